@@ -0,0 +1,102 @@
+"""Wasted swipes and candidate query latency, with and without reciprocal filtering.
+
+Seeds a throwaway database with profiles of mixed preferences in a few
+cities, then fetches a batch of candidates for a sample of viewers, once
+with Database's two-sided filtering and once with the viewer's preferences
+only (as before it existed). A swipe is wasted when the candidate's own
+gender or age preferences rule the viewer out, so it can never become a
+match. Reports the wasted share and query latency percentiles.
+
+    python scripts/bench_reciprocal.py
+    python scripts/bench_reciprocal.py --users 200000 --viewers 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from db import ANY_GENDER, Database  # noqa: E402
+
+CITIES = ("Berlin", "Paris", "Madrid", "Rome", "Vienna")
+
+
+class OneSidedDatabase(Database):
+    """Database that only applies the viewer's preferences"""
+
+    @staticmethod
+    def _accepts_condition(user: Dict) -> Tuple[str, Tuple]:
+        return '', ()
+
+
+def seed(db: Database, users: int):
+    rng = random.Random(42)
+    for user_id in range(1, users + 1):
+        gender = rng.choice(["Male", "Female"])
+        other = "Female" if gender == "Male" else "Male"
+        age = rng.randint(18, 60)
+        db.save_user({
+            "user_id": user_id,
+            "name": f"User {user_id}",
+            "age": age,
+            "city": rng.choice(CITIES),
+            "gender": gender,
+            "looking_gender": rng.choices([other, gender, ANY_GENDER], [6, 1, 3])[0],
+            "looking_age_min": max(18, age - rng.randint(2, 12)),
+            "looking_age_max": age + rng.randint(2, 12),
+            "description": "Benchmark profile",
+            "photo": None,
+        })
+
+
+def accepts(candidate: Dict, viewer: Dict) -> bool:
+    return (candidate["looking_gender"] in (viewer["gender"], ANY_GENDER)
+            and candidate["looking_age_min"] <= viewer["age"] <= candidate["looking_age_max"])
+
+
+def run(db: Database, users: int, viewers: int, batch: int):
+    rng = random.Random(7)
+    served = wasted = 0
+    latencies = []
+    for _ in range(viewers):
+        viewer = db.get_user(rng.randint(1, users))
+        start = time.perf_counter()
+        found = db.find_potential_matches(viewer["user_id"], batch)
+        latencies.append(time.perf_counter() - start)
+        served += len(found)
+        wasted += sum(not accepts(candidate, viewer) for candidate in found)
+    latencies.sort()
+    return served, wasted, latencies
+
+
+def percentile(values, share: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--viewers", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=20, help="candidates per query")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        db = Database(path)
+        seed(db, args.users)
+        db.close()
+        for mode, cls in (("one-sided", OneSidedDatabase), ("reciprocal", Database)):
+            db = cls(path)
+            served, wasted, latencies = run(db, args.users, args.viewers, args.batch)
+            db.close()
+            print(f"{mode:>10}: {served} served, {wasted} wasted "
+                  f"({wasted / max(served, 1):.0%}), query p50 {percentile(latencies, 0.5):.2f} ms, "
+                  f"p95 {percentile(latencies, 0.95):.2f} ms, p99 {percentile(latencies, 0.99):.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
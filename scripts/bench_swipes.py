@@ -0,0 +1,129 @@
+"""Swipe throughput benchmark for db.Database.
+
+Seeds a throwaway database with profiles in one city (or, with ``--geo``,
+at shared locations scattered around every gazetteer city), then replays the
+browsing loop (find a match, mark it viewed, like it) and reports swipes/sec.
+``--legacy`` runs the same loop with a fresh connection per call, which is how
+Database worked before the connection pool.
+
+    python scripts/bench_swipes.py --users 5000 --swipes 5000
+    python scripts/bench_swipes.py --legacy
+    python scripts/bench_swipes.py --write-behind
+    python scripts/bench_swipes.py --write-behind --engine
+    python scripts/bench_swipes.py --geo --users 200000
+    python scripts/bench_swipes.py --rank
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from db import Database  # noqa: E402
+from engine import MatchingEngine  # noqa: E402
+from geo import gazetteer  # noqa: E402
+from ranking import Ranker  # noqa: E402
+
+
+class LegacyDatabase(Database):
+    """Database with connect-per-call behaviour and default pragmas"""
+
+    def __init__(self, db_name: str):
+        # No write-behind and no profile cache, neither existed back then
+        super().__init__(db_name, write_behind=False, profile_cache_size=0)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def seed(db: Database, users: int, geo: bool = False):
+    rng = random.Random(42)
+    places = list(gazetteer())
+    for user_id in range(1, users + 1):
+        profile = {
+            "user_id": user_id,
+            "name": f"User {user_id}",
+            "age": rng.randint(18, 60),
+            "city": "Berlin",
+            "gender": rng.choice(["Male", "Female"]),
+            "looking_gender": rng.choice(["Male", "Female", "Doesn't matter"]),
+            "looking_age_min": 18,
+            "looking_age_max": 99,
+            "description": "Benchmark profile",
+            "photo": None,
+        }
+        if geo:
+            # Within about 40 km of a city
+            place = rng.choice(places)
+            profile["city"] = place.name
+            profile["latitude"] = place.latitude + rng.uniform(-0.35, 0.35)
+            profile["longitude"] = place.longitude + rng.uniform(-0.35, 0.35)
+        db.save_user(profile)
+
+
+def run(db: Database, users: int, swipes: int) -> float:
+    rng = random.Random(7)
+    start = time.perf_counter()
+    for _ in range(swipes):
+        viewer = rng.randint(1, users)
+        matches = db.find_potential_matches(viewer, 1)
+        if not matches:
+            db.reset_viewed_profiles(viewer)
+            continue
+        viewed = matches[0]["user_id"]
+        db.add_viewed_profile(viewer, viewed)
+        if rng.random() < 0.5:
+            db.add_like(viewer, viewed)
+    return swipes / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--swipes", type=int, default=2000)
+    parser.add_argument("--legacy", action="store_true",
+                        help="open a new connection for every call")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="buffer views and likes and write them in batches")
+    parser.add_argument("--engine", action="store_true",
+                        help="select candidates with the in-memory numpy engine")
+    parser.add_argument("--geo", action="store_true",
+                        help="scatter profiles around all gazetteer cities")
+    parser.add_argument("--rank", action="store_true",
+                        help="rank candidates by their swipe counters")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        if args.legacy:
+            db = LegacyDatabase(path)
+        else:
+            db = Database(path, write_behind=args.write_behind,
+                          engine=MatchingEngine() if args.engine else None,
+                          ranker=Ranker() if args.rank else None)
+        seed(db, args.users, args.geo)
+        rate = run(db, args.users, args.swipes)
+        db.close()
+
+    if args.legacy:
+        mode = "legacy"
+    else:
+        mode = "+".join(["pooled"] + [flag for flag, on in (
+            ("write-behind", args.write_behind), ("engine", args.engine), ("geo", args.geo),
+            ("rank", args.rank)) if on])
+    print(f"{mode}: {rate:,.0f} swipes/sec ({args.users} users, {args.swipes} swipes)")
+
+
+if __name__ == "__main__":
+    main()
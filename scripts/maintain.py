@@ -0,0 +1,47 @@
+"""Run the bot's database maintenance jobs once and print what they did.
+
+Uses the same jobs and SOULMATE_* settings as the bot (maintenance.database_jobs),
+so it can run from cron while the bot is stopped, or once after a big
+cleanup. ``--budget`` overrides every job's time budget, e.g. to run each
+job to completion on a large database.
+
+    python scripts/maintain.py --db soulmate.db
+    python scripts/maintain.py --db soulmate.db --budget 60
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import settings  # noqa: E402
+from async_db import AsyncDatabase  # noqa: E402
+from db import Database  # noqa: E402
+from maintenance import Maintenance, database_jobs  # noqa: E402
+
+
+async def run(db_name: str, budget: float):
+    db = AsyncDatabase(Database(db_name))
+    maintenance = Maintenance(database_jobs(db, budget or None))
+    try:
+        for job in maintenance.jobs:
+            await job.run()
+    finally:
+        await db.close()
+    for name, stats in maintenance.stats().items():
+        print(f"{name:>10}: reclaimed {stats['reclaimed']} in {stats['seconds']:.3f}s"
+              + (" (out of budget)" if stats["out_of_budget"] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=settings.DB_NAME)
+    parser.add_argument("--budget", type=float, default=0,
+                        help="seconds per job instead of the configured budgets")
+    args = parser.parse_args()
+    asyncio.run(run(args.db, args.budget))
+
+
+if __name__ == "__main__":
+    main()
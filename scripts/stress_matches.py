@@ -0,0 +1,110 @@
+"""Concurrency stress test for mutual match detection in db.Database.
+
+Creates ``--pairs`` pairs of users and has both users of every pair like
+each other at the same time, from ``--threads`` threads in each of
+``--processes`` processes sharing one database file. With more than one
+process the two likes of a pair always come from different processes, and
+likes are written through as in a multi-worker deployment. With one process
+and ``--write-behind`` they go through the swipe buffer. Afterwards it
+checks that every pair has exactly one match row and that exactly one of
+its two add_like calls reported it.
+
+    python scripts/stress_matches.py --pairs 5000
+    python scripts/stress_matches.py --pairs 5000 --processes 4 --write-behind
+    python scripts/stress_matches.py --pairs 5000 --processes 1 --write-behind
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from db import Database  # noqa: E402
+
+
+def run_job(db_name: str, likes, threads: int, write_behind: bool, buffer_likes: bool, results):
+    """Send ``likes`` from several threads and record which ones reported a match"""
+    database = Database(db_name, write_behind=write_behind, buffer_likes=buffer_likes)
+    barrier = threading.Barrier(threads)
+    reported = []
+
+    def worker(chunk):
+        barrier.wait()
+        for from_id, to_id in chunk:
+            if database.add_like(from_id, to_id):
+                reported.append(min(from_id, to_id))
+
+    workers = [threading.Thread(target=worker, args=(likes[i::threads],)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    database.close()
+    results.put(reported)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--write-behind", action="store_true")
+    args = parser.parse_args()
+
+    processes = max(1, args.processes)
+    # Likes can only be buffered when one process sees all of them
+    buffer_likes = processes == 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, "stress.db")
+        Database(db_name).close()
+
+        results = multiprocessing.Queue()
+        # Pair i is users i and i + pairs; its two likes go to neighbouring
+        # processes, so reciprocal likes race across them
+        jobs = [[] for _ in range(processes)]
+        for i in range(args.pairs):
+            jobs[i % processes].append((i, i + args.pairs))
+            jobs[(i + 1) % processes].append((i + args.pairs, i))
+        for job in jobs:
+            random.shuffle(job)
+
+        started = time.perf_counter()
+        workers = [
+            multiprocessing.Process(
+                target=run_job,
+                args=(db_name, job, args.threads, args.write_behind, buffer_likes, results),
+            )
+            for job in jobs
+        ]
+        for worker in workers:
+            worker.start()
+        reported = [pair for _ in workers for pair in results.get()]
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        conn = sqlite3.connect(db_name)
+        match_rows = conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        like_rows = conn.execute("SELECT COUNT(*) FROM likes").fetchone()[0]
+        conn.close()
+
+    duplicates = len(reported) - len(set(reported))
+    print(f"{2 * args.pairs} likes from {processes} processes x {args.threads} threads "
+          f"in {elapsed:.2f}s")
+    print(f"likes: {like_rows}, match rows: {match_rows}, reported: {len(reported)}, "
+          f"reported twice: {duplicates}")
+    ok = like_rows == 2 * args.pairs and match_rows == args.pairs \
+        and len(reported) == args.pairs and not duplicates
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Check that one user flooding the bot doesn't hold up everyone else.
+
+Feeds updates to updates.UserOrderedProcessor the way the Application does:
+``--flood`` updates from one user, then one update from each of ``--users``
+other users. Every handler sleeps ``--delay`` seconds. The processor has
+``--slots`` concurrent slots. Afterwards the script checks three things:
+the flooding user's updates ran in order and never two at a time; every
+other user was served while the flood was still going; and no more than
+``--slots`` updates ever ran at once.
+
+    python scripts/stress_updates.py
+    python scripts/stress_updates.py --flood 200 --users 50 --slots 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from telegram import Chat, Message, Update, User  # noqa: E402
+
+from updates import UserOrderedProcessor  # noqa: E402
+
+FLOODER = 1
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, f"User {user_id}", False)
+    chat = Chat(user_id, Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, None, chat, from_user=user, text="hi"))
+
+
+async def run(args):
+    processor = UserOrderedProcessor(args.slots)
+    running = 0
+    peak = 0
+    flood_order = []
+    finished = {}
+
+    async def handle(update: Update):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        try:
+            if update.effective_user.id == FLOODER:
+                flood_order.append(update.update_id)
+            await asyncio.sleep(args.delay)
+        finally:
+            running -= 1
+        finished[update.update_id] = time.perf_counter()
+
+    updates = [make_update(i, FLOODER) for i in range(args.flood)]
+    updates += [make_update(args.flood + i, 100 + i) for i in range(args.users)]
+    started = time.perf_counter()
+    # The Application starts a task per update without waiting for earlier ones
+    await asyncio.gather(*(processor.process_update(update, handle(update)) for update in updates))
+
+    assert flood_order == list(range(args.flood)), "flood handled out of order"
+    assert peak <= args.slots, f"{peak} updates ran at once with {args.slots} slots"
+    flood_done = max(finished[i] for i in range(args.flood))
+    others_done = max(finished[args.flood + i] for i in range(args.users))
+    assert others_done < flood_done, "other users waited for the flood to clear"
+    print(f"flood of {args.flood}: {flood_done - started:.2f}s, "
+          f"{args.users} other users served within {others_done - started:.2f}s, "
+          f"at most {peak} at once")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flood", type=int, default=50, help="updates from the flooding user")
+    parser.add_argument("--users", type=int, default=20, help="other users, one update each")
+    parser.add_argument("--slots", type=int, default=4, help="concurrent updates")
+    parser.add_argument("--delay", type=float, default=0.01, help="seconds per handler")
+    asyncio.run(run(parser.parse_args()))
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Run the bot in webhook mode against a fake Bot API, without network access.
+
+Starts the embedded webhook server on a free local port with a stand-in for
+Telegram's HTTP API that records every call, POSTs update JSON to it the way
+Telegram would and prints what the bot sent back. Requires a config.py with
+any token next to main.py, like a normal run.
+
+    python scripts/webhook_local.py
+    python scripts/webhook_local.py --updates 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+SECRET = "local-secret"
+os.environ.setdefault("SOULMATE_DB_NAME", os.path.join(tempfile.mkdtemp(), "webhook.db"))
+
+from telegram.request import BaseRequest  # noqa: E402
+
+import main  # noqa: E402
+from webhook import WebhookServer  # noqa: E402
+
+
+class LocalRequest(BaseRequest):
+    """Answers Bot API calls locally and records them"""
+
+    def __init__(self):
+        self.calls = []
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, params))
+
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Soulmate", "username": "soulmate_bot"}
+        elif endpoint == "getChat":
+            result = {"id": params["chat_id"], "type": "private", "username": "someone"}
+        elif endpoint in ("sendMessage", "sendPhoto"):
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": params["chat_id"], "type": "private"},
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(update_id: int, user_id: int, text: str) -> bytes:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}] if text == "/start" else [],
+        },
+    }).encode()
+
+
+async def post(port: int, body: bytes, secret: str = SECRET) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"POST /telegram HTTP/1.1\r\n"
+        f"Host: localhost\r\n"
+        f"Content-Type: application/json\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+
+async def run(updates: int):
+    request = LocalRequest()
+    app = main.build_app(request=request)
+    server = WebhookServer(app, port=0, path="/telegram", secret_token=SECRET)
+    running = asyncio.create_task(main.run_webhook(app, server))
+
+    # Port 0 picks a free port, known once the server is listening
+    while not server.port:
+        await asyncio.sleep(0.01)
+    port = server.port
+
+    print("wrong secret ->", await post(port, make_update(1, 1000, "/start"), secret="nope"))
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(
+        post(port, make_update(i + 2, 1000 + i, "/start")) for i in range(updates)
+    ))
+    print(f"{updates} updates accepted ({set(statuses)}) in {time.perf_counter() - started:.2f}s")
+
+    os.kill(os.getpid(), signal.SIGTERM)
+    await running
+
+    sent = [params for endpoint, params in request.calls if endpoint == "sendMessage"]
+    print(f"{len(sent)} messages sent, first: {sent[0]['text']!r}" if sent else "no messages sent")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args().updates))
@@ -0,0 +1,107 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from db import Database
+from storage import Storage
+
+
+class AsyncDatabase(Storage):
+    """Async facade over Database that runs every call on a bounded thread pool"""
+
+    tables = ("users", "likes", "matches", "seen_sets", "user_stats")
+
+    def __init__(self, database: Database, max_workers: int = 4):
+        self.database = database
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="db"
+        )
+
+    @property
+    def engine(self):
+        return self.database.engine
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def save_user(self, user_data: Dict) -> bool:
+        return await self._run(self.database.save_user, user_data)
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        return await self._run(self.database.get_user, user_id)
+
+    async def user_exists(self, user_id: int) -> bool:
+        return await self._run(self.database.user_exists, user_id)
+
+    async def set_username(self, user_id: int, username: str) -> bool:
+        return await self._run(self.database.set_username, user_id, username)
+
+    async def activate_user(self, user_id: int) -> bool:
+        return await self._run(self.database.activate_user, user_id)
+
+    async def deactivate_user(self, user_id: int) -> bool:
+        return await self._run(self.database.deactivate_user, user_id)
+
+    async def is_user_active(self, user_id: int) -> bool:
+        return await self._run(self.database.is_user_active, user_id)
+
+    async def find_potential_matches(self, user_id: int, limit: int = 1,
+                                     exclude_ids: Iterable[int] = ()) -> List[Dict]:
+        return await self._run(
+            self.database.find_potential_matches, user_id, limit, exclude_ids
+        )
+
+    async def get_candidates(self, viewer_id: int, candidate_ids: Iterable[int]) -> Dict[int, Dict]:
+        return await self._run(self.database.get_candidates, viewer_id, list(candidate_ids))
+
+    async def add_like(self, from_user_id: int, to_user_id: int) -> bool:
+        return await self._run(self.database.add_like, from_user_id, to_user_id)
+
+    async def add_viewed_profile(self, viewer_id: int, viewed_id: int) -> bool:
+        return await self._run(self.database.add_viewed_profile, viewer_id, viewed_id)
+
+    async def count_unread_likes(self, user_id: int) -> int:
+        return await self._run(self.database.count_unread_likes, user_id)
+
+    async def get_matches(self, user_id: int, limit: Optional[int] = None,
+                          before: Optional[int] = None, after: Optional[int] = None) -> List[Dict]:
+        return await self._run(self.database.get_matches, user_id, limit, before, after)
+
+    async def reset_viewed_profiles(self, user_id: int) -> bool:
+        return await self._run(self.database.reset_viewed_profiles, user_id)
+
+    async def clear_all_user_interactions(self, user_id: int) -> bool:
+        return await self._run(self.database.clear_all_user_interactions, user_id)
+
+    async def give_user_fresh_start(self, user_id: int) -> bool:
+        return await self._run(self.database.give_user_fresh_start, user_id)
+
+    async def retire_inactive_users(self, days: float, batch_size: int = 1000) -> Tuple[int, bool]:
+        return await self._run(self.database.retire_inactive_users, days, batch_size)
+
+    async def compact_interactions(self, batch_size: int = 1000) -> Tuple[int, bool]:
+        return await self._run(self.database.compact_interactions, batch_size)
+
+    async def prune_profile_changes(self, keep: int, batch_size: int = 1000) -> Tuple[int, bool]:
+        return await self._run(self.database.prune_profile_changes, keep, batch_size)
+
+    async def incremental_vacuum(self, pages: int = 256) -> Tuple[int, bool]:
+        return await self._run(self.database.incremental_vacuum, pages)
+
+    async def analyze(self, table: str, analysis_limit: int = 1000) -> bool:
+        return await self._run(self.database.analyze, table, analysis_limit)
+
+    async def checkpoint_wal(self) -> int:
+        return await self._run(self.database.checkpoint_wal)
+
+    async def sync_engine(self) -> int:
+        return await self._run(self.database.sync_engine)
+
+    async def close(self):
+        """Wait for in-flight calls, then close the underlying database"""
+        self._executor.shutdown(wait=True)
+        self.database.close()
@@ -0,0 +1,236 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+from async_db import AsyncDatabase
+from state import StateStore
+
+
+class BrowseState:
+    """Queued candidate ids, the one on screen and the one prepared to follow it
+
+    ``checked`` holds the queued and prefetched candidates' profiles as last
+    read from the database at ``checked_at`` (None for those that no longer
+    qualified).
+    """
+
+    __slots__ = ("queue", "current_id", "prefetched", "checked", "checked_at")
+
+    def __init__(self):
+        self.queue = deque()
+        self.current_id: Optional[int] = None
+        self.prefetched: Optional[Dict] = None
+        self.checked: Dict[int, Optional[Dict]] = {}
+        self.checked_at = 0.0
+
+
+class CandidateQueue:
+    """Per-user queue of candidate ids, fetched from the database in batches
+
+    The matching query runs once per batch instead of once per swipe, and
+    profiles from the user's "likes you" inbox go to the front. Queued
+    candidates are re-read together, in one query, whenever the queue is
+    refilled and before serving from a check older than ``recheck_after``
+    seconds, so profiles that were deactivated, edited out of the viewer's
+    filters or already viewed in the meantime are skipped. Serving from the
+    queue costs no query in between; changes made by other workers show up
+    within ``recheck_after`` seconds or the next refill.
+
+    While a profile is on screen the one after it is passed through
+    ``prepare`` (rendering, photo checks) in the background, so the next
+    swipe only has to send it. A prefetched profile is served only if the
+    latest check still has it unchanged.
+    """
+
+    def __init__(self, db: AsyncDatabase, batch_size: int = 20, low_water: int = 5,
+                 store: Optional[StateStore] = None,
+                 prepare: Optional[Callable[[Dict], Awaitable[Dict]]] = None,
+                 recheck_after: float = 30.0):
+        self.db = db
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self.recheck_after = recheck_after
+        self.store = store if store is not None else StateStore()
+        self.prepare = prepare
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self._refills: Dict[int, asyncio.Task] = {}
+        self._prefetches: Dict[int, asyncio.Task] = {}
+
+    def stats(self) -> Dict[str, int]:
+        """Prefetch hits and misses, and the size of the per-user state"""
+        return {
+            "prefetch_hits": self.prefetch_hits,
+            "prefetch_misses": self.prefetch_misses,
+            **self.store.stats(),
+        }
+
+    def _state(self, user_id: int) -> BrowseState:
+        state = self.store.get(user_id)
+        if state is None:
+            state = BrowseState()
+            self.store.put(user_id, state)
+        return state
+
+    def current(self, user_id: int) -> Optional[int]:
+        """Id of the profile the user is looking at right now"""
+        state = self.store.get(user_id)
+        return state.current_id if state else None
+
+    async def next(self, user_id: int) -> Optional[Dict]:
+        """Serve the next valid candidate and make it current"""
+        state = self._state(user_id)
+        state.current_id = None
+
+        candidate = await self._take_prefetched(user_id, state)
+        if candidate is None:
+            candidate = await self._pop_valid(user_id, state)
+            if candidate is None:
+                return None
+            state.current_id = candidate["user_id"]
+            if self.prepare:
+                candidate = await self.prepare(candidate)
+
+        state.current_id = candidate["user_id"]
+        self._schedule_prefetch(user_id)
+        return candidate
+
+    async def _pop_valid(self, user_id: int, state: BrowseState) -> Optional[Dict]:
+        """Pop queued ids until one still qualifies, refilling as needed"""
+        while True:
+            if not state.queue:
+                await self._refill(user_id)
+                if not state.queue:
+                    return None
+
+            await self._recheck_if_stale(user_id, state)
+            candidate = await self._fresh(user_id, state, state.queue.popleft())
+            if candidate:
+                break
+
+        if len(state.queue) <= self.low_water:
+            self._schedule_refill(user_id)
+        return candidate
+
+    async def _take_prefetched(self, user_id: int, state: BrowseState) -> Optional[Dict]:
+        task = self._prefetches.get(user_id)
+        if task:
+            await asyncio.wait((task,))
+        if state.prefetched is None:
+            return None
+
+        # The check reads the database rather than this process's profile
+        # cache, which doesn't see edits and deactivations by other workers
+        await self._recheck_if_stale(user_id, state)
+        candidate, state.prefetched = state.prefetched, None
+        if candidate is None:
+            return None
+        fresh = await self._fresh(user_id, state, candidate["user_id"])
+        if fresh and all(candidate.get(k) == v for k, v in fresh.items()):
+            self.prefetch_hits += 1
+            return candidate
+        self.prefetch_misses += 1
+        return None
+
+    async def _recheck_if_stale(self, user_id: int, state: BrowseState):
+        if time.monotonic() - state.checked_at > self.recheck_after:
+            await self._check(user_id, state)
+
+    async def _check(self, user_id: int, state: BrowseState, known: Optional[Dict[int, Dict]] = None):
+        """Re-read the queued and prefetched candidates in one query
+
+        ``known`` profiles were just read by the matching query and are
+        taken as they are.
+        """
+        known = known or {}
+        ids = [candidate_id for candidate_id in state.queue if candidate_id not in known]
+        if state.prefetched is not None:
+            ids.append(state.prefetched["user_id"])
+        checked: Dict[int, Optional[Dict]] = dict.fromkeys(ids)
+        # Matching queries only set likes_you on profiles from the inbox
+        checked.update(
+            (candidate_id, dict(candidate, likes_you=bool(candidate.get("likes_you"))))
+            for candidate_id, candidate in known.items()
+        )
+        if ids:
+            checked.update(await self.db.get_candidates(user_id, ids))
+        state.checked = checked
+        state.checked_at = time.monotonic()
+
+    async def _fresh(self, user_id: int, state: BrowseState, candidate_id: int) -> Optional[Dict]:
+        """Candidate's profile from the latest check, or None if it no longer qualified"""
+        if candidate_id in state.checked:
+            return state.checked[candidate_id]
+        # Queued while a check was running
+        return await self.db.get_candidate(user_id, candidate_id)
+
+    def clear(self, user_id: int):
+        """Forget everything queued for the user (preferences or history changed)"""
+        self.store.pop(user_id)
+        for tasks in (self._refills, self._prefetches):
+            task = tasks.pop(user_id, None)
+            if task:
+                task.cancel()
+
+    def _schedule_prefetch(self, user_id: int):
+        if user_id not in self._prefetches:
+            self._prefetches[user_id] = asyncio.create_task(self._prefetch(user_id))
+
+    async def _prefetch(self, user_id: int):
+        """Validate and prepare the candidate after the current one"""
+        try:
+            state = self._state(user_id)
+            candidate = state.prefetched = await self._pop_valid(user_id, state)
+            if candidate and self.prepare:
+                candidate = await self.prepare(candidate)
+            # The state may have been cleared or evicted in the meantime
+            if self.store.get(user_id) is state:
+                state.prefetched = candidate
+        finally:
+            if self._prefetches.get(user_id) is asyncio.current_task():
+                del self._prefetches[user_id]
+
+    def _schedule_refill(self, user_id: int):
+        if user_id not in self._refills:
+            self._refills[user_id] = asyncio.create_task(self._refill(user_id))
+
+    async def _refill(self, user_id: int):
+        """Top the queue up with a new batch, sharing an in-flight refill if any"""
+        task = self._refills.get(user_id)
+        if task and task is not asyncio.current_task():
+            await asyncio.wait((task,))
+            return
+
+        try:
+            state = self._state(user_id)
+            exclude = list(state.queue)
+            if state.current_id is not None:
+                exclude.append(state.current_id)
+            if state.prefetched is not None:
+                exclude.append(state.prefetched["user_id"])
+
+            batch = await self.db.find_potential_matches(
+                user_id, self.batch_size, exclude_ids=exclude
+            )
+            # The state may have been cleared or evicted while the query ran
+            if self.store.get(user_id) is state:
+                # Skip ids served or prefetched while the query ran
+                taken = {state.current_id, *state.queue}
+                if state.prefetched is not None:
+                    taken.add(state.prefetched["user_id"])
+                batch = [candidate for candidate in batch if candidate["user_id"] not in taken]
+                # Re-check what was queued before, with the new batch as read
+                await self._check(
+                    user_id, state, {candidate["user_id"]: candidate for candidate in batch}
+                )
+                # Profiles that liked the user skip ahead of those queued earlier
+                state.queue.extendleft(reversed(
+                    [candidate["user_id"] for candidate in batch if candidate.get("likes_you")]
+                ))
+                state.queue.extend(
+                    candidate["user_id"] for candidate in batch if not candidate.get("likes_you")
+                )
+        finally:
+            if self._refills.get(user_id) is asyncio.current_task():
+                del self._refills[user_id]
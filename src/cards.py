@@ -0,0 +1,63 @@
+from typing import Dict, Optional
+
+from outbox import INTERACTIVE, MAX_TEXT_LENGTH, Outbox, text_length
+
+# Telegram's limit for a photo caption, in UTF-16 code units
+CAPTION_LIMIT = 1024
+
+
+def truncate(text: str, length: int) -> str:
+    """``text`` cut to at most ``length`` UTF-16 code units, ending in an ellipsis if cut"""
+    if text_length(text) <= length:
+        return text
+    # Ignoring errors drops half of a surrogate pair left at the cut
+    return text.encode("utf-16-le")[:max(0, length - 1) * 2].decode("utf-16-le", "ignore") + "…"
+
+
+def _card(head: str, description: str, footer: Optional[str]) -> str:
+    """Card text with the description shortened to fit one text message"""
+    tail = f"\n\n{footer}" if footer else ""
+    room = MAX_TEXT_LENGTH - text_length(head) - text_length(tail)
+    return f"{head}{truncate(description, room)}{tail}"
+
+
+def profile_caption(profile: Dict, footer: Optional[str] = None) -> str:
+    """Short card shown while browsing and in match notices"""
+    head = (
+        f"{profile['name']}, {profile['age']}\n"
+        f"{profile['city']}\n"
+    )
+    return _card(head, profile['description'], footer)
+
+
+def preview_caption(profile: Dict, footer: Optional[str] = None) -> str:
+    """Full card shown to the owner at the end of registration"""
+    head = (
+        f"Name: {profile['name']}\n"
+        f"Age: {profile['age']}\n"
+        f"City: {profile['city']}\n"
+        f"Gender: {profile['gender']}\n"
+        f"Looking for: {profile['looking_gender']}\n"
+        f"Age range: {profile['looking_age_min']} - {profile['looking_age_max']}\n"
+        "About: "
+    )
+    return _card(head, profile['description'], footer)
+
+
+async def send_card(outbox: Outbox, chat_id: int, photo: Optional[str], caption: str,
+                    reply_markup=None, lane: int = INTERACTIVE):
+    """Queue a profile card as one photo-with-caption message
+
+    Captions over Telegram's limit (long descriptions) are sent as the photo
+    followed by a text message, which then carries the keyboard. Text past
+    the message limit is cut; the caption builders above already shorten
+    the description to fit.
+    """
+    text = truncate(caption, MAX_TEXT_LENGTH)
+    if not photo:
+        await outbox.send_message(chat_id, text, reply_markup=reply_markup, lane=lane)
+    elif text_length(caption) <= CAPTION_LIMIT:
+        await outbox.send_photo(chat_id, photo, caption=caption, reply_markup=reply_markup, lane=lane)
+    else:
+        await outbox.send_photo(chat_id, photo, lane=lane)
+        await outbox.send_message(chat_id, text, reply_markup=reply_markup, lane=lane)
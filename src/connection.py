@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+from typing import List
+
+
+class ConnectionPool:
+    """Long-lived SQLite connections, one per worker thread"""
+
+    def __init__(
+        self,
+        db_name: str,
+        cache_size_kb: int = 64 * 1024,
+        mmap_size: int = 256 * 1024 * 1024,
+        cached_statements: int = 256,
+        busy_timeout: float = 5.0,
+    ):
+        self.db_name = db_name
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._closed = False
+
+    def _open(self) -> sqlite3.Connection:
+        """Open a connection and apply the performance pragmas"""
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.busy_timeout,
+            cached_statements=self.cached_statements,
+            # Each connection is only used by the thread that opened it,
+            # this just allows close() to run from the shutdown thread.
+            check_same_thread=False,
+        )
+        # Lets Database.incremental_vacuum give free pages back. This only
+        # takes effect in a new database file, before WAL mode is set
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # Negative cache_size is in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Return the calling thread's connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection pool is closed")
+            conn = self._open()
+            self._connections.append(conn)
+
+        self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close every connection opened by the pool"""
+        with self._lock:
+            self._closed = True
+            connections, self._connections = self._connections, []
+
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                print(f"Database error on close: {e}")
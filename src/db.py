@@ -1,17 +1,118 @@
 import os
 import random
 import sqlite3
-from typing import Dict, List, Optional, Tuple
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from cache import TTLCache
+from connection import ConnectionPool
+from geo import SearchArea, area_cell, locate, normalize_city, search_area
+from ranking import UserStats
+from seenset import EPOCH_BITS, EPOCH_MASK, SeenSet, seen_key
+from swipes import SwipeBuffer
+
+GENDERS = ("Male", "Female")
+ANY_GENDER = "Doesn't matter"
+
+MAX_RAND_KEY = (1 << 63) - 1
+# Upper bound of an INTEGER PRIMARY KEY, for open-ended id ranges
+MAX_ROWID = (1 << 63) - 1
+
+_MISSING = object()
+
+# Every user has an epoch that a fresh start increments. Likes and matches
+# record the epochs of both users and only count while those are current, so
+# a fresh start never has to find and delete rows; compact_interactions
+# removes the dead ones later.
+
+# Candidate has not been liked by the viewer (bound to viewer_id and the
+# viewer's epoch). Viewed profiles are excluded in Python with the viewer's
+# SeenSet.
+NOT_LIKED_CONDITION = '''
+    NOT EXISTS (
+        SELECT 1 FROM likes
+        WHERE from_user_id = ? AND to_user_id = users.user_id
+        AND from_epoch = ? AND to_epoch = users.epoch
+    )
+'''
+
+# Insert a like (?1 -> ?2) at the users' current epochs, or renew one left
+# over from an earlier epoch. A like that is already current changes nothing.
+# New and renewed likes wait in the recipient's inbox until answered.
+INSERT_LIKE = '''
+    INSERT INTO likes (from_user_id, to_user_id, from_epoch, to_epoch)
+    VALUES (?1, ?2,
+            COALESCE((SELECT epoch FROM users WHERE user_id = ?1), 0),
+            COALESCE((SELECT epoch FROM users WHERE user_id = ?2), 0))
+    ON CONFLICT (from_user_id, to_user_id) DO UPDATE SET
+        from_epoch = excluded.from_epoch,
+        to_epoch = excluded.to_epoch,
+        created_at = CURRENT_TIMESTAMP,
+        answered = 0
+    WHERE from_epoch != excluded.from_epoch OR to_epoch != excluded.to_epoch
+'''
+
+# The recipient has answered a like (?1 -> ?2): they have seen the liker, or
+# the like is part of a match
+ANSWER_LIKE = '''
+    UPDATE likes SET answered = 1
+    WHERE from_user_id = ? AND to_user_id = ? AND answered = 0
+'''
+
+# Add to a user's swipe counters: (user_id, last_active_at, views_given,
+# likes_given, views_received, likes_unread). likes_unread may go down, but
+# not below 0.
+COUNT_STATS = '''
+    INSERT INTO user_stats
+    (user_id, last_active_at, views_given, likes_given, views_received, likes_unread)
+    VALUES (?1, ?2, ?3, ?4, ?5, MAX(?6, 0))
+    ON CONFLICT (user_id) DO UPDATE SET
+        last_active_at = MAX(last_active_at, excluded.last_active_at),
+        views_given = views_given + excluded.views_given,
+        likes_given = likes_given + excluded.likes_given,
+        views_received = views_received + excluded.views_received,
+        likes_unread = MAX(likes_unread + ?6, 0)
+'''
 
 
 class Database:
-    def __init__(self, db_name: str = "soulmate.db"):
+    def __init__(self, db_name: str = "soulmate.db", write_behind: bool = False,
+                 flush_interval: float = 0.05, flush_batch: int = 500,
+                 profile_cache_size: int = 10000, profile_cache_ttl: float = 300.0,
+                 engine=None, buffer_likes: bool = True, radius_km: float = 50.0,
+                 ranker=None):
         self.db_name = db_name
+        # Candidates are searched within this distance of located profiles
+        self.radius_km = radius_km
+        # Orders the candidates found (ranking.Ranker); None keeps them random
+        self.ranker = ranker
+        self.pool = ConnectionPool(db_name)
+        self.profiles = TTLCache(profile_cache_size, profile_cache_ttl)
         self.init_database()
+        self.engine = engine
+        self._engine_seq = 0
+        # Where compact_interactions continues in each table
+        self._compact_position = {'likes': 0, 'matches': 0, 'seen_sets': 0}
+        if engine is not None:
+            self._load_engine()
+        self.swipes = SwipeBuffer(self, flush_interval, flush_batch) if write_behind else None
+        # With several processes the reciprocal like may sit in another
+        # process's buffer, so likes are written through
+        self.buffer_likes = buffer_likes
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Get this thread's pooled connection (use as a transaction context)"""
+        return self.pool.connection()
+    
+    def close(self):
+        """Flush buffered swipes and close all pooled connections"""
+        if self.swipes:
+            self.swipes.close()
+        self.pool.close()
     
     def init_database(self):
         """Initialize the database with required tables"""
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             # Users table
@@ -28,7 +129,15 @@ class Database:
                     description TEXT NOT NULL,
                     photo TEXT,
                     is_active BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    city_key TEXT NOT NULL DEFAULT '',
+                    rand_key INTEGER NOT NULL DEFAULT 0,
+                    epoch INTEGER NOT NULL DEFAULT 0,
+                    deactivated_at TIMESTAMP,
+                    latitude REAL,
+                    longitude REAL,
+                    cell TEXT NOT NULL DEFAULT '',
+                    username TEXT
                 )
             ''')
             
@@ -39,6 +148,9 @@ class Database:
                     from_user_id INTEGER NOT NULL,
                     to_user_id INTEGER NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    from_epoch INTEGER NOT NULL DEFAULT 0,
+                    to_epoch INTEGER NOT NULL DEFAULT 0,
+                    answered INTEGER NOT NULL DEFAULT 0,
                     FOREIGN KEY (from_user_id) REFERENCES users (user_id),
                     FOREIGN KEY (to_user_id) REFERENCES users (user_id),
                     UNIQUE(from_user_id, to_user_id)
@@ -52,38 +164,363 @@ class Database:
                     user1_id INTEGER NOT NULL,
                     user2_id INTEGER NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    epoch1 INTEGER NOT NULL DEFAULT 0,
+                    epoch2 INTEGER NOT NULL DEFAULT 0,
                     FOREIGN KEY (user1_id) REFERENCES users (user_id),
                     FOREIGN KEY (user2_id) REFERENCES users (user_id),
                     UNIQUE(user1_id, user2_id)
                 )
             ''')
             
-            # Viewed profiles table (to avoid showing same profiles repeatedly)
+            # Viewed profiles (to avoid showing same profiles repeatedly),
+            # one encoded SeenSet per viewer
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS viewed_profiles (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    viewer_id INTEGER NOT NULL,
-                    viewed_id INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (viewer_id) REFERENCES users (user_id),
-                    FOREIGN KEY (viewed_id) REFERENCES users (user_id),
-                    UNIQUE(viewer_id, viewed_id)
+                CREATE TABLE IF NOT EXISTS seen_sets (
+                    viewer_id INTEGER PRIMARY KEY,
+                    ids BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    FOREIGN KEY (viewer_id) REFERENCES users (user_id)
+                )
+            ''')
+            
+            # Log of changed profiles, so other processes can refresh
+            # their in-memory matching engines
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS profile_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL
                 )
             ''')
+            for event in ('INSERT', 'UPDATE'):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS log_profile_{event.lower()}
+                    AFTER {event} ON users
+                    BEGIN
+                        INSERT INTO profile_changes (user_id) VALUES (NEW.user_id);
+                    END
+                ''')
+            
+            self._migrate(cursor)
+
+            # Swipe counters for candidate ranking, updated with every view
+            # and like (see COUNT_STATS)
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'")
+            new_stats = cursor.fetchone() is None
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id INTEGER PRIMARY KEY,
+                    last_active_at REAL NOT NULL DEFAULT 0,
+                    views_given INTEGER NOT NULL DEFAULT 0,
+                    likes_given INTEGER NOT NULL DEFAULT 0,
+                    views_received INTEGER NOT NULL DEFAULT 0,
+                    likes_unread INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            if new_stats:
+                # Start existing users from what the tables still know: when
+                # they registered, their seen set size and their likes. Views
+                # received can't be told from the seen sets and start at 0.
+                cursor.execute('''
+                    INSERT INTO user_stats (user_id, last_active_at, views_given, likes_given)
+                    SELECT user_id,
+                           COALESCE(CAST(strftime('%s', created_at) AS REAL), 0),
+                           COALESCE((SELECT size FROM seen_sets WHERE viewer_id = user_id), 0),
+                           (SELECT COUNT(*) FROM likes WHERE from_user_id = user_id)
+                    FROM users
+                ''')
+            cursor.execute('PRAGMA table_info(user_stats)')
+            if 'likes_unread' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute(
+                    'ALTER TABLE user_stats ADD COLUMN likes_unread INTEGER NOT NULL DEFAULT 0'
+                )
+                new_stats = True
+            if new_stats:
+                cursor.execute('''
+                    UPDATE user_stats SET likes_unread = (
+                        SELECT COUNT(*) FROM likes
+                        JOIN users ON users.user_id = likes.to_user_id
+                        WHERE likes.to_user_id = user_stats.user_id
+                        AND likes.to_epoch = users.epoch AND likes.answered = 0
+                    )
+                ''')
+
+            # A like whose reciprocal already exists (at the same epochs)
+            # creates the match row in the same statement, so concurrent
+            # writers can't both miss it. Renewing a like left over from an
+            # earlier epoch renews the match the same way.
+            cursor.execute('''
+                SELECT 1 FROM sqlite_master
+                WHERE type = 'trigger' AND name = 'match_on_mutual_like'
+            ''')
+            if cursor.fetchone() is None:
+                # Mutual likes written before the trigger may lack their match
+                cursor.execute('''
+                    INSERT OR IGNORE INTO matches (user1_id, user2_id, epoch1, epoch2)
+                    SELECT a.from_user_id, a.to_user_id, a.from_epoch, a.to_epoch
+                    FROM likes a
+                    JOIN likes b
+                    ON b.from_user_id = a.to_user_id AND b.to_user_id = a.from_user_id
+                    AND b.from_epoch = a.to_epoch AND b.to_epoch = a.from_epoch
+                    WHERE a.from_user_id < a.to_user_id
+                ''')
+            for name, event in (('match_on_mutual_like', 'INSERT'),
+                                ('match_on_renewed_like', 'UPDATE OF from_epoch, to_epoch')):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {name}
+                    AFTER {event} ON likes
+                    WHEN EXISTS (
+                        SELECT 1 FROM likes
+                        WHERE from_user_id = NEW.to_user_id AND to_user_id = NEW.from_user_id
+                        AND from_epoch = NEW.to_epoch AND to_epoch = NEW.from_epoch
+                    )
+                    BEGIN
+                        INSERT INTO matches (user1_id, user2_id, epoch1, epoch2)
+                        VALUES (
+                            MIN(NEW.from_user_id, NEW.to_user_id),
+                            MAX(NEW.from_user_id, NEW.to_user_id),
+                            CASE WHEN NEW.from_user_id < NEW.to_user_id
+                                 THEN NEW.from_epoch ELSE NEW.to_epoch END,
+                            CASE WHEN NEW.from_user_id < NEW.to_user_id
+                                 THEN NEW.to_epoch ELSE NEW.from_epoch END
+                        )
+                        ON CONFLICT (user1_id, user2_id) DO UPDATE SET
+                            epoch1 = excluded.epoch1,
+                            epoch2 = excluded.epoch2,
+                            created_at = CURRENT_TIMESTAMP
+                        WHERE epoch1 != excluded.epoch1 OR epoch2 != excluded.epoch2;
+                    END
+                ''')
+
+            # Candidate lookups: equality on cell/active/gender, then a range
+            # scan over rand_key for random sampling. Age, the candidate's own
+            # preferences, the bounding box of the search radius and the epoch
+            # are filtered from the index entry, so rows that don't qualify
+            # never cost a table lookup. The UNIQUE constraint on likes
+            # already indexes (from_user_id, to_user_id).
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_nearby
+                ON users (cell, is_active, gender, rand_key, age, looking_gender,
+                          looking_age_min, looking_age_max, latitude, longitude, epoch)
+            ''')
+            
+            # Each user's inbox: likes they haven't answered yet, oldest first
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_likes_inbox
+                ON likes (to_user_id, to_epoch) WHERE answered = 0
+            ''')
+            
+            # Each user's matches on either side of the pair, for paging
+            # through them by id
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_matches_user1 ON matches (user1_id, epoch1, id)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_matches_user2 ON matches (user2_id, epoch2, id)
+            ''')
+            
+            # Deactivated profiles by age, for retire_inactive_users
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_deactivated
+                ON users (deactivated_at) WHERE is_active = 0
+            ''')
             
             conn.commit()
     
+    def _load_engine(self):
+        """Fill the in-memory matching engine from the users table"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            # Taken first, so changes made during the load are applied again by sync_engine
+            cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM profile_changes')
+            self._engine_seq = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT user_id, cell, latitude, longitude, age, gender, looking_gender,
+                       looking_age_min, looking_age_max, is_active, epoch
+                FROM users
+            ''')
+            columns = [desc[0] for desc in cursor.description]
+            self.engine.load(dict(zip(columns, row)) for row in cursor)
+    
+    def sync_engine(self) -> int:
+        """Apply profile changes made by other processes to the matching engine"""
+        if self.engine is None:
+            return 0
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT MIN(seq), MAX(seq) FROM profile_changes')
+                first, last = cursor.fetchone()
+                if last is None or last <= self._engine_seq:
+                    return 0
+                if first > self._engine_seq + 1:
+                    # Part of the log we haven't seen was pruned
+                    self._load_engine()
+                    return last - first + 1
+                
+                cursor.execute('''
+                    SELECT user_id, cell, latitude, longitude, age, gender, looking_gender,
+                           looking_age_min, looking_age_max, is_active, epoch
+                    FROM users
+                    WHERE user_id IN (
+                        SELECT user_id FROM profile_changes WHERE seq > ? AND seq <= ?
+                    )
+                ''', (self._engine_seq, last))
+                columns = [desc[0] for desc in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor]
+                for user in rows:
+                    self.engine.upsert(user)
+                self._engine_seq = last
+                return len(rows)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return 0
+    
+    def _migrate(self, cursor: sqlite3.Cursor):
+        """Bring tables created by older versions up to the current schema"""
+        cursor.execute('PRAGMA table_info(users)')
+        columns = {row[1] for row in cursor.fetchall()}
+        
+        if 'city_key' not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN city_key TEXT NOT NULL DEFAULT ''")
+            cursor.execute('SELECT user_id, city FROM users')
+            cursor.executemany(
+                'UPDATE users SET city_key = ? WHERE user_id = ?',
+                [(normalize_city(city), user_id) for user_id, city in cursor.fetchall()]
+            )
+        
+        if 'rand_key' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN rand_key INTEGER NOT NULL DEFAULT 0')
+            cursor.execute('SELECT user_id FROM users')
+            cursor.executemany(
+                'UPDATE users SET rand_key = ? WHERE user_id = ?',
+                [(random.getrandbits(63), user_id) for (user_id,) in cursor.fetchall()]
+            )
+        
+        cursor.execute('PRAGMA user_version')
+        if cursor.fetchone()[0] < 1:
+            if 'epoch' in columns:
+                # Seen keys used to have 16 epoch bits, which overflowed int64
+                # for large user ids; re-key with the current layout
+                cursor.execute('SELECT viewer_id, ids FROM seen_sets')
+                for viewer_id, ids in cursor.fetchall():
+                    keys = SeenSet(
+                        seen_key(key >> 16, key & 0xFFFF) for key in SeenSet.from_bytes(ids)
+                    )
+                    self._store_seen(cursor, viewer_id, keys)
+            cursor.execute('PRAGMA user_version = 1')
+
+        if 'epoch' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0')
+            # Seen sets hold seen_key(user_id, epoch) instead of plain ids
+            cursor.execute('SELECT viewer_id, ids FROM seen_sets')
+            for viewer_id, ids in cursor.fetchall():
+                keys = SeenSet(seen_key(user_id, 0) for user_id in SeenSet.from_bytes(ids))
+                self._store_seen(cursor, viewer_id, keys)
+
+        if 'cell' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN latitude REAL')
+            cursor.execute('ALTER TABLE users ADD COLUMN longitude REAL')
+            cursor.execute("ALTER TABLE users ADD COLUMN cell TEXT NOT NULL DEFAULT ''")
+            # Place existing profiles by their city, where the gazetteer knows it
+            cursor.execute('SELECT user_id, city, city_key FROM users')
+            updates = []
+            for user_id, city, city_key in cursor.fetchall():
+                latitude, longitude = locate({'city': city})
+                updates.append((latitude, longitude, area_cell(city_key, latitude, longitude), user_id))
+            cursor.executemany(
+                'UPDATE users SET latitude = ?, longitude = ?, cell = ? WHERE user_id = ?', updates
+            )
+        # Replaced by idx_users_nearby
+        cursor.execute('DROP INDEX IF EXISTS idx_users_candidates')
+        # Older idx_users_nearby lacks the preference columns; init_database
+        # creates the current one
+        cursor.execute('''
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'index' AND name = 'idx_users_nearby'
+            AND sql NOT LIKE '%looking_gender%'
+        ''')
+        if cursor.fetchone():
+            cursor.execute('DROP INDEX idx_users_nearby')
+
+        if 'username' not in columns:
+            # Telegram @username, '' if the user has none and NULL until seen
+            cursor.execute('ALTER TABLE users ADD COLUMN username TEXT')
+
+        if 'deactivated_at' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN deactivated_at TIMESTAMP')
+            # Profiles that were already inactive count from now
+            cursor.execute(
+                'UPDATE users SET deactivated_at = CURRENT_TIMESTAMP WHERE is_active = 0'
+            )
+
+        for table, added in (('likes', ('from_epoch', 'to_epoch')),
+                             ('matches', ('epoch1', 'epoch2'))):
+            cursor.execute(f'PRAGMA table_info({table})')
+            if added[0] not in {row[1] for row in cursor.fetchall()}:
+                for column in added:
+                    cursor.execute(
+                        f'ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0'
+                    )
+
+        cursor.execute('PRAGMA table_info(likes)')
+        if 'answered' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE likes ADD COLUMN answered INTEGER NOT NULL DEFAULT 0')
+            # Likes that are part of a match are answered. Likes from profiles
+            # the recipient had already seen are found by the inbox later.
+            cursor.execute('''
+                UPDATE likes SET answered = 1
+                WHERE EXISTS (
+                    SELECT 1 FROM likes reverse
+                    WHERE reverse.from_user_id = likes.to_user_id
+                    AND reverse.to_user_id = likes.from_user_id
+                )
+            ''')
+
+        # The match trigger of older versions ignores epochs; init_database
+        # creates the current one
+        cursor.execute('''
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'trigger' AND name = 'match_on_mutual_like'
+            AND sql NOT LIKE '%epoch%'
+        ''')
+        if cursor.fetchone():
+            cursor.execute('DROP TRIGGER match_on_mutual_like')
+
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'viewed_profiles'")
+        if cursor.fetchone():
+            # Fold the old row-per-pair table into one SeenSet per viewer
+            cursor.execute('SELECT viewer_id, viewed_id FROM viewed_profiles ORDER BY viewer_id')
+            seen: Dict[int, List[int]] = {}
+            for viewer_id, viewed_id in cursor.fetchall():
+                seen.setdefault(viewer_id, []).append(viewed_id)
+            for viewer_id, viewed_ids in seen.items():
+                keys = SeenSet(seen_key(user_id, 0) for user_id in viewed_ids)
+                self._store_seen(cursor, viewer_id, keys)
+            cursor.execute('DROP TABLE viewed_profiles')
+    
     def save_user(self, user_data: Dict) -> bool:
         """Save or update user data"""
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                
+
+                # Editing a profile must not undo a fresh start or forget the username
+                cursor.execute(
+                    'SELECT epoch, username FROM users WHERE user_id = ?', (user_data['user_id'],)
+                )
+                row = cursor.fetchone()
+                epoch, username = row if row else (0, None)
+
+                city_key = normalize_city(user_data['city'])
+                latitude, longitude = locate(user_data)
+                cell = area_cell(city_key, latitude, longitude)
+
                 cursor.execute('''
-                    INSERT OR REPLACE INTO users 
-                    (user_id, name, age, city, gender, looking_gender, 
-                     looking_age_min, looking_age_max, description, photo, is_active)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                    INSERT OR REPLACE INTO users
+                    (user_id, name, age, city, gender, looking_gender,
+                     looking_age_min, looking_age_max, description, photo, is_active,
+                     city_key, rand_key, epoch, latitude, longitude, cell, username)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
                     user_data['user_id'],
                     user_data['name'],
@@ -94,10 +531,28 @@ class Database:
                     user_data['looking_age_min'],
                     user_data['looking_age_max'],
                     user_data['description'],
-                    user_data.get('photo')
+                    user_data.get('photo'),
+                    city_key,
+                    random.getrandbits(63),
+                    epoch,
+                    latitude,
+                    longitude,
+                    cell,
+                    user_data.get('username', username),
                 ))
+                cursor.execute(COUNT_STATS, (user_data['user_id'], time.time(), 0, 0, 0, 0))
                 
                 conn.commit()
+                self.profiles.invalidate(user_data['user_id'])
+                if self.engine is not None:
+                    self.engine.upsert({
+                        **user_data,
+                        'cell': cell,
+                        'latitude': latitude,
+                        'longitude': longitude,
+                        'is_active': 1,
+                        'epoch': epoch,
+                    })
                 return True
         except sqlite3.Error as e:
             print(f"Database error: {e}")
@@ -105,16 +560,24 @@ class Database:
     
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Get user data by user_id"""
+        cached = self.profiles.get(user_id, _MISSING)
+        if cached is not _MISSING:
+            return dict(cached) if cached else None
+        
+        generation = self.profiles.generation
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
                 row = cursor.fetchone()
                 
+                user = None
                 if row:
                     columns = [desc[0] for desc in cursor.description]
-                    return dict(zip(columns, row))
-                return None
+                    user = dict(zip(columns, row))
+                # Missing users are cached too, save_user invalidates them
+                self.profiles.set(user_id, user, generation)
+                return dict(user) if user else None
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return None
@@ -123,13 +586,36 @@ class Database:
         """Check if user exists in database"""
         return self.get_user(user_id) is not None
     
+    def set_username(self, user_id: int, username: str) -> bool:
+        """Store the user's Telegram @username ('' for none); True if it changed"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'UPDATE users SET username = ? WHERE user_id = ? AND username IS NOT ?',
+                    (username, user_id, username)
+                )
+                conn.commit()
+                if cursor.rowcount:
+                    self.profiles.invalidate(user_id)
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+    
     def activate_user(self, user_id: int) -> bool:
         """Activate user profile"""
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('UPDATE users SET is_active = 1 WHERE user_id = ?', (user_id,))
+                cursor.execute(
+                    'UPDATE users SET is_active = 1, deactivated_at = NULL WHERE user_id = ?',
+                    (user_id,)
+                )
                 conn.commit()
+                self.profiles.invalidate(user_id)
+                if self.engine is not None:
+                    self.engine.set_active(user_id, True)
                 return cursor.rowcount > 0
         except sqlite3.Error as e:
             print(f"Database error: {e}")
@@ -138,10 +624,16 @@ class Database:
     def deactivate_user(self, user_id: int) -> bool:
         """Deactivate user profile"""
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('UPDATE users SET is_active = 0 WHERE user_id = ?', (user_id,))
+                cursor.execute(
+                    'UPDATE users SET is_active = 0, deactivated_at = CURRENT_TIMESTAMP WHERE user_id = ?',
+                    (user_id,)
+                )
                 conn.commit()
+                self.profiles.invalidate(user_id)
+                if self.engine is not None:
+                    self.engine.set_active(user_id, False)
                 return cursor.rowcount > 0
         except sqlite3.Error as e:
             print(f"Database error: {e}")
@@ -152,132 +644,611 @@ class Database:
         user = self.get_user(user_id)
         return user and user['is_active']
     
-    def find_potential_matches(self, user_id: int, limit: int = 1) -> List[Dict]:
-        """Find potential matches based on user preferences"""
+    def _wanted_genders(self, user: Dict) -> Tuple[str, ...]:
+        """Genders the user wants to see"""
+        if user['looking_gender'] == ANY_GENDER:
+            return GENDERS
+        return (user['looking_gender'],)
+    
+    def find_potential_matches(self, user_id: int, limit: int = 1,
+                               exclude_ids: Iterable[int] = ()) -> List[Dict]:
+        """Find potential matches based on user preferences
+
+        Profiles that liked the user and are waiting for an answer come
+        first (marked ``likes_you``), then new ones.
+        """
         user = self.get_user(user_id)
         if not user:
             return []
         
+        exclude = set(exclude_ids)
+        if self.swipes:
+            exclude |= self.swipes.pending_views(user_id)
+        
+        area = search_area(user, self.radius_km)
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                
-                # Build the query based on looking_gender preference
-                if user['looking_gender'] == "Doesn't matter":
-                    gender_condition = "1=1"
-                    params = []
-                else:
-                    gender_condition = "gender = ?"
-                    params = [user['looking_gender']]
-                
-                # Add other parameters
-                params.extend([
-                    user['city'],
+                seen = self._load_seen(cursor, user_id)
+                inbox = self._walk_inbox(conn, user, area, limit, exclude, seen)
+                if len(inbox) == limit:
+                    return inbox
+                exclude.update(candidate['user_id'] for candidate in inbox)
+                return inbox + self._find_new(cursor, user, area, limit - len(inbox),
+                                              exclude, seen)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return []
+    
+    def _find_new(self, cursor: sqlite3.Cursor, user: Dict, area: SearchArea, limit: int,
+                  exclude: set, seen: SeenSet) -> List[Dict]:
+        """Random unseen candidates, or the best of a random pool with a ranker"""
+        pool = limit if self.ranker is None else limit * self.ranker.pool
+        if self.engine is not None:
+            try:
+                return self._engine_matches(cursor, user, area, pool, limit, exclude, seen)
+            except Exception as e:
+                print(f"Matching engine error, falling back to SQL: {e}")
+        
+        # Random sampling without a sort: start at a random point of each
+        # (cell, gender) slice of the rand_key index and walk forward,
+        # wrapping around to the beginning if the tail runs out.
+        pivot = random.getrandbits(63)
+        candidates = []
+        
+        for cell in area.cells:
+            for gender in self._wanted_genders(user):
+                found = self._walk_slice(
+                    cursor, user, area, cell, gender, pivot, MAX_RAND_KEY,
+                    pool, exclude, seen
+                )
+                if len(found) < pool and pivot > 0:
+                    found += self._walk_slice(
+                        cursor, user, area, cell, gender, 0, pivot - 1,
+                        pool - len(found), exclude, seen
+                    )
+                candidates.extend(found)
+        
+        # Order by distance from the pivot, wrapping around
+        candidates.sort(key=lambda c: (c['rand_key'] - pivot) % (1 << 63))
+        return self._rank(cursor, candidates[:pool], limit)
+    
+    def _engine_matches(self, cursor: sqlite3.Cursor, user: Dict, area: SearchArea, pool: int,
+                        limit: int, exclude: set, seen: SeenSet) -> List[Dict]:
+        """Candidate selection through the in-memory matching engine"""
+        cursor.execute('''
+            SELECT likes.to_user_id FROM likes
+            JOIN users ON users.user_id = likes.to_user_id
+            WHERE likes.from_user_id = ? AND likes.from_epoch = ?
+            AND likes.to_epoch = users.epoch
+        ''', (user['user_id'], user['epoch']))
+        liked = [row[0] for row in cursor.fetchall()]
+        
+        ids = self.engine.candidates(user, area, pool, seen.ids, liked, exclude)
+        if not ids:
+            return []
+        
+        placeholders = ', '.join('?' * len(ids))
+        cursor.execute(f'SELECT * FROM users WHERE user_id IN ({placeholders})', ids)
+        columns = [desc[0] for desc in cursor.description]
+        rows = {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+        return self._rank(cursor, [rows[user_id] for user_id in ids if user_id in rows], limit)
+    
+    def _walk_inbox(self, conn: sqlite3.Connection, user: Dict, area: SearchArea, limit: int,
+                    exclude: set, seen: SeenSet) -> List[Dict]:
+        """Up to ``limit`` profiles whose unanswered like to the user is current, oldest first
+
+        They have to pass the same filters as any candidate. Likes from
+        profiles the user had already seen (the like came later) are marked
+        answered on the way. When the walk reaches the end of the inbox the
+        likes_unread counter is set to what it found, which also corrects it
+        for likes hidden by the liker's fresh start or deactivation.
+        """
+        genders = self._wanted_genders(user)
+        placeholders = ', '.join('?' * len(genders))
+        cells = ', '.join('?' * len(area.cells))
+        box_condition, box = self._box_condition(area)
+        accepts_condition, accepts = self._accepts_condition(user)
+        
+        cursor = conn.cursor()
+        found = []
+        stale = []
+        waiting = 0
+        last_id = 0
+        page = limit + len(exclude)
+        while True:
+            cursor.execute(f'''
+                SELECT likes.id AS like_id, users.* FROM likes
+                JOIN users ON users.user_id = likes.from_user_id
+                WHERE likes.to_user_id = ? AND likes.to_epoch = ? AND likes.answered = 0
+                AND likes.id > ?
+                AND likes.from_epoch = users.epoch
+                AND cell IN ({cells})
+                AND is_active = 1
+                AND gender IN ({placeholders})
+                AND age BETWEEN ? AND ?
+                {accepts_condition}
+                {box_condition}
+                AND {NOT_LIKED_CONDITION}
+                ORDER BY likes.id
+                LIMIT ?
+            ''', (
+                user['user_id'],
+                user['epoch'],
+                last_id,
+                *area.cells,
+                *genders,
+                user['looking_age_min'],
+                user['looking_age_max'],
+                *accepts,
+                *box,
+                user['user_id'],
+                user['epoch'],
+                page
+            ))
+            rows = cursor.fetchall()
+            columns = [desc[0] for desc in cursor.description]
+            
+            for row in rows:
+                candidate = dict(zip(columns, row))
+                like_id = candidate.pop('like_id')
+                if not area.contains(candidate['latitude'], candidate['longitude']):
+                    continue
+                if seen_key(candidate['user_id'], candidate['epoch']) in seen:
+                    stale.append(like_id)
+                    continue
+                waiting += 1
+                if candidate['user_id'] not in exclude and len(found) < limit:
+                    candidate['likes_you'] = True
+                    found.append(candidate)
+            
+            done = len(rows) < page
+            if done or len(found) == limit:
+                break
+            last_id = rows[-1][0]
+            page = min(page * 2, 1024)
+        
+        if stale:
+            placeholders = ', '.join('?' * len(stale))
+            cursor.execute(f'UPDATE likes SET answered = 1 WHERE id IN ({placeholders})', stale)
+        if done:
+            cursor.execute(
+                'SELECT likes_unread FROM user_stats WHERE user_id = ?', (user['user_id'],)
+            )
+            row = cursor.fetchone()
+            if row is not None and row[0] != waiting:
+                cursor.execute(
+                    'UPDATE user_stats SET likes_unread = ? WHERE user_id = ?',
+                    (waiting, user['user_id'])
+                )
+        elif stale:
+            self._count_swipes(cursor, unread=[(user['user_id'], -len(stale))])
+        if conn.in_transaction:
+            conn.commit()
+        return found
+    
+    def _rank(self, cursor: sqlite3.Cursor, candidates: List[Dict], limit: int) -> List[Dict]:
+        """The ``limit`` best candidates by the ranker, or the first ones without one"""
+        if self.ranker is None or not candidates:
+            return candidates[:limit]
+        return self.ranker.top(candidates, self._load_stats(cursor, candidates), limit)
+    
+    def _load_stats(self, cursor: sqlite3.Cursor, users: List[Dict]) -> Dict[int, UserStats]:
+        """Swipe counters of the given users (missing ones have none yet)"""
+        ids = [user['user_id'] for user in users]
+        placeholders = ', '.join('?' * len(ids))
+        cursor.execute(f'''
+            SELECT user_id, last_active_at, views_given, likes_given, views_received
+            FROM user_stats WHERE user_id IN ({placeholders})
+        ''', ids)
+        return {row[0]: UserStats(*row[1:]) for row in cursor.fetchall()}
+    
+    def _walk_slice(self, cursor: sqlite3.Cursor, user: Dict, area: SearchArea, cell: str,
+                    gender: str, lower: int, upper: int, limit: int, exclude: set,
+                    seen: SeenSet) -> List[Dict]:
+        """Walk one (cell, gender) slice of the candidate index in rand_key order
+
+        Pages through rand_key in [lower, upper] until ``limit`` candidates
+        that are neither excluded nor already seen have been found. Rows
+        outside the bounding box of the search radius are skipped within
+        the index; only the ones left are checked against the circle.
+        """
+        found = []
+        # Start small and grow, users who have seen most of the slice need
+        # a few bigger pages
+        page = limit + len(exclude)
+        box_condition, box = self._box_condition(area)
+        accepts_condition, accepts = self._accepts_condition(user)
+        
+        while len(found) < limit:
+            cursor.execute(f'''
+                SELECT * FROM users
+                WHERE cell = ?
+                AND is_active = 1
+                AND gender = ?
+                AND rand_key BETWEEN ? AND ?
+                AND age BETWEEN ? AND ?
+                {accepts_condition}
+                {box_condition}
+                AND user_id != ?
+                AND {NOT_LIKED_CONDITION}
+                ORDER BY rand_key
+                LIMIT ?
+            ''', (
+                cell,
+                gender,
+                lower,
+                upper,
+                user['looking_age_min'],
+                user['looking_age_max'],
+                *accepts,
+                *box,
+                user['user_id'],  # exclude self
+                user['user_id'],  # exclude already liked
+                user['epoch'],
+                page
+            ))
+            rows = cursor.fetchall()
+            columns = [desc[0] for desc in cursor.description]
+            
+            for row in rows:
+                candidate = dict(zip(columns, row))
+                if (candidate['user_id'] not in exclude
+                        and seen_key(candidate['user_id'], candidate['epoch']) not in seen
+                        and area.contains(candidate['latitude'], candidate['longitude'])):
+                    found.append(candidate)
+            
+            if len(rows) < page:
+                break
+            lower = rows[-1][columns.index('rand_key')] + 1
+            page = min(page * 2, 1024)
+        
+        return found[:limit]
+    
+    def get_candidate(self, viewer_id: int, candidate_id: int) -> Optional[Dict]:
+        """Fresh profile of a queued candidate, or None if they no longer qualify"""
+        return self.get_candidates(viewer_id, [candidate_id]).get(candidate_id)
+    
+    def get_candidates(self, viewer_id: int, candidate_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Fresh profiles of queued candidates by id, leaving out those that no longer qualify"""
+        user = self.get_user(viewer_id)
+        if not user:
+            return {}
+        ids = set(candidate_ids)
+        if self.swipes:
+            ids -= self.swipes.pending_views(viewer_id)
+        if not ids:
+            return {}
+        
+        genders = self._wanted_genders(user)
+        placeholders = ', '.join('?' * len(genders))
+        id_placeholders = ', '.join('?' * len(ids))
+        area = search_area(user, self.radius_km)
+        cells = ', '.join('?' * len(area.cells))
+        box_condition, box = self._box_condition(area)
+        accepts_condition, accepts = self._accepts_condition(user)
+        
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                # likes_you is a lookup in the likes primary key index
+                cursor.execute(f'''
+                    SELECT *, EXISTS (
+                        SELECT 1 FROM likes
+                        WHERE from_user_id = users.user_id AND to_user_id = ?
+                        AND from_epoch = users.epoch AND to_epoch = ?
+                    ) AS likes_you
+                    FROM users
+                    WHERE user_id IN ({id_placeholders})
+                    AND cell IN ({cells})
+                    AND is_active = 1
+                    AND gender IN ({placeholders})
+                    AND age BETWEEN ? AND ?
+                    {accepts_condition}
+                    {box_condition}
+                    AND {NOT_LIKED_CONDITION}
+                ''', (
+                    viewer_id,
+                    user['epoch'],
+                    *ids,
+                    *area.cells,
+                    *genders,
                     user['looking_age_min'],
                     user['looking_age_max'],
-                    user_id,  # exclude self
-                    user_id,  # exclude already viewed
-                    user_id   # exclude already liked
-                ])
-                
-                query = f'''
-                    SELECT * FROM users 
-                    WHERE {gender_condition}
-                    AND LOWER(TRIM(city)) = LOWER(TRIM(?))
-                    AND age BETWEEN ? AND ?
-                    AND user_id != ?
-                    AND is_active = 1
-                    AND user_id NOT IN (
-                        SELECT viewed_id FROM viewed_profiles WHERE viewer_id = ?
-                    )
-                    AND user_id NOT IN (
-                        SELECT to_user_id FROM likes WHERE from_user_id = ?
-                    )
-                    ORDER BY RANDOM()
-                    LIMIT ?
-                '''
-                
-                params.append(limit)
-                cursor.execute(query, params)
+                    *accepts,
+                    *box,
+                    viewer_id,
+                    user['epoch']
+                ))
                 rows = cursor.fetchall()
-                
+                if not rows:
+                    return {}
+
                 columns = [desc[0] for desc in cursor.description]
-                return [dict(zip(columns, row)) for row in rows]
-                
+                seen = self._load_seen(cursor, viewer_id)
+                found = {}
+                for row in rows:
+                    candidate = dict(zip(columns, row))
+                    candidate['likes_you'] = bool(candidate['likes_you'])
+                    if (area.contains(candidate['latitude'], candidate['longitude'])
+                            and seen_key(candidate['user_id'], candidate['epoch']) not in seen):
+                        found[candidate['user_id']] = candidate
+                return found
         except sqlite3.Error as e:
             print(f"Database error: {e}")
-            return []
+            return {}
+    
+    @staticmethod
+    def _accepts_condition(user: Dict) -> Tuple[str, Tuple]:
+        """SQL condition and parameters: the candidate's own preferences accept the user"""
+        return (
+            'AND looking_gender IN (?, ?) AND ? BETWEEN looking_age_min AND looking_age_max',
+            (user['gender'], ANY_GENDER, user['age']),
+        )
+    
+    @staticmethod
+    def _box_condition(area: SearchArea) -> Tuple[str, Tuple[float, ...]]:
+        """SQL condition and parameters for the bounding box of a search area"""
+        if area.box is None:
+            return '', ()
+        lat_min, lat_max, lon_min, lon_max = area.box
+        return (
+            'AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?',
+            (lat_min, lat_max, lon_min, lon_max),
+        )
+    
+    def _load_seen(self, cursor: sqlite3.Cursor, viewer_id: int) -> SeenSet:
+        """Profiles the viewer has already been shown"""
+        cursor.execute('SELECT ids FROM seen_sets WHERE viewer_id = ?', (viewer_id,))
+        row = cursor.fetchone()
+        return SeenSet.from_bytes(row[0]) if row else SeenSet()
+    
+    def _store_seen(self, cursor: sqlite3.Cursor, viewer_id: int, seen: SeenSet):
+        cursor.execute('''
+            INSERT OR REPLACE INTO seen_sets (viewer_id, ids, size)
+            VALUES (?, ?, ?)
+        ''', (viewer_id, seen.to_bytes(), len(seen)))
+    
+    def _add_seen(self, cursor: sqlite3.Cursor,
+                  views: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """Merge (viewer_id, viewed_id) pairs into the viewers' seen sets
+
+        Returns the pairs that weren't in them yet.
+        """
+        epochs: Dict[int, int] = {}
+        by_viewer: Dict[int, Dict[int, int]] = {}
+        for viewer_id, viewed_id in views:
+            if viewed_id not in epochs:
+                cursor.execute('SELECT epoch FROM users WHERE user_id = ?', (viewed_id,))
+                row = cursor.fetchone()
+                epochs[viewed_id] = row[0] if row else 0
+            by_viewer.setdefault(viewer_id, {})[seen_key(viewed_id, epochs[viewed_id])] = viewed_id
+        added = []
+        for viewer_id, keys in by_viewer.items():
+            seen = self._load_seen(cursor, viewer_id)
+            added += [(viewer_id, viewed_id) for key, viewed_id in keys.items() if key not in seen]
+            self._store_seen(cursor, viewer_id, seen.union(keys))
+        return added
+    
+    def _count_swipes(self, cursor: sqlite3.Cursor, views: Iterable[Tuple[int, int]] = (),
+                      likes: Iterable[Tuple[int, int]] = (),
+                      unread: Iterable[Tuple[int, int]] = ()):
+        """Add views and likes that were just written to the user_stats counters
+
+        Every written like is unread for its recipient; ``unread`` holds
+        further (user_id, change) pairs, -1 for each answered like.
+        """
+        now = time.time()
+        # user_id -> [last_active_at, views_given, likes_given, views_received, likes_unread]
+        counts: Dict[int, list] = {}
+        for viewer_id, viewed_id in views:
+            viewer = counts.setdefault(viewer_id, [now, 0, 0, 0, 0])
+            viewer[0] = now
+            viewer[1] += 1
+            counts.setdefault(viewed_id, [0.0, 0, 0, 0, 0])[3] += 1
+        for from_user_id, to_user_id in likes:
+            liker = counts.setdefault(from_user_id, [now, 0, 0, 0, 0])
+            liker[0] = now
+            liker[2] += 1
+            counts.setdefault(to_user_id, [0.0, 0, 0, 0, 0])[4] += 1
+        for user_id, change in unread:
+            counts.setdefault(user_id, [0.0, 0, 0, 0, 0])[4] += change
+        cursor.executemany(COUNT_STATS, [(user_id, *values) for user_id, values in counts.items()])
+    
+    def _answer_likes(self, cursor: sqlite3.Cursor,
+                      likes: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """Take (from_user_id, to_user_id) likes out of their recipients' inboxes
+
+        Returns the likes_unread changes for _count_swipes.
+        """
+        unread = []
+        for from_user_id, to_user_id in likes:
+            cursor.execute(ANSWER_LIKE, (from_user_id, to_user_id))
+            if cursor.rowcount:
+                unread.append((to_user_id, -1))
+        return unread
     
     def add_like(self, from_user_id: int, to_user_id: int) -> bool:
         """Add a like and check for mutual match"""
+        if self.swipes and self.buffer_likes:
+            return self.swipes.add_like(from_user_id, to_user_id)
+        
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
+            with self._connect() as conn:
+                # Take the write lock before anything else: the reciprocal
+                # like has either committed already or waits for this one
+                conn.execute('BEGIN IMMEDIATE')
+                is_match = self._insert_like(conn, from_user_id, to_user_id)
+                conn.commit()
+                return is_match
                 
-                # Add the like
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+    
+    def _insert_like(self, conn: sqlite3.Connection, from_user_id: int, to_user_id: int) -> bool:
+        """Insert a like; True only if it created the match row"""
+        before = conn.total_changes
+        conn.execute(INSERT_LIKE, (from_user_id, to_user_id))
+        # The like itself plus the match row written by the trigger; a
+        # repeated like changes nothing and so can't report the match twice
+        changes = conn.total_changes - before
+        if changes:
+            cursor = conn.cursor()
+            unread = []
+            if changes == 2:
+                unread = self._answer_likes(
+                    cursor, [(from_user_id, to_user_id), (to_user_id, from_user_id)]
+                )
+            self._count_swipes(cursor, likes=[(from_user_id, to_user_id)], unread=unread)
+        return changes == 2
+    
+    def _insert_match(self, cursor: sqlite3.Cursor, user_a: int, user_b: int) -> bool:
+        # Ensure consistent ordering (smaller ID first)
+        cursor.execute('''
+            INSERT INTO matches (user1_id, user2_id, epoch1, epoch2)
+            VALUES (?1, ?2,
+                    COALESCE((SELECT epoch FROM users WHERE user_id = ?1), 0),
+                    COALESCE((SELECT epoch FROM users WHERE user_id = ?2), 0))
+            ON CONFLICT (user1_id, user2_id) DO UPDATE SET
+                epoch1 = excluded.epoch1,
+                epoch2 = excluded.epoch2,
+                created_at = CURRENT_TIMESTAMP
+            WHERE epoch1 != excluded.epoch1 OR epoch2 != excluded.epoch2
+        ''', (min(user_a, user_b), max(user_a, user_b)))
+        return cursor.rowcount == 1
+    
+    def _has_like(self, from_user_id: int, to_user_id: int) -> bool:
+        """Check the likes table for a single like at the users' current epochs"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
                 cursor.execute('''
-                    INSERT OR IGNORE INTO likes (from_user_id, to_user_id)
-                    VALUES (?, ?)
+                    SELECT 1 FROM likes
+                    WHERE from_user_id = ?1 AND to_user_id = ?2
+                    AND from_epoch = COALESCE((SELECT epoch FROM users WHERE user_id = ?1), 0)
+                    AND to_epoch = COALESCE((SELECT epoch FROM users WHERE user_id = ?2), 0)
                 ''', (from_user_id, to_user_id))
-                
-                # Check if it's a mutual like
-                cursor.execute('''
-                    SELECT 1 FROM likes 
-                    WHERE from_user_id = ? AND to_user_id = ?
-                ''', (to_user_id, from_user_id))
-                
-                is_match = cursor.fetchone() is not None
-                
-                # If it's a match, add to matches table
-                if is_match:
-                    # Ensure consistent ordering (smaller ID first)
-                    user1_id = min(from_user_id, to_user_id)
-                    user2_id = max(from_user_id, to_user_id)
-                    
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO matches (user1_id, user2_id)
-                        VALUES (?, ?)
-                    ''', (user1_id, user2_id))
-                
+                return cursor.fetchone() is not None
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+    
+    def _write_match(self, from_user_id: int, to_user_id: int) -> bool:
+        """Write a like that is known to complete a match, with its match row
+
+        The reciprocal like may still be in the swipe buffer, so the match row
+        is inserted here if the trigger didn't. True if the match is new.
+        """
+        try:
+            with self._connect() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                created = self._insert_like(conn, from_user_id, to_user_id)
+                if not created:
+                    cursor = conn.cursor()
+                    created = self._insert_match(cursor, from_user_id, to_user_id)
+                    self._count_swipes(cursor, unread=self._answer_likes(
+                        cursor, [(from_user_id, to_user_id), (to_user_id, from_user_id)]
+                    ))
                 conn.commit()
-                return is_match
-                
+                return created
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+    
+    def _insert_swipes(self, views: List[Tuple[int, int]], likes: List[Tuple[int, int]]) -> bool:
+        """Insert a batch of buffered views and likes in one transaction"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                views = self._add_seen(cursor, views)
+                # Seeing a profile answers its like, whatever the viewer does next
+                answered = self._answer_likes(cursor, [(viewed, viewer) for viewer, viewed in views])
+                self._count_swipes(cursor, views, unread=answered)
+                for from_user_id, to_user_id in likes:
+                    self._insert_like(conn, from_user_id, to_user_id)
+                conn.commit()
+                return True
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return False
     
     def add_viewed_profile(self, viewer_id: int, viewed_id: int) -> bool:
         """Mark a profile as viewed"""
+        if self.swipes:
+            self.swipes.add_view(viewer_id, viewed_id)
+            return True
+        
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR IGNORE INTO viewed_profiles (viewer_id, viewed_id)
-                    VALUES (?, ?)
-                ''', (viewer_id, viewed_id))
+                views = self._add_seen(cursor, [(viewer_id, viewed_id)])
+                answered = self._answer_likes(cursor, [(viewed, viewer) for viewer, viewed in views])
+                self._count_swipes(cursor, views, unread=answered)
                 conn.commit()
                 return True
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return False
     
-    def get_matches(self, user_id: int) -> List[Dict]:
-        """Get all matches for a user"""
+    def count_unread_likes(self, user_id: int) -> int:
+        """Likes the user hasn't answered yet (corrected when their inbox is read)
+
+        Buffered likes are added without waiting for them to be written.
+        Buffered views that answer likes are not subtracted, so the count
+        can be a little high until the next flush.
+        """
+        pending = self.swipes.pending_likes_to(user_id) if self.swipes else 0
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT u.* FROM users u
-                    INNER JOIN matches m ON (
-                        (m.user1_id = ? AND m.user2_id = u.user_id) OR
-                        (m.user2_id = ? AND m.user1_id = u.user_id)
+                cursor.execute('SELECT likes_unread FROM user_stats WHERE user_id = ?', (user_id,))
+                row = cursor.fetchone()
+                return (row[0] if row else 0) + pending
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return 0
+    
+    def get_matches(self, user_id: int, limit: Optional[int] = None,
+                    before: Optional[int] = None, after: Optional[int] = None) -> List[Dict]:
+        """Get matches for a user, newest first, one page at a time
+
+        Each profile carries the ``match_id`` to pass as ``before`` for the
+        next (older) page or ``after`` for the previous one. Both sides of
+        the pair are read from their own (user, epoch, id) index.
+        """
+        order = 'ASC' if after is not None and before is None else 'DESC'
+        side = f'''
+            SELECT * FROM (
+                SELECT m.id AS match_id, u.* FROM matches m
+                INNER JOIN users u ON u.user_id = m.{{other}}_id AND u.epoch = m.epoch{{other_n}}
+                WHERE m.{{me}}_id = ?1 AND m.epoch{{me_n}} = (SELECT epoch FROM users WHERE user_id = ?1)
+                AND m.id > ?2 AND m.id < ?3 AND u.is_active = 1
+                ORDER BY m.id {order} LIMIT ?4
+            )
+        '''
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                # Only matches made at both users' current epochs
+                cursor.execute(f'''
+                    SELECT * FROM (
+                        {side.format(me='user1', me_n=1, other='user2', other_n=2)}
+                        UNION ALL
+                        {side.format(me='user2', me_n=2, other='user1', other_n=1)}
                     )
-                    WHERE u.is_active = 1
-                ''', (user_id, user_id))
+                    ORDER BY match_id {order} LIMIT ?4
+                ''', (
+                    user_id,
+                    0 if after is None else after,
+                    MAX_ROWID if before is None else before,
+                    -1 if limit is None else limit,
+                ))
                 
                 rows = cursor.fetchall()
                 columns = [desc[0] for desc in cursor.description]
-                return [dict(zip(columns, row)) for row in rows]
+                matches = [dict(zip(columns, row)) for row in rows]
+                return matches[::-1] if order == 'ASC' else matches
                 
         except sqlite3.Error as e:
             print(f"Database error: {e}")
@@ -285,10 +1256,12 @@ class Database:
     
     def reset_viewed_profiles(self, user_id: int) -> bool:
         """Reset viewed profiles for a user (useful when no more matches available)"""
+        if self.swipes:
+            self.swipes.discard_views(user_id)
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('DELETE FROM viewed_profiles WHERE viewer_id = ?', (user_id,))
+                cursor.execute('DELETE FROM seen_sets WHERE viewer_id = ?', (user_id,))
                 conn.commit()
                 return True
         except sqlite3.Error as e:
@@ -296,32 +1269,257 @@ class Database:
             return False
 
     def clear_all_user_interactions(self, user_id: int) -> bool:
-        """Clear all interactions for a user - gives them a completely fresh start"""
+        """Clear all interactions for a user - gives them a completely fresh start
+
+        Runs in constant time: the user moves to a new epoch and only their
+        own seen set is deleted. compact_interactions removes the old rows.
+        """
+        if self.swipes:
+            # Buffered swipes would be written at the new epoch
+            self.swipes.discard(user_id)
+        try:
+            with self._connect() as conn:
+                epochs = self._start_epochs(conn.cursor(), [user_id])
+                conn.commit()
+            self._apply_epochs(epochs)
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+
+    def _start_epochs(self, cursor: sqlite3.Cursor, user_ids: List[int]) -> Dict[int, int]:
+        """Move users to a new epoch and drop their seen sets; returns the new epochs"""
+        # A new epoch hides all likes and matches of the user, and their
+        # profile in everyone's seen sets (so others can see them again),
+        # without touching any of those rows
+        cursor.executemany(
+            'UPDATE users SET epoch = epoch + 1 WHERE user_id = ?', [(i,) for i in user_ids]
+        )
+        # Remove all viewed profiles BY the user (so they can see everyone again)
+        cursor.executemany('DELETE FROM seen_sets WHERE viewer_id = ?', [(i,) for i in user_ids])
+        # Likes to the old epoch are gone from the inbox
+        cursor.executemany(
+            'UPDATE user_stats SET likes_unread = 0 WHERE user_id = ?', [(i,) for i in user_ids]
+        )
+        epochs = {}
+        for user_id in user_ids:
+            cursor.execute('SELECT epoch FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            if row:
+                epochs[user_id] = row[0]
+        return epochs
+
+    def _apply_epochs(self, epochs: Dict[int, int]):
+        """Update the profile cache and matching engine once _start_epochs has committed"""
+        for user_id, epoch in epochs.items():
+            self.profiles.invalidate(user_id)
+            if self.engine is not None:
+                self.engine.set_epoch(user_id, epoch)
+
+    def retire_inactive_users(self, days: float, batch_size: int = 1000) -> Tuple[int, bool]:
+        """Clear the interactions of up to ``batch_size`` users deactivated over ``days`` ago
+
+        Their likes, matches and seen sets become dead rows for
+        compact_interactions, as after a fresh start. Returns the number of
+        users retired and whether more are waiting.
+        """
         try:
-            with sqlite3.connect(self.db_name) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                
-                # Remove all likes FROM this user to others
-                cursor.execute('DELETE FROM likes WHERE from_user_id = ?', (user_id,))
-                
-                # Remove all likes TO this user from others
-                cursor.execute('DELETE FROM likes WHERE to_user_id = ?', (user_id,))
-                
-                # Remove all matches involving this user
-                cursor.execute('DELETE FROM matches WHERE user1_id = ? OR user2_id = ?', (user_id, user_id))
-                
-                # Remove all viewed profiles BY this user (so they can see everyone again)
-                cursor.execute('DELETE FROM viewed_profiles WHERE viewer_id = ?', (user_id,))
-                
-                # Remove all viewed profiles OF this user (so others can see them again)
-                cursor.execute('DELETE FROM viewed_profiles WHERE viewed_id = ?', (user_id,))
-                
+                conn.execute('BEGIN IMMEDIATE')
+                cursor.execute('''
+                    SELECT user_id FROM users
+                    WHERE is_active = 0 AND deactivated_at < datetime('now', ?)
+                    LIMIT ?
+                ''', (f'-{days} days', batch_size))
+                user_ids = [row[0] for row in cursor.fetchall()]
+                epochs = self._start_epochs(cursor, user_ids)
+                # Retired once, until the next deactivation
+                cursor.executemany(
+                    'UPDATE users SET deactivated_at = NULL WHERE user_id = ?',
+                    [(i,) for i in user_ids]
+                )
+                conn.commit()
+            self._apply_epochs(epochs)
+            return len(user_ids), len(user_ids) == batch_size
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return 0, False
+
+    def compact_interactions(self, batch_size: int = 1000) -> Tuple[int, bool]:
+        """Delete likes, matches and seen entries hidden by new epochs, a batch at a time
+
+        Each call checks the next ``batch_size`` rows of likes, matches and
+        seen_sets not yet checked in the current pass over them. Every batch
+        is its own short transaction, so swipes are never held up for long.
+        Returns how many rows and seen entries were removed, and whether the
+        pass has more to check (otherwise the next call starts a new pass).
+        """
+        positions = self._compact_position
+        removed = 0
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                for table, users in (
+                    ('likes', (('from_user_id', 'from_epoch'), ('to_user_id', 'to_epoch'))),
+                    ('matches', (('user1_id', 'epoch1'), ('user2_id', 'epoch2'))),
+                ):
+                    if positions[table] is not None:
+                        removed += self._compact_rows(cursor, table, users, batch_size)
+                        conn.commit()
+                if positions['seen_sets'] is not None:
+                    removed += self._compact_seen(conn, batch_size)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return removed, False
+
+        if all(position is None for position in positions.values()):
+            self._compact_position = dict.fromkeys(positions, 0)
+            return removed, False
+        return removed, True
+
+    def _compact_rows(self, cursor: sqlite3.Cursor, table: str,
+                      users: Tuple[Tuple[str, str], ...], batch_size: int) -> int:
+        """Delete the rows of the next id range of a table whose epochs are out of date
+
+        ``users`` names the (user id, epoch) column pairs to check.
+        """
+        position = self._compact_position[table]
+        cursor.execute(f'''
+            SELECT MAX(id), COUNT(*) FROM (
+                SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?
+            )
+        ''', (position, batch_size))
+        last, count = cursor.fetchone()
+        if last is None:
+            self._compact_position[table] = None
+            return 0
+
+        stale = ' OR '.join(
+            f'{epoch} != COALESCE((SELECT epoch FROM users WHERE user_id = {table}.{user}), 0)'
+            for user, epoch in users
+        )
+        cursor.execute(
+            f'DELETE FROM {table} WHERE id > ? AND id <= ? AND ({stale})', (position, last)
+        )
+        # Done for this pass once the end of the table is reached
+        self._compact_position[table] = last if count == batch_size else None
+        return cursor.rowcount
+
+    def _compact_seen(self, conn: sqlite3.Connection, batch_size: int) -> int:
+        """Strip out-of-date keys from the next batch of seen sets"""
+        cursor = conn.cursor()
+        removed = 0
+        # Lock before reading, so a swipe flush can't update a set in between
+        conn.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT viewer_id, ids FROM seen_sets
+            WHERE viewer_id > ? ORDER BY viewer_id LIMIT ?
+        ''', (self._compact_position['seen_sets'], batch_size))
+        rows = [(viewer_id, SeenSet.from_bytes(ids)) for viewer_id, ids in cursor.fetchall()]
+        
+        # Only the epochs of users in this batch, so a step costs the same
+        # however many users there are
+        ids = list({key >> EPOCH_BITS for _, seen in rows for key in seen})
+        epochs = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(
+                f'SELECT user_id, epoch FROM users WHERE user_id IN ({placeholders})', chunk
+            )
+            epochs.update(cursor.fetchall())
+        
+        for viewer_id, seen in rows:
+            stale = [
+                key for key in seen
+                if key & EPOCH_MASK != epochs.get(key >> EPOCH_BITS, 0) & EPOCH_MASK
+            ]
+            if stale:
+                self._store_seen(cursor, viewer_id, seen.difference(stale))
+                removed += len(stale)
+        conn.commit()
+        self._compact_position['seen_sets'] = rows[-1][0] if len(rows) == batch_size else None
+        return removed
+
+    def prune_profile_changes(self, keep: int, batch_size: int = 1000) -> Tuple[int, bool]:
+        """Delete the oldest profile change log entries beyond the newest ``keep``
+
+        Workers that fall further behind reload their matching engine.
+        Returns the number deleted and whether more are waiting.
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM profile_changes WHERE seq IN (
+                        SELECT seq FROM profile_changes
+                        WHERE seq <= (SELECT MAX(seq) FROM profile_changes) - ?
+                        ORDER BY seq LIMIT ?
+                    )
+                ''', (keep, batch_size))
+                conn.commit()
+                return cursor.rowcount, cursor.rowcount == batch_size
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return 0, False
+
+    def incremental_vacuum(self, pages: int = 256) -> Tuple[int, bool]:
+        """Return up to ``pages`` free pages to the file system
+
+        Only works on databases created with auto_vacuum = INCREMENTAL (see
+        ConnectionPool). Returns the pages freed and whether any are left.
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('PRAGMA auto_vacuum')
+                if cursor.fetchone()[0] != 2:
+                    return 0, False
+                cursor.execute('PRAGMA freelist_count')
+                before = cursor.fetchone()[0]
+                if not before:
+                    return 0, False
+                # execute() would step the pragma only once, freeing a single page
+                conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+                cursor.execute('PRAGMA freelist_count')
+                after = cursor.fetchone()[0]
+                return before - after, after > 0
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return 0, False
+
+    def analyze(self, table: str, analysis_limit: int = 1000) -> bool:
+        """Refresh the query planner statistics of one table
+
+        ``analysis_limit`` caps the index entries sampled, which keeps this
+        quick on big tables.
+        """
+        try:
+            with self._connect() as conn:
+                conn.execute(f'PRAGMA analysis_limit = {int(analysis_limit)}')
+                conn.execute(f'ANALYZE {table}')
                 conn.commit()
                 return True
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return False
 
+    def checkpoint_wal(self) -> int:
+        """Copy WAL frames into the database without waiting for readers or writers
+
+        Returns the number of frames checkpointed.
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('PRAGMA wal_checkpoint(PASSIVE)')
+                busy, log_frames, checkpointed = cursor.fetchone()
+                return max(checkpointed, 0)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return 0
+
     def give_user_fresh_start(self, user_id: int) -> bool:
         """Give user a completely fresh start - clear interactions and activate"""
         try:
@@ -0,0 +1,119 @@
+import asyncio
+import json
+from typing import Dict, List, Optional, Sequence
+
+from sharding import HashRing
+from webhook import SECRET_HEADER
+
+
+class WorkerLink:
+    """Keep-alive HTTP connection to one worker's webhook server"""
+
+    def __init__(self, host: str, port: int, path: str = "/telegram",
+                 secret_token: Optional[str] = None, timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # One request at a time keeps a user's updates in order
+        self._lock = asyncio.Lock()
+
+    async def post(self, body: bytes) -> int:
+        """POST an update and return the worker's HTTP status"""
+        async with self._lock:
+            # A kept-alive connection may have been closed by the worker; reconnect once
+            for attempt in range(2):
+                try:
+                    return await asyncio.wait_for(self._post(body), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    self.close()
+                    if attempt:
+                        raise
+                except asyncio.TimeoutError:
+                    self.close()
+                    raise
+
+    async def _post(self, body: bytes) -> int:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+        secret = f"{SECRET_HEADER}: {self.secret_token}\r\n" if self.secret_token else ""
+        self._writer.write(
+            f"POST {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"{secret}\r\n".encode("latin-1") + body
+        )
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("worker closed the connection")
+        status = int(status_line.split()[1])
+        length = 0
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        if length:
+            await self._reader.readexactly(length)
+        return status
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+def update_user_id(data: Dict) -> Optional[int]:
+    """Id of the user an update comes from (or its chat), for routing"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            sender = value.get(field)
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return None
+
+
+class Dispatcher:
+    """Webhook handler that forwards each update to the worker owning its user
+
+    Users are assigned to workers by consistent hashing of the user id, so
+    a user's conversation always runs in the same process. Updates without
+    a user are spread by update_id. If a worker can't be reached the update
+    is answered 502, and Telegram delivers it again later.
+    """
+
+    def __init__(self, workers: Sequence[WorkerLink]):
+        self.workers: List[WorkerLink] = list(workers)
+        self.ring = HashRing(range(len(self.workers)))
+        self.forwarded = [0] * len(self.workers)
+        self.failed = 0
+
+    def worker_for(self, data: Dict) -> int:
+        user_id = update_user_id(data)
+        return self.ring.node_for(user_id if user_id is not None else data.get("update_id", 0))
+
+    async def __call__(self, data: Dict) -> Optional[int]:
+        index = self.worker_for(data)
+        try:
+            status = await self.workers[index].post(json.dumps(data).encode())
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError) as e:
+            print(f"Couldn't forward update to worker {index}: {e}")
+            self.failed += 1
+            return 502
+        self.forwarded[index] += 1
+        return status
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
@@ -0,0 +1,237 @@
+import random
+import threading
+from itertools import repeat
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for MATCH_ENGINE=numpy
+    np = None
+
+from geo import EARTH_RADIUS_KM, SearchArea
+from seenset import EPOCH_BITS, EPOCH_MASK
+
+GENDER_CODES = {"Male": 0, "Female": 1}
+LOOKING_CODES = {"Male": 0, "Female": 1, "Doesn't matter": 2}
+ANY_CODE = LOOKING_CODES["Doesn't matter"]
+
+# (column, dtype) for every per-profile array in a block
+_COLUMNS = (
+    ("user_id", "int64"),
+    ("age", "int16"),
+    ("looking_gender", "int8"),
+    ("looking_age_min", "int16"),
+    ("looking_age_max", "int16"),
+    ("is_active", "bool"),
+    ("epoch", "int64"),
+    ("latitude", "float64"),
+    ("longitude", "float64"),
+)
+
+
+class _Block:
+    """Columnar arrays for the profiles of one (cell, gender)
+
+    Rows ``[0, sorted_size)`` are ordered by age so an age range is a binary
+    search; newer rows are appended unsorted after them until the next
+    ``rebuild``.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.size = 0
+        self.sorted_size = 0
+        self.dead = 0
+        self.columns = {name: np.zeros(capacity, dtype) for name, dtype in _COLUMNS}
+
+    def append(self, values: Dict) -> int:
+        if self.size == len(self.columns["user_id"]):
+            for name, column in self.columns.items():
+                self.columns[name] = np.resize(column, len(column) * 2)
+        row = self.size
+        for name, value in values.items():
+            self.columns[name][row] = value
+        self.size += 1
+        return row
+
+    def view(self, name: str, start: int = 0, stop: Optional[int] = None):
+        return self.columns[name][start:self.size if stop is None else stop]
+
+    def needs_rebuild(self) -> bool:
+        unsorted = self.size - self.sorted_size
+        return unsorted > max(256, self.sorted_size // 8) or self.dead * 2 > self.size
+
+    def rebuild(self) -> "_Block":
+        """Copy without replaced rows, fully sorted by age"""
+        keep = np.flatnonzero(self.view("user_id") >= 0)
+        order = keep[np.argsort(self.view("age")[keep], kind="stable")]
+        fresh = _Block(max(64, len(order) * 2))
+        for name in self.columns:
+            fresh.columns[name][:len(order)] = self.view(name)[order]
+        fresh.size = fresh.sorted_size = len(order)
+        return fresh
+
+
+class MatchingEngine:
+    """In-memory columnar index of profiles for candidate selection
+
+    Profiles are grouped into blocks of NumPy arrays per (cell, gender), so a
+    query only reads the blocks of the cells around the viewer and wanted
+    genders, and within them only the viewer's age range. The rest of the
+    filtering is a few vectorized comparisons (active, within the search
+    radius, and whether the candidate's own preferences accept the viewer).
+    A random sample is drawn from the result and seen ids are removed from
+    it by binary search in the sorted seen set. Database keeps it in sync
+    from save_user, activate_user, deactivate_user and fresh starts (epochs).
+
+    Experimental and off by default: every query filters the viewer's whole
+    age range, which costs more than the SQL walk's few index entries
+    (scripts/bench_swipes.py --engine).
+    """
+
+    def __init__(self, seed: Optional[int] = None):
+        if np is None:
+            raise RuntimeError("numpy is required for the in-memory matching engine")
+        self._blocks: Dict[Tuple[str, int], _Block] = {}
+        # user_id -> ((cell, gender), row)
+        self._rows: Dict[int, Tuple[Tuple[str, int], int]] = {}
+        self._lock = threading.Lock()
+        self._rng = np.random.default_rng(seed if seed is not None else random.getrandbits(32))
+
+    def load(self, users: Iterable[Dict]):
+        """Bulk-load profiles (rows from the users table)"""
+        for user in users:
+            self.upsert(user)
+        with self._lock:
+            for key in list(self._blocks):
+                self._rebuild(key)
+
+    def upsert(self, user: Dict):
+        """Add or replace a profile"""
+        key = (user["cell"], GENDER_CODES.get(user["gender"], -1))
+        values = {
+            "user_id": user["user_id"],
+            "age": user["age"],
+            "looking_gender": LOOKING_CODES.get(user["looking_gender"], -1),
+            "looking_age_min": user["looking_age_min"],
+            "looking_age_max": user["looking_age_max"],
+            "is_active": bool(user.get("is_active", 1)),
+            "epoch": user.get("epoch", 0),
+            "latitude": np.nan if user.get("latitude") is None else user["latitude"],
+            "longitude": np.nan if user.get("longitude") is None else user["longitude"],
+        }
+        with self._lock:
+            self._remove(user["user_id"])
+            block = self._blocks.get(key)
+            if block is None:
+                block = self._blocks[key] = _Block()
+            self._rows[user["user_id"]] = (key, block.append(values))
+
+    def set_active(self, user_id: int, active: bool):
+        with self._lock:
+            location = self._rows.get(user_id)
+            if location:
+                key, row = location
+                self._blocks[key].columns["is_active"][row] = active
+
+    def set_epoch(self, user_id: int, epoch: int):
+        with self._lock:
+            location = self._rows.get(user_id)
+            if location:
+                key, row = location
+                self._blocks[key].columns["epoch"][row] = epoch
+
+    def _remove(self, user_id: int):
+        location = self._rows.pop(user_id, None)
+        if location is None:
+            return
+        key, row = location
+        block = self._blocks[key]
+        block.columns["is_active"][row] = False
+        block.columns["user_id"][row] = -1
+        block.dead += 1
+
+    def _rebuild(self, key: Tuple[str, int]):
+        block = self._blocks[key] = self._blocks[key].rebuild()
+        ids = block.view("user_id").tolist()
+        self._rows.update(zip(ids, zip(repeat(key), range(len(ids)))))
+
+    def candidates(self, viewer: Dict, area: SearchArea, limit: int, seen: Iterable[int],
+                   liked: Iterable[int], exclude: Iterable[int] = ()) -> List[int]:
+        """Random sample of up to ``limit`` ids of matching, unseen profiles in ``area``
+
+        ``seen`` must be sorted seen keys (SeenSet.ids); ``liked`` and
+        ``exclude`` are plain user ids and need not be sorted.
+        """
+        looking = LOOKING_CODES.get(viewer["looking_gender"], -1)
+        genders = (0, 1) if looking == ANY_CODE else (looking,)
+        gender = GENDER_CODES.get(viewer["gender"], -1)
+        age = viewer["age"]
+        found = []
+        epochs = []
+
+        with self._lock:
+            for key in ((cell, code) for cell in area.cells for code in genders):
+                if key not in self._blocks:
+                    continue
+                if self._blocks[key].needs_rebuild():
+                    self._rebuild(key)
+                block = self._blocks[key]
+
+                lo, hi = np.searchsorted(
+                    block.view("age", 0, block.sorted_size),
+                    [viewer["looking_age_min"], viewer["looking_age_max"] + 1],
+                )
+                for start, stop in ((lo, hi), (block.sorted_size, block.size)):
+                    ages = block.view("age", start, stop)
+                    wanted = block.view("looking_gender", start, stop)
+                    mask = block.view("is_active", start, stop).copy()
+                    mask &= (ages >= viewer["looking_age_min"]) & (ages <= viewer["looking_age_max"])
+                    # Reciprocity: the candidate has to be looking for someone like the viewer
+                    mask &= (wanted == gender) | (wanted == ANY_CODE)
+                    mask &= block.view("looking_age_min", start, stop) <= age
+                    mask &= block.view("looking_age_max", start, stop) >= age
+                    if area.box is not None:
+                        mask &= self._within(area, block.view("latitude", start, stop),
+                                             block.view("longitude", start, stop))
+                    found.append(block.view("user_id", start, stop)[mask])
+                    epochs.append(block.view("epoch", start, stop)[mask])
+
+        if not found:
+            return []
+        ids = np.concatenate(found)
+        keys = (ids << EPOCH_BITS) | (np.concatenate(epochs) & EPOCH_MASK)
+        seen = np.asarray(seen, dtype=np.int64)  # sorted, as kept by SeenSet
+        skip = np.fromiter([*liked, *exclude, viewer["user_id"]], dtype=np.int64)
+
+        # Draw a random sample first and drop skipped ids from it, growing the
+        # sample only if too many of the drawn profiles were already seen
+        size = min(len(ids), limit * 2 + 16)
+        while True:
+            rows = self._rng.choice(len(ids), size=size, replace=False)
+            picked = ids[rows]
+            if len(seen):
+                picked_keys = keys[rows]
+                positions = np.minimum(np.searchsorted(seen, picked_keys), len(seen) - 1)
+                picked = picked[seen[positions] != picked_keys]
+            picked = picked[~np.isin(picked, skip)]
+            if len(picked) >= limit or size == len(ids):
+                return picked[:limit].tolist()
+            size = min(len(ids), size * 4)
+
+    @staticmethod
+    def _within(area: SearchArea, latitude, longitude):
+        """Mask of the points inside the area's circle (haversine, vectorized)"""
+        lat_min, lat_max, lon_min, lon_max = area.box
+        mask = (latitude >= lat_min) & (latitude <= lat_max)
+        mask &= (longitude >= lon_min) & (longitude <= lon_max)
+        phi1 = np.radians(area.latitude)
+        phi2 = np.radians(latitude[mask])
+        a = (np.sin((phi2 - phi1) / 2) ** 2
+             + np.cos(phi1) * np.cos(phi2)
+             * np.sin(np.radians(longitude[mask] - area.longitude) / 2) ** 2)
+        distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        mask[mask] = distance <= area.radius_km
+        return mask
+
+    def __len__(self) -> int:
+        return len(self._rows)
@@ -0,0 +1,228 @@
+import csv
+import functools
+import math
+import os
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Geohash length of the cell stored with each located profile. Cells of
+# length 3 are 1.4 degrees high (156 km) and 1.4 degrees wide at the
+# equator (90 km at 55N), so a search radius of tens of km touches 1-6 of
+# them. Longer cells would mean more index slices per query; shorter ones
+# more rows outside the circle in each slice.
+CELL_PRECISION = 3
+
+# Cell of profiles without coordinates; only the same city matches them
+CITY_CELL_PREFIX = "city:"
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.csv")
+
+# (lat_min, lat_max, lon_min, lon_max) in degrees
+Box = Tuple[float, float, float, float]
+
+
+def normalize_city(city: str) -> str:
+    """Key used to compare cities (case and surrounding whitespace ignored)"""
+    return city.strip().lower()
+
+
+def encode(latitude: float, longitude: float, precision: int = CELL_PRECISION) -> str:
+    """Geohash of a point"""
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    chars = []
+    value = bits = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if longitude >= mid:
+                value, lon_lo = value * 2 + 1, mid
+            else:
+                value, lon_hi = value * 2, mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if latitude >= mid:
+                value, lat_lo = value * 2 + 1, mid
+            else:
+                value, lat_hi = value * 2, mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            value = bits = 0
+    return "".join(chars)
+
+
+def cell_size(precision: int = CELL_PRECISION) -> Tuple[float, float]:
+    """Height and width of a geohash cell, in degrees"""
+    lat_bits = 5 * precision // 2
+    lon_bits = 5 * precision - lat_bits
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance (haversine)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude: float, longitude: float, radius_km: float) -> Box:
+    """Smallest lat/lon box around a circle
+
+    Circles that reach a pole or cross the antimeridian get the full
+    longitude range.
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    lat_min, lat_max = latitude - dlat, latitude + dlat
+    if lat_min <= -90 or lat_max >= 90:
+        return max(lat_min, -90.0), min(lat_max, 90.0), -180.0, 180.0
+    angle = min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(latitude)))
+    dlon = math.degrees(math.asin(angle))
+    lon_min, lon_max = longitude - dlon, longitude + dlon
+    if lon_min < -180 or lon_max > 180:
+        return lat_min, lat_max, -180.0, 180.0
+    return lat_min, lat_max, lon_min, lon_max
+
+
+@functools.lru_cache(maxsize=65536)
+def cover(latitude: float, longitude: float, radius_km: float,
+          precision: int = CELL_PRECISION) -> Tuple[str, ...]:
+    """Geohash cells that overlap a circle (cached: most users share their city's point)"""
+    lat_min, lat_max, lon_min, lon_max = bounding_box(latitude, longitude, radius_km)
+    height, width = cell_size(precision)
+    rows = range(int((lat_min + 90) // height), int((min(lat_max, 89.999999) + 90) // height) + 1)
+    columns = range(int((lon_min + 180) // width), int((min(lon_max, 179.999999) + 180) // width) + 1)
+    cells = []
+    for row in rows:
+        cell_lat = -90 + (row + 0.5) * height
+        near_lat = min(max(latitude, cell_lat - height / 2), cell_lat + height / 2)
+        for column in columns:
+            cell_lon = -180 + (column + 0.5) * width
+            # Closest point of the cell, going around the antimeridian if shorter
+            dlon = (longitude - cell_lon + 180) % 360 - 180
+            near_lon = cell_lon + min(max(dlon, -width / 2), width / 2)
+            # The clamped point is close to, not exactly, the nearest one on the sphere
+            if distance_km(latitude, longitude, near_lat, near_lon) <= radius_km * 1.01 + 1:
+                cells.append(encode(cell_lat, cell_lon, precision))
+    return tuple(cells)
+
+
+def area_cell(city_key: str, latitude: Optional[float], longitude: Optional[float]) -> str:
+    """Index cell of a profile: its geohash cell, or its city if it has no location"""
+    if latitude is None or longitude is None:
+        return CITY_CELL_PREFIX + city_key
+    return encode(latitude, longitude)
+
+
+class SearchArea:
+    """Where a viewer's candidates are: index cells, and the circle around the viewer
+
+    Profiles without a location only search (and are found in) their own
+    city, and have no circle.
+    """
+
+    __slots__ = ("cells", "latitude", "longitude", "radius_km", "box")
+
+    def __init__(self, cells: Sequence[str], latitude: Optional[float] = None,
+                 longitude: Optional[float] = None, radius_km: float = 0.0):
+        self.cells = cells
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius_km = radius_km
+        self.box: Optional[Box] = None
+        if latitude is not None:
+            self.box = bounding_box(latitude, longitude, radius_km)
+
+    def contains(self, latitude: Optional[float], longitude: Optional[float]) -> bool:
+        """Whether a profile found in one of the cells is within the radius"""
+        if self.box is None:
+            return True
+        if latitude is None or longitude is None:
+            return False
+        return distance_km(self.latitude, self.longitude, latitude, longitude) <= self.radius_km
+
+
+def search_area(user: Dict, radius_km: float) -> SearchArea:
+    latitude, longitude = user.get("latitude"), user.get("longitude")
+    if latitude is None or longitude is None:
+        return SearchArea((area_cell(user["city_key"], None, None),))
+    return SearchArea(cover(latitude, longitude, radius_km), latitude, longitude, radius_km)
+
+
+class Place:
+    """Gazetteer entry"""
+
+    __slots__ = ("name", "country", "latitude", "longitude")
+
+    def __init__(self, name: str, country: str, latitude: float, longitude: float):
+        self.name = name
+        self.country = country
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class Gazetteer:
+    """Offline city lookup by name or alias, and nearest city to a point
+
+    Reads a CSV with name, country, latitude, longitude and ``|``-separated
+    aliases (src/data/cities.csv by default).
+    """
+
+    def __init__(self, path: str = GAZETTEER_PATH):
+        self.places: List[Place] = []
+        self._by_name: Dict[str, Place] = {}
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                place = Place(row["name"], row["country"],
+                              float(row["latitude"]), float(row["longitude"]))
+                self.places.append(place)
+                for name in (row["name"], *filter(None, row["aliases"].split("|"))):
+                    # The first place listed under a name wins
+                    self._by_name.setdefault(self._key(name), place)
+
+    @staticmethod
+    def _key(name: str) -> str:
+        return " ".join(normalize_city(name).replace(".", " ").split())
+
+    def lookup(self, name: str) -> Optional[Place]:
+        return self._by_name.get(self._key(name))
+
+    def nearest(self, latitude: float, longitude: float,
+                max_km: float = float("inf")) -> Optional[Place]:
+        """Closest place within ``max_km``, if any"""
+        best, best_km = None, max_km
+        for place in self.places:
+            km = distance_km(latitude, longitude, place.latitude, place.longitude)
+            if km <= best_km:
+                best, best_km = place, km
+        return best
+
+    def __iter__(self) -> Iterator[Place]:
+        return iter(self.places)
+
+    def __len__(self) -> int:
+        return len(self.places)
+
+
+@functools.lru_cache(maxsize=None)
+def gazetteer() -> Gazetteer:
+    """The bundled gazetteer, loaded on first use"""
+    return Gazetteer()
+
+
+def locate(user: Dict) -> Tuple[Optional[float], Optional[float]]:
+    """Coordinates of a profile: the shared location, or its city from the gazetteer"""
+    if user.get("latitude") is not None and user.get("longitude") is not None:
+        return float(user["latitude"]), float(user["longitude"])
+    place = gazetteer().lookup(user["city"])
+    if place is None:
+        return None, None
+    return place.latitude, place.longitude
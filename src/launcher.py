@@ -0,0 +1,114 @@
+"""Run several bot workers behind one webhook endpoint.
+
+The launcher listens on SOULMATE_WEBHOOK_HOST/PORT/PATH like a single bot in
+webhook mode, and starts SOULMATE_WORKERS copies of main.py on local ports
+from SOULMATE_WORKER_BASE_PORT. Every update is forwarded to the worker that
+owns its user (consistent hashing of the user id), so each user's
+conversation stays in one process. Workers that exit are restarted.
+
+Workers share the SQLite database. They write likes through instead of
+buffering them, so mutual likes handled by different workers still make
+exactly one match. Conversation states and registration drafts are kept in
+SQLite, so they survive restarts and changes in the number of workers.
+
+    SOULMATE_WORKERS=4 SOULMATE_WEBHOOK_URL=https://bot.example.com/telegram \\
+        SOULMATE_WEBHOOK_SECRET=change-me python launcher.py
+"""
+import asyncio
+import os
+import secrets
+import signal
+import sys
+
+from telegram import Bot, Update
+
+import settings
+from config import TELEGRAM_BOT_TOKEN
+from dispatcher import Dispatcher, WorkerLink
+from webhook import WebhookServer
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def worker_env(port: int, secret: str, maintenance: bool) -> dict:
+    env = dict(os.environ)
+    env.update(
+        SOULMATE_MODE="webhook",
+        SOULMATE_WEBHOOK_HOST="127.0.0.1",
+        SOULMATE_WEBHOOK_PORT=str(port),
+        SOULMATE_WEBHOOK_PATH="/telegram",
+        SOULMATE_WEBHOOK_SECRET=secret,
+        # The launcher owns the public webhook
+        SOULMATE_WEBHOOK_URL="",
+        SOULMATE_WORKERS=str(settings.WORKERS),
+        # Database upkeep runs in one worker
+        SOULMATE_MAINTENANCE="1" if maintenance and settings.MAINTENANCE else "0",
+    )
+    env.setdefault("SOULMATE_STATE_BACKEND", "sqlite")
+    return env
+
+
+async def supervise(index: int, port: int, secret: str, stopping: asyncio.Event,
+                    processes: dict):
+    """Keep one worker process running until the launcher stops"""
+    while not stopping.is_set():
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, MAIN, env=worker_env(port, secret, index == 0),
+            cwd=os.path.dirname(MAIN),
+        )
+        processes[index] = process
+        code = await process.wait()
+        if not stopping.is_set():
+            print(f"Worker {index} exited with {code}, restarting")
+            await asyncio.sleep(1)
+
+
+async def run():
+    secret = secrets.token_urlsafe(32)
+    ports = [settings.WORKER_BASE_PORT + i for i in range(settings.WORKERS)]
+    dispatcher = Dispatcher(
+        [WorkerLink("127.0.0.1", port, "/telegram", secret) for port in ports]
+    )
+    server = WebhookServer(
+        dispatcher,
+        host=settings.WEBHOOK_HOST,
+        port=settings.WEBHOOK_PORT,
+        path=settings.WEBHOOK_PATH,
+        secret_token=settings.WEBHOOK_SECRET or None,
+    )
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    processes = {}
+    supervisors = [
+        asyncio.create_task(supervise(i, port, secret, stopping, processes))
+        for i, port in enumerate(ports)
+    ]
+
+    if settings.WEBHOOK_URL:
+        async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+            await bot.set_webhook(
+                settings.WEBHOOK_URL,
+                secret_token=settings.WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+    await server.start()
+    print(f"Dispatching updates from {server.host}:{server.port}{server.path} "
+          f"to {len(ports)} workers")
+
+    await stopping.wait()
+
+    # Updates that can't be forwarded any more are answered 502 and resent by Telegram
+    await server.stop()
+    dispatcher.close()
+    for process in processes.values():
+        if process.returncode is None:
+            process.terminate()
+    await asyncio.gather(*supervisors)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
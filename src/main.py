@@ -1,9 +1,31 @@
-from telegram import ReplyKeyboardMarkup, Update
-from telegram.ext import (ApplicationBuilder, CommandHandler, ContextTypes,
-                          ConversationHandler, MessageHandler, filters)
-
+import asyncio
+import json
+import signal
+
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton,
+                      ReplyKeyboardMarkup, Update)
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import (ApplicationBuilder, CallbackQueryHandler, CommandHandler,
+                          ContextTypes, ConversationHandler, MessageHandler, TypeHandler,
+                          filters)
+
+import settings
+from async_db import AsyncDatabase
+from cache import TTLCache
+from candidates import CandidateQueue
+from cards import preview_caption, profile_caption, send_card
 from config import TELEGRAM_BOT_TOKEN
 from db import Database
+from engine import MatchingEngine
+from geo import gazetteer
+from maintenance import Maintenance, MaintenanceJob, database_jobs, single_step
+from outbox import BACKGROUND, Outbox
+from persistence import SqlitePersistence
+from pg_storage import PostgresStorage
+from ranking import Ranker
+from state import AsyncStateStore, MemoryBackend, RegistrationDraft, SqliteBackend, StateStore
+from updates import UserOrderedProcessor
+from webhook import WebhookServer
 
 BOT_TOKEN = TELEGRAM_BOT_TOKEN
 
@@ -28,30 +50,164 @@ BOT_TOKEN = TELEGRAM_BOT_TOKEN
 GENDER_OPTIONS = [["Male", "Female"]]
 LOOKING_FOR_OPTIONS = [["Male", "Female", "Doesn't matter"]]
 CANCEL_REGISTRATION = [["Cancel"]]
+CITY_OPTIONS = [[KeyboardButton("📍 Share location", request_location=True)], ["Cancel"]]
 START = [["Start"]]
 CONFIRM_REGISTRATION = [["Start searching", "Edit profile"]]
 BROWSING_OPTIONS = [["❤️ Like", "❌ Skip", "⚙️ Menu"]]
-MAIN_MENU = [["Continue searching"], ["Edit profile"], ["Deactivate account"]]
+MAIN_MENU = [["Continue searching"], ["My matches"], ["Edit profile"], ["Deactivate account"]]
 CONTINUE_SEARCHING = [["Continue searching"]]
 INACTIVE_MENU = [["Activate account", "Edit profile"]]
 
-db = Database()
-user_data = {}
-current_profiles = {}
+
+def build_engine():
+    """In-memory matching engine if configured and available, else SQL matching"""
+    if settings.MATCH_ENGINE != "numpy":
+        return None
+    try:
+        return MatchingEngine()
+    except RuntimeError as e:
+        print(f"{e}, falling back to SQL matching")
+        return None
+
+
+async def prepare_card(profile):
+    """Render a candidate's card ahead of time and optionally check its photo"""
+    card = dict(profile, caption=profile_caption(profile, browse_footer(profile)), photo_ok=True)
+    if settings.PREFETCH_CHECK_PHOTOS and card["photo"]:
+        try:
+            await outbox.bot.get_file(card["photo"])
+        except BadRequest:
+            card["photo_ok"] = False
+        except TelegramError:
+            pass
+    return card
+
+
+def build_ranker():
+    """Candidate ranking, unless RANK_POOL keeps the random order"""
+    if settings.RANK_POOL <= 1:
+        return None
+    return Ranker(
+        pool=settings.RANK_POOL,
+        activity=settings.RANK_WEIGHT_ACTIVITY,
+        like_back=settings.RANK_WEIGHT_LIKE_BACK,
+        exposure=settings.RANK_WEIGHT_EXPOSURE,
+        jitter=settings.RANK_WEIGHT_RANDOM,
+        half_life=settings.RANK_ACTIVITY_HALF_LIFE_HOURS * 3600,
+        exposure_scale=settings.RANK_EXPOSURE_SCALE,
+    )
+
+
+def build_storage():
+    """PostgreSQL storage if configured, else SQLite"""
+    if settings.STORAGE == "postgres":
+        return PostgresStorage(
+            settings.POSTGRES_DSN,
+            schema=settings.POSTGRES_SCHEMA or None,
+            min_size=settings.POSTGRES_POOL_MIN,
+            max_size=settings.POSTGRES_POOL_MAX,
+            profile_cache_size=settings.PROFILE_CACHE_SIZE,
+            profile_cache_ttl=settings.PROFILE_CACHE_TTL,
+            radius_km=settings.GEO_RADIUS_KM,
+            ranker=build_ranker(),
+        )
+    return AsyncDatabase(
+        Database(
+            settings.DB_NAME,
+            write_behind=settings.WRITE_BEHIND,
+            flush_interval=settings.FLUSH_INTERVAL_MS / 1000,
+            flush_batch=settings.FLUSH_BATCH,
+            profile_cache_size=settings.PROFILE_CACHE_SIZE,
+            profile_cache_ttl=settings.PROFILE_CACHE_TTL,
+            engine=build_engine(),
+            buffer_likes=settings.BUFFER_LIKES,
+            radius_km=settings.GEO_RADIUS_KM,
+            ranker=build_ranker(),
+        ),
+        max_workers=settings.DB_WORKERS,
+    )
+
+
+db = build_storage()
+candidates = CandidateQueue(
+    db,
+    batch_size=settings.CANDIDATE_BATCH,
+    low_water=settings.CANDIDATE_LOW_WATER,
+    store=StateStore(
+        MemoryBackend(),
+        idle_timeout=settings.STATE_IDLE_TIMEOUT,
+        max_entries=settings.STATE_MAX_ENTRIES,
+    ),
+    prepare=prepare_card,
+    recheck_after=settings.CANDIDATE_RECHECK,
+)
+drafts = AsyncStateStore(StateStore(
+    SqliteBackend(settings.DB_NAME) if settings.STATE_BACKEND == "sqlite" else MemoryBackend(),
+    idle_timeout=settings.STATE_IDLE_TIMEOUT,
+    max_entries=settings.STATE_MAX_ENTRIES,
+))
+
+outbox = Outbox(
+    global_rate=settings.OUTBOX_GLOBAL_RATE,
+    chat_rate=settings.OUTBOX_CHAT_RATE,
+    chat_burst=settings.OUTBOX_CHAT_BURST,
+    max_queued=settings.OUTBOX_MAX_QUEUED,
+)
+
+# Telegram @usernames by user id ('' for none), as last stored with the profile
+usernames = TTLCache(settings.USERNAME_CACHE_SIZE, settings.USERNAME_CACHE_TTL)
+
+
+async def remember_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Store the sender's @username with their profile when it changes (runs on every update)"""
+    user = update.effective_user
+    if user is None or user.is_bot:
+        return
+    username = user.username or ""
+    if usernames.get(user.id) == username:
+        return
+    profile = await db.get_user(user.id)
+    if profile is None:
+        # Registration stores it with the new profile
+        return
+    if profile["username"] != username:
+        await db.set_username(user.id, username)
+    usernames.set(user.id, username)
+
+
+async def reply(update: Update, text: str, reply_markup=None):
+    """Queue a message to the chat the update came from"""
+    await outbox.send_message(update.effective_chat.id, text, reply_markup=reply_markup)
+
+
+async def save_answer(user_id: int, field: str, value):
+    """Store one registration answer in the user's draft"""
+    draft = await drafts.get(user_id) or RegistrationDraft()
+    setattr(draft, field, value)
+    await drafts.put(user_id, draft)
+
+
+async def save_location(user_id: int, city: str, latitude, longitude):
+    """Store the city answer and its coordinates (None if unknown) in the user's draft"""
+    draft = await drafts.get(user_id) or RegistrationDraft()
+    draft.city, draft.latitude, draft.longitude = city, latitude, longitude
+    await drafts.put(user_id, draft)
+
 
 # Registration
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    if db.user_exists(user_id):
-        user_profile = db.get_user(user_id)
+    user_profile = await db.get_user(user_id)
+    if user_profile:
         if user_profile["is_active"]:
             return await show_main_menu(update, context)
         else:
             return await show_inactive_menu(update, context)
         
     reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
-    await update.message.reply_text(
+    await reply(
+        update,
         "Hi! Let's find your soulmate! What's your name?", reply_markup=reply_markup
     )
     return ASK_NAME
@@ -64,10 +220,9 @@ async def ask_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if name == "Cancel":
         return await cancel(update, context)
 
-    user_data[user_id] = {}
-    user_data[user_id]["name"] = update.message.text
+    await drafts.put(user_id, RegistrationDraft(name=name))
     reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
-    await update.message.reply_text("How old are you?", reply_markup=reply_markup)
+    await reply(update, "How old are you?", reply_markup=reply_markup)
     return ASK_AGE
 
 
@@ -80,30 +235,44 @@ async def ask_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         age = int(update.message.text)
         if age < 18:
-            await update.message.reply_text("You must be at least 18 years old.")
+            await reply(update, "You must be at least 18 years old.")
             return ASK_AGE
         if age > 120:
-            await update.message.reply_text("Enter your real age.")
+            await reply(update, "Enter your real age.")
             return ASK_AGE
-        user_data[user_id]["age"] = age
-        reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
-        await update.message.reply_text(
-            "What city are you in?", reply_markup=reply_markup
+        await save_answer(user_id, "age", age)
+        reply_markup = ReplyKeyboardMarkup(CITY_OPTIONS, resize_keyboard=True)
+        await reply(
+            update,
+            "What city are you in? You can also share your location.", reply_markup=reply_markup
         )
         return ASK_CITY
 
     except ValueError:
-        await update.message.reply_text("Please input only numbers.")
+        await reply(update, "Please input only numbers.")
         return ASK_AGE
 
 
 async def ask_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    if update.message.text == "Cancel":
-        return await cancel(update, context)
+    location = update.message.location
 
-    user_data[user_id]["city"] = update.message.text
+    if location:
+        # Shown as the nearest known city, matched by the exact point
+        place = gazetteer().nearest(
+            location.latitude, location.longitude, max_km=settings.GEO_RADIUS_KM
+        )
+        city = place.name if place else f"{location.latitude:.2f}, {location.longitude:.2f}"
+        await save_location(user_id, city, location.latitude, location.longitude)
+    elif update.message.text == "Cancel":
+        return await cancel(update, context)
+    else:
+        place = gazetteer().lookup(update.message.text)
+        if place:
+            await save_location(user_id, place.name, place.latitude, place.longitude)
+        else:
+            await save_location(user_id, update.message.text, None, None)
 
     gender_with_cancel = GENDER_OPTIONS.copy()
     gender_with_cancel.append(["Cancel"])
@@ -111,7 +280,8 @@ async def ask_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
         gender_with_cancel, one_time_keyboard=True, resize_keyboard=True
     )
 
-    await update.message.reply_text(
+    await reply(
+        update,
         "Please, specify your gender:", reply_markup=reply_markup
     )
     return ASK_GENDER
@@ -130,12 +300,13 @@ async def ask_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = ReplyKeyboardMarkup(
             gender_with_cancel, one_time_keyboard=True, resize_keyboard=True
         )
-        await update.message.reply_text(
+        await reply(
+            update,
             "Please select your gender using the buttons provided:",
             reply_markup=reply_markup,
         )
         return ASK_GENDER
-    user_data[user_id]["gender"] = selected_gender
+    await save_answer(user_id, "gender", selected_gender)
 
     looking_with_cancel = LOOKING_FOR_OPTIONS.copy()
     looking_with_cancel.append(["Cancel"])
@@ -143,7 +314,8 @@ async def ask_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
         looking_with_cancel, one_time_keyboard=True, resize_keyboard=True
     )
 
-    await update.message.reply_text(
+    await reply(
+        update,
         "What gender could your soulmate be?", reply_markup=reply_markup
     )
     return ASK_LOOKING_GENDER
@@ -162,17 +334,19 @@ async def ask_looking_gender(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup = ReplyKeyboardMarkup(
             looking_with_cancel, one_time_keyboard=True, resize_keyboard=True
         )
-        await update.message.reply_text(
+        await reply(
+            update,
             "Please select your preferences using the button:",
             reply_markup=reply_markup,
         )
         return ASK_LOOKING_GENDER
-    user_data[user_id]["looking_gender"] = selected_gender
+    await save_answer(user_id, "looking_gender", selected_gender)
 
     reply_markup = ReplyKeyboardMarkup(
         CANCEL_REGISTRATION, one_time_keyboard=True, resize_keyboard=True
     )
-    await update.message.reply_text(
+    await reply(
+        update,
         "What is the minimum age of your potential soulmate.",
         reply_markup=reply_markup,
     )
@@ -188,23 +362,24 @@ async def ask_looking_age_min(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         min_age = int(update.message.text)
         if min_age < 18:
-            await update.message.reply_text("Minimum age must be at least 18.")
+            await reply(update, "Minimum age must be at least 18.")
             return ASK_LOOKING_AGE_MIN
         if min_age > 99:
-            await update.message.reply_text("Please enter a realistic minimum age.")
+            await reply(update, "Please enter a realistic minimum age.")
             return ASK_LOOKING_AGE_MIN
-        user_data[user_id]["looking_age_min"] = min_age
+        await save_answer(user_id, "looking_age_min", min_age)
 
         reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
 
-        await update.message.reply_text(
+        await reply(
+            update,
             "Great! And what is the maximum age you're looking for?",
             reply_markup=reply_markup,
         )
         return ASK_LOOKING_AGE_MAX
 
     except ValueError:
-        await update.message.reply_text("Please input only numbers.")
+        await reply(update, "Please input only numbers.")
         return ASK_LOOKING_AGE_MIN
 
 
@@ -214,28 +389,34 @@ async def ask_looking_age_max(update: Update, context: ContextTypes.DEFAULT_TYPE
     if update.message.text == "Cancel":
         return await cancel(update, context)
 
-    min_age = user_data[user_id]["looking_age_min"]
+    draft = await drafts.get(user_id)
+    if not draft or draft.looking_age_min is None:
+        return await start(update, context)
+
+    min_age = draft.looking_age_min
     try:
         max_age = int(update.message.text)
         if max_age <= min_age:
-            await update.message.reply_text(
+            await reply(
+                update,
                 f"Maximum age must be greater than your minimum of {min_age}."
             )
             return ASK_LOOKING_AGE_MAX
         if max_age > 120:
-            await update.message.reply_text("Please enter a realistic maximum age.")
+            await reply(update, "Please enter a realistic maximum age.")
             return ASK_LOOKING_AGE_MAX
-        user_data[user_id]["looking_age_max"] = max_age
+        await save_answer(user_id, "looking_age_max", max_age)
 
         reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
-        await update.message.reply_text(
+        await reply(
+            update,
             "We're almost done! Write a few words about yourself and what you're looking for here.",
             reply_markup=reply_markup,
         )
         return ASK_DESCRIPTION
 
     except ValueError:
-        await update.message.reply_text("Please input only numbers.")
+        await reply(update, "Please input only numbers.")
         return ASK_LOOKING_AGE_MAX
 
 
@@ -245,9 +426,10 @@ async def ask_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == "Cancel":
         return await cancel(update, context)
 
-    user_data[user_id]["description"] = update.message.text
+    await save_answer(user_id, "description", update.message.text)
     reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
-    await update.message.reply_text(
+    await reply(
+        update,
         "Nice! Last step — could you send a photo of yourself?",
         reply_markup=reply_markup,
     )
@@ -261,38 +443,29 @@ async def ask_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await cancel(update, context)
 
     if update.message.photo:
-        user_data[user_id]["photo"] = update.message.photo[-1].file_id
+        await save_answer(user_id, "photo", update.message.photo[-1].file_id)
         return await check_profile(update, context)
     else:
-        await update.message.reply_text("Please send a photo.")
+        await reply(update, "Please send a photo.")
         return ASK_PHOTO
 
 
 async def check_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    profile = user_data[user_id]
-
-    if "photo" in profile:
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id, photo=profile["photo"]
-        )
+    draft = await drafts.get(user_id)
+    if not draft or not draft.is_complete():
+        return await start(update, context)
 
-    looking_age = f"{profile['looking_age_min']} - {profile['looking_age_max']}"
-    profile_text = (
-        f"Name: {profile['name']}\n"
-        f"Age: {profile['age']}\n"
-        f"City: {profile['city']}\n"
-        f"Gender: {profile['gender']}\n"
-        f"Looking for: {profile['looking_gender']}\n"
-        f"Age range: {looking_age}\n"
-        f"About: {profile['description']}\n\n"
-        f"Now you can start your searching or if you want to edit something restart registration"
+    profile = draft.to_dict()
+    caption = preview_caption(
+        profile,
+        "Now you can start your searching or if you want to edit something restart registration",
     )
 
     reply_markup = ReplyKeyboardMarkup(
         CONFIRM_REGISTRATION, one_time_keyboard=True, resize_keyboard=True
     )
-    await update.message.reply_text(profile_text, reply_markup=reply_markup)
+    await send_card(outbox, update.effective_chat.id, profile["photo"], caption, reply_markup)
     return COMPLETE_REG
 
 
@@ -301,10 +474,19 @@ async def complete_reg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     choice = update.message.text
 
     if choice == "Start searching":
-        user_data[user_id]["user_id"] = user_id
-        db.save_user(user_data[user_id])
-        db.give_user_fresh_start(user_id)
-        await update.message.reply_text(
+        draft = await drafts.get(user_id)
+        if not draft or not draft.is_complete():
+            return await start(update, context)
+
+        profile = draft.to_dict()
+        profile["user_id"] = user_id
+        profile["username"] = update.effective_user.username or ""
+        await db.save_user(profile)
+        await drafts.pop(user_id)
+        await db.give_user_fresh_start(user_id)
+        candidates.clear(user_id)
+        await reply(
+            update,
             "Your profile is now active. Good luck finding your soulmate!",
         )
         return await start_browsing(update, context)
@@ -316,7 +498,8 @@ async def complete_reg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = ReplyKeyboardMarkup(
             CONFIRM_REGISTRATION, one_time_keyboard=True, resize_keyboard=True
         )
-        await update.message.reply_text(
+        await reply(
+            update,
             "Please use the buttons provided", reply_markup=reply_markup
         )
         return COMPLETE_REG
@@ -325,12 +508,12 @@ async def complete_reg(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    if user_id in user_data:
-        user_data[user_id] = {}
+    await drafts.pop(user_id)
 
     reply_markup = ReplyKeyboardMarkup(START, resize_keyboard=True)
 
-    await update.message.reply_text(
+    await reply(
+        update,
         "Registration cancelled. All information has been discarded.\n"
         "You can start a new registration with the Start button or /start command.",
         reply_markup=reply_markup,
@@ -347,40 +530,40 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_browsing(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    potential_matches = db.find_potential_matches(user_id, 1)
+    potential_match = await candidates.next(user_id)
 
-    if not potential_matches:
+    if not potential_match:
         reply_markup = ReplyKeyboardMarkup([["⚙️ Menu", "🔄 Reset search"]], resize_keyboard=True)
-        await update.message.reply_text(
+        await reply(
+            update,
             "No more profiles to show! You can reset your search to see profiles again, or go to menu.",
             reply_markup=reply_markup
         )
         return BROWSING
     
-    potential_match = potential_matches[0]
-    current_profiles[user_id] = potential_match
-
     await show_profile(update, context, potential_match)
     return BROWSING
 
 
-async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, profile, matched=False):
-    await context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=profile["photo"]
-    )
-
-    profile_text = (
-        f"{profile["name"]}, {profile["age"]}\n"
-        f"{profile["city"]}\n"
-        f"{profile["description"]}"
-    )
-
+async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, profile, footer=None):
     reply_markup = ReplyKeyboardMarkup(
-        CONTINUE_SEARCHING if matched else BROWSING_OPTIONS,
+        CONTINUE_SEARCHING if footer else BROWSING_OPTIONS,
         resize_keyboard=True
     )
-    await update.message.reply_text(profile_text, reply_markup=reply_markup)
+    # Prefetched candidates come with their card already rendered
+    caption = profile.get("caption") if not footer else None
+    await send_card(
+        outbox,
+        update.effective_chat.id,
+        profile["photo"] if profile.get("photo_ok", True) else None,
+        caption or profile_caption(profile, footer or browse_footer(profile)),
+        reply_markup,
+    )
+
+
+def browse_footer(profile):
+    """Footer of a card while browsing"""
+    return "❤️ Likes you" if profile.get("likes_you") else None
 
 
 async def handle_browsing(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -394,98 +577,175 @@ async def handle_browsing(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await show_main_menu(update, context)
     
     elif choice == "🔄 Reset search":
-        db.reset_viewed_profiles(user_id)
-        await update.message.reply_text("Search reset! You'll see all profiles again.")
+        await db.reset_viewed_profiles(user_id)
+        candidates.clear(user_id)
+        await reply(update, "Search reset! You'll see all profiles again.")
         return await start_browsing(update, context)
     
     elif choice in ["❤️ Like", "❌ Skip"]:
-        if user_id not in current_profiles:
+        viewed_id = candidates.current(user_id)
+        if viewed_id is None:
             return await start_browsing(update, context)
         
-        viewed_profile = current_profiles[user_id]
-        db.add_viewed_profile(user_id, viewed_profile["user_id"])
+        await db.add_viewed_profile(user_id, viewed_id)
 
         if choice == "❤️ Like":
-            is_match = db.add_like(user_id, viewed_profile["user_id"])
+            is_match = await db.add_like(user_id, viewed_id)
 
             if is_match:
-                current_user = db.get_user(user_id)
-                matched_user = db.get_user(viewed_profile["user_id"])
-
-                #Get usernames for both users
-                try:
-                    current_user_chat = await context.bot.get_chat(user_id)
-                    current_username = current_user_chat.username or "No username"
-                except:
-                    current_username = "No username"
-                
-                try:
-                    matched_user_chat = await context.bot.get_chat(viewed_profile["user_id"])
-                    matched_username = matched_user_chat.username or "No username"
-                except:
-                    matched_username = "No username"
+                current_user, matched_user = await asyncio.gather(
+                    db.get_user(user_id), db.get_user(viewed_id)
+                )
+                current_username, matched_username = await asyncio.gather(
+                    get_username(context, user_id, current_user),
+                    get_username(context, viewed_id, matched_user),
+                )
 
                 # Show match to user who just liked
-                await show_profile(update, context, matched_user, True)
-                await update.message.reply_text(
-                    f"🎉 It's a match with {matched_user['name']} (@{matched_username})! "
-                    f"You can now start chatting!"
+                await show_profile(
+                    update, context, matched_user, match_text(matched_user, matched_username)
                 )
 
-                # Show match to the other user
-                try:
-                    await context.bot.send_photo(
-                        chat_id=viewed_profile["user_id"],
-                        photo=current_user["photo"]
-                    )
-
-                    profile_text = (
-                        f"{current_user['name']}, {current_user['age']}\n"
-                        f"{current_user['city']}\n"
-                        f"{current_user['description']}"
-                    )
-                    
-                    await context.bot.send_message(
-                        chat_id=viewed_profile["user_id"],
-                        text=profile_text
-                    )
-                    
-                    await context.bot.send_message(
-                        chat_id=viewed_profile["user_id"],
-                        text=f"🎉 It's a match with {current_user['name']} (@{current_username})! "
-                             f"You can now start chatting!"
-                    )
-                except Exception as e:
-                    # If the user is no longer available (deleted account, blocked bot, etc.)
-                    print(f"Couldn't send match notification to user {viewed_profile['user_id']}: {e}")
+                # Show match to the other user without holding up this user's next profile
+                context.application.create_task(
+                    notify_match(context, viewed_id, current_user, current_username),
+                    update=update,
+                )
             else:
-                await update.message.reply_text("❤️")
+                await reply(update, "❤️")
 
         elif choice == "❌ Skip":
-            await update.message.reply_text("❌")
+            await reply(update, "❌")
         
         return await start_browsing(update, context)
     
     else:
         reply_markup = ReplyKeyboardMarkup(BROWSING_OPTIONS, resize_keyboard=True)
-        await update.message.reply_text(
+        await reply(
+            update,
             "Please use the buttons provided.", reply_markup=reply_markup
         )
         return BROWSING
 
 
+async def get_username(context: ContextTypes.DEFAULT_TYPE, user_id: int, profile=None) -> str:
+    """Telegram @username of a user, for match messages
+
+    Comes from the cache or the stored profile (pass it if already loaded);
+    get_chat is only called for users whose username was never seen.
+    """
+    username = usernames.get(user_id)
+    if username is None:
+        if profile is None:
+            profile = await db.get_user(user_id)
+        username = profile.get("username") if profile else None
+        if username is None:
+            try:
+                chat = await context.bot.get_chat(user_id)
+            except TelegramError:
+                return "No username"
+            username = chat.username or ""
+            await db.set_username(user_id, username)
+        usernames.set(user_id, username)
+    return username or "No username"
+
+
+async def notify_match(context: ContextTypes.DEFAULT_TYPE, chat_id: int, profile, username: str):
+    """Queue the match and the liker's profile for the other user, behind interactive replies"""
+    await send_card(
+        outbox,
+        chat_id,
+        profile["photo"],
+        profile_caption(profile, match_text(profile, username)),
+        lane=BACKGROUND,
+    )
+
+
+def match_text(profile, username: str) -> str:
+    return (
+        f"🎉 It's a match with {profile['name']} (@{username})! "
+        f"You can now start chatting!"
+    )
+
+
+async def show_matches(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/matches: the newest page of the user's matches as one message"""
+    text, reply_markup = await matches_page(context, update.effective_user.id)
+    await reply(update, text, reply_markup=reply_markup)
+
+
+async def turn_matches_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Older/newer button under a matches page: edit the message in place"""
+    query = update.callback_query
+    _, direction, match_id = query.data.split(":")
+    text, reply_markup = await matches_page(
+        context, update.effective_user.id, **{direction: int(match_id)}
+    )
+    await query.answer()
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest:
+        # The page didn't change, e.g. the button was pressed twice
+        pass
+
+
+async def matches_page(context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                       before: int = None, after: int = None):
+    """Text and paging buttons for one page of matches, keyed by match id"""
+    size = settings.MATCHES_PAGE_SIZE
+    # One extra row tells whether there is a page past this one
+    matches = await db.get_matches(user_id, size + 1, before=before, after=after)
+    if not matches:
+        if before is not None or after is not None:
+            # Everything past the button's match is gone, start from the newest
+            return await matches_page(context, user_id)
+        return "No matches yet. Keep searching!", None
+    # The other direction is probed with a single row past the page's end,
+    # the match it was reached from may have been deactivated since
+    if after is not None:
+        has_newer = len(matches) > size
+        matches = matches[-size:]
+        has_older = bool(await db.get_matches(user_id, 1, before=matches[-1]["match_id"]))
+    else:
+        has_older = len(matches) > size
+        matches = matches[:size]
+        has_newer = before is not None and bool(
+            await db.get_matches(user_id, 1, after=matches[0]["match_id"])
+        )
+
+    match_usernames = await asyncio.gather(
+        *(get_username(context, match["user_id"], match) for match in matches)
+    )
+    lines = [
+        f"{match['name']}, {match['age']}, {match['city']} (@{username})"
+        for match, username in zip(matches, match_usernames)
+    ]
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton(
+            "‹ Newer", callback_data=f"matches:after:{matches[0]['match_id']}"
+        ))
+    if has_older:
+        buttons.append(InlineKeyboardButton(
+            "Older ›", callback_data=f"matches:before:{matches[-1]['match_id']}"
+        ))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "💞 Your matches:\n\n" + "\n".join(lines), reply_markup
+
+
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_profile = db.get_user(user_id)
+    user_profile = await db.get_user(user_id)
 
     if not user_profile:
         return await start(update, context)
     
     reply_markup = ReplyKeyboardMarkup(MAIN_MENU, resize_keyboard=True)
-    await update.message.reply_text(
-        "Please use buttons provided.",
-        reply_markup=reply_markup
-    )
+    unread = await db.count_unread_likes(user_id)
+    text = "Please use buttons provided."
+    if unread:
+        text = f"❤️ {unread} liked you, you'll see them first.\n\n{text}"
+    await reply(update, text, reply_markup=reply_markup)
     return MAIN_MENU_STATE
 
 
@@ -496,15 +756,18 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if choice == "Continue searching":
         return await start_browsing(update, context)
     
+    elif choice == "My matches":
+        await show_matches(update, context)
+        return MAIN_MENU_STATE
+    
     elif choice == "Edit profile":
-        db.deactivate_user(user_id)
-        if user_id in user_data:
-            del user_data[user_id]
-        
-        user_data[user_id] = {}
+        await db.deactivate_user(user_id)
+        candidates.clear(user_id)
+        await drafts.pop(user_id)
 
         reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
-        await update.message.reply_text(
+        await reply(
+            update,
             "Let's update your profile! What's you name?",
             reply_markup=reply_markup
         )
@@ -512,15 +775,17 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ASK_NAME
     
     elif choice == "Deactivate account":
-        db.deactivate_user(user_id)
-        await update.message.reply_text(
+        await db.deactivate_user(user_id)
+        await reply(
+            update,
             "Your account has been deactivated. Your profile won't be shown to others."
         )
         return await show_inactive_menu(update, context)
     
     else:
         reply_markup = ReplyKeyboardMarkup(MAIN_MENU, resize_keyboard=True)
-        await update.message.reply_text(
+        await reply(
+            update,
             "Please use buttons provided.", reply_markup=reply_markup
         )
         return MAIN_MENU_STATE
@@ -528,13 +793,13 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_inactive_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_pofile = db.get_user(user_id)
+    user_pofile = await db.get_user(user_id)
 
     if not user_pofile:
         return await start(update, context)
     
     reply_markup = ReplyKeyboardMarkup(INACTIVE_MENU, resize_keyboard=True)
-    await update.message.reply_text("Please use buttons provided.", reply_markup=reply_markup)
+    await reply(update, "Please use buttons provided.", reply_markup=reply_markup)
     return INACTIVE_MENU_STATE
     
     
@@ -543,21 +808,22 @@ async def handle_inactive_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     choice = update.message.text
 
     if choice == "Activate account":
-        db.give_user_fresh_start(user_id)
-        await update.message.reply_text(
+        await db.give_user_fresh_start(user_id)
+        candidates.clear(user_id)
+        await reply(
+            update,
             "🎉 Welcome back! Your profile is now visible to others again."
         )
         return await show_main_menu(update, context)
     
     elif choice == "Edit profile":
-        db.deactivate_user(user_id)
-        if user_id in user_data:
-            del user_data[user_id]
-        
-        user_data[user_id] = {}
+        await db.deactivate_user(user_id)
+        candidates.clear(user_id)
+        await drafts.pop(user_id)
 
         reply_markup = ReplyKeyboardMarkup(CANCEL_REGISTRATION, resize_keyboard=True)
-        await update.message.reply_text(
+        await reply(
+            update,
             "Let's update your profile! What's you name?",
             reply_markup=reply_markup
         )
@@ -566,17 +832,115 @@ async def handle_inactive_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     
     else:
         reply_markup = ReplyKeyboardMarkup(INACTIVE_MENU, resize_keyboard=True)
-        await update.message.reply_text(
+        await reply(
+            update,
             "Please use the buttons provided.", reply_markup=reply_markup
         )
         return INACTIVE_MENU_STATE
 
 
+async def log_stats():
+    """Print the counters of this worker's in-memory state, outbox and background jobs"""
+    stats = {
+        "candidates": candidates.stats(),
+        "drafts": await drafts.stats(),
+        "outbox": outbox.stats(),
+        "maintenance": maintenance.stats(),
+    }
+    print("Stats: " + json.dumps(stats, sort_keys=True))
+
+
 #App launch
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_maintenance():
+    """Background jobs: counters, engine sync between workers, and database upkeep"""
+    jobs = [MaintenanceJob("stats", settings.STATS_INTERVAL, 1, [single_step(log_stats)])]
+    if settings.WORKERS > 1 and db.engine is not None:
+        # Pick up profiles changed by other workers in the in-memory engine
+        jobs.append(MaintenanceJob(
+            "engine_sync", settings.ENGINE_SYNC_INTERVAL, settings.ENGINE_SYNC_INTERVAL,
+            [single_step(db.sync_engine)],
+        ))
+    if settings.MAINTENANCE:
+        jobs += database_jobs(db)
+    return Maintenance(jobs)
+
+
+maintenance = build_maintenance()
+
+
+async def on_startup(app):
+    await db.start()
+    outbox.start(app.bot)
+    maintenance.start()
+
+
+async def on_stop(app):
+    await maintenance.stop()
+    await outbox.stop()
+
+
+async def on_shutdown(app):
+    await db.close()
+    drafts.close()
+
+
+async def run_webhook(app, server=None):
+    """Serve updates from the embedded webhook server until SIGINT/SIGTERM"""
+    if server is None:
+        server = WebhookServer(
+            app,
+            host=settings.WEBHOOK_HOST,
+            port=settings.WEBHOOK_PORT,
+            path=settings.WEBHOOK_PATH,
+            secret_token=settings.WEBHOOK_SECRET or None,
+        )
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    await app.initialize()
+    await on_startup(app)
+    try:
+        if settings.WEBHOOK_URL:
+            await app.bot.set_webhook(
+                settings.WEBHOOK_URL,
+                secret_token=settings.WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await app.start()
+        await server.start()
+        print(f"Listening for webhook updates on {server.host}:{server.port}{server.path}")
+        await stopping.wait()
+    finally:
+        # Stop taking updates, finish the queued ones, then flush sends and DB writes
+        await server.stop()
+        if app.running:
+            await app.stop()
+        await on_stop(app)
+        await app.shutdown()
+        await on_shutdown(app)
+
+
+def build_app(request=None):
+    """Application with all handlers; ``request`` replaces the HTTP client (local testing)"""
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UserOrderedProcessor(settings.CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    if settings.STATE_BACKEND == "sqlite":
+        builder = builder.persistence(SqlitePersistence(settings.DB_NAME))
+    app = builder.build()
 
     conv_handler = ConversationHandler(
+        name="soulmate",
+        persistent=settings.STATE_BACKEND == "sqlite",
         entry_points=[
             CommandHandler("start", start),
             MessageHandler(filters.Regex("^Start$"), register),
@@ -584,7 +948,9 @@ def main():
         states={
             ASK_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_name)],
             ASK_AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_age)],
-            ASK_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_city)],
+            ASK_CITY: [
+                MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.LOCATION, ask_city)
+            ],
             ASK_GENDER: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_gender)],
             ASK_LOOKING_GENDER: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, ask_looking_gender)
@@ -616,8 +982,21 @@ def main():
         ],
     )
 
+    # Before every other handler, so match messages find usernames already stored
+    app.add_handler(TypeHandler(Update, remember_username), group=-1)
     app.add_handler(conv_handler)
-    app.run_polling()
+    # Outside the conversation, so matches can be listed from any state
+    app.add_handler(CommandHandler("matches", show_matches))
+    app.add_handler(CallbackQueryHandler(turn_matches_page, pattern=r"^matches:(before|after):\d+$"))
+    return app
+
+
+def main():
+    app = build_app()
+    if settings.MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+import asyncio
+import functools
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import settings
+
+# One short unit of work: returns what it reclaimed (rows, pages, ...) and
+# whether there is more to do
+Step = Callable[[], Awaitable[Tuple[int, bool]]]
+
+
+def single_step(func: Callable[[], Awaitable[object]]) -> Step:
+    """Step for work done in one go; an int result counts as reclaimed"""
+    async def step():
+        result = await func()
+        if isinstance(result, bool) or not isinstance(result, int):
+            result = 0
+        return result, False
+    return step
+
+
+class MaintenanceJob:
+    """Periodic job made of short steps, run until done or out of time
+
+    Each run goes through ``steps`` in order, repeating a step while it
+    reports more work, and stops early once ``budget`` seconds have passed.
+    A step already running is not interrupted, so steps should be small
+    enough to fit in the budget. Counters are kept for ``stats()``.
+    """
+
+    __slots__ = ("name", "interval", "budget", "steps", "runs", "reclaimed",
+                 "seconds", "last_seconds", "out_of_budget", "errors")
+
+    def __init__(self, name: str, interval: float, budget: float, steps: Sequence[Step]):
+        self.name = name
+        self.interval = interval
+        self.budget = budget
+        self.steps: List[Step] = list(steps)
+        self.runs = 0
+        self.reclaimed = 0
+        self.seconds = 0.0
+        self.last_seconds = 0.0
+        # Runs that stopped with work left
+        self.out_of_budget = 0
+        self.errors = 0
+
+    async def run(self) -> int:
+        """Run the steps once; returns what they reclaimed"""
+        started = time.monotonic()
+        deadline = started + self.budget
+        reclaimed = 0
+        try:
+            for step in self.steps:
+                more = True
+                while more and time.monotonic() < deadline:
+                    count, more = await step()
+                    reclaimed += count
+                if more:
+                    self.out_of_budget += 1
+                    break
+        finally:
+            self.last_seconds = time.monotonic() - started
+            self.seconds += self.last_seconds
+            self.runs += 1
+            self.reclaimed += reclaimed
+        return reclaimed
+
+
+class Maintenance:
+    """Runs maintenance jobs in the background, each every ``interval`` seconds
+
+    Jobs with an interval of 0 are skipped. Steps are expected to do their
+    blocking work off the event loop (AsyncDatabase does).
+    """
+
+    def __init__(self, jobs: Sequence[MaintenanceJob]):
+        self.jobs = [job for job in jobs if job.interval > 0]
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run(job)) for job in self.jobs]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self, job: MaintenanceJob):
+        while True:
+            await asyncio.sleep(job.interval)
+            try:
+                await job.run()
+            except Exception as e:
+                job.errors += 1
+                print(f"Maintenance job {job.name} failed: {e}")
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Runs, amount reclaimed and time spent per job"""
+        return {
+            job.name: {
+                "runs": job.runs,
+                "reclaimed": job.reclaimed,
+                "seconds": round(job.seconds, 3),
+                "last_seconds": round(job.last_seconds, 3),
+                "out_of_budget": job.out_of_budget,
+                "errors": job.errors,
+            }
+            for job in self.jobs
+        }
+
+
+def database_jobs(db, budget: Optional[float] = None) -> List[MaintenanceJob]:
+    """Database upkeep jobs for a Storage, configured from settings
+
+    ``budget`` replaces every job's configured time budget.
+    """
+    batch = settings.MAINTENANCE_BATCH
+    gc_steps = []
+    if settings.GC_INACTIVE_DAYS > 0:
+        gc_steps.append(functools.partial(db.retire_inactive_users, settings.GC_INACTIVE_DAYS, batch))
+    gc_steps += [
+        functools.partial(db.compact_interactions, batch),
+        functools.partial(db.prune_profile_changes, settings.PROFILE_LOG_KEEP, batch),
+    ]
+    return [
+        MaintenanceJob("gc", settings.GC_INTERVAL, budget or settings.GC_BUDGET, gc_steps),
+        MaintenanceJob(
+            "vacuum", settings.VACUUM_INTERVAL, budget or settings.VACUUM_BUDGET,
+            [functools.partial(db.incremental_vacuum, settings.VACUUM_PAGES)],
+        ),
+        MaintenanceJob(
+            "analyze", settings.ANALYZE_INTERVAL, budget or settings.ANALYZE_BUDGET,
+            [single_step(functools.partial(db.analyze, table))
+             for table in db.tables],
+        ),
+        MaintenanceJob(
+            "checkpoint", settings.CHECKPOINT_INTERVAL, budget or settings.CHECKPOINT_BUDGET,
+            [single_step(db.checkpoint_wal)],
+        ),
+    ]
@@ -0,0 +1,324 @@
+import asyncio
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Deque, Dict, Optional, Set
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+# Priority lanes, served in this order
+INTERACTIVE = 0  # replies to the user who is using the bot right now
+BACKGROUND = 1   # notices to other users (matches)
+
+# Telegram's limit for one text message, in UTF-16 code units
+MAX_TEXT_LENGTH = 4096
+
+
+def text_length(text: str) -> int:
+    """Length as Telegram counts it (emoji outside the BMP count twice)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def retry_delay(error: RetryAfter) -> float:
+    """Seconds Telegram asked us to wait"""
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return float(error.retry_after)
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``burst``"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundMessage:
+    """One queued send_message or send_photo call"""
+
+    __slots__ = ("chat_id", "text", "photo", "reply_markup", "lane", "futures", "attempts")
+
+    def __init__(self, chat_id: int, text: Optional[str] = None, photo: Optional[str] = None,
+                 reply_markup=None, lane: int = INTERACTIVE):
+        self.chat_id = chat_id
+        self.text = text
+        self.photo = photo
+        self.reply_markup = reply_markup
+        self.lane = lane
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.attempts = 0
+
+    def can_absorb(self, other: "OutboundMessage") -> bool:
+        """Whether ``other`` can be appended to this text message"""
+        return (
+            self.photo is None
+            and other.photo is None
+            and (self.reply_markup is None or other.reply_markup is None)
+            and text_length(self.text) + text_length(other.text) + 2 <= MAX_TEXT_LENGTH
+        )
+
+    def absorb(self, other: "OutboundMessage"):
+        self.text = f"{self.text}\n\n{other.text}"
+        self.reply_markup = self.reply_markup or other.reply_markup
+        self.futures.extend(other.futures)
+
+
+class Outbox:
+    """Rate-limit-aware scheduler for outbound Telegram messages
+
+    Sends are queued in priority lanes and released under a global token
+    bucket and one bucket per chat. Messages to one chat keep their order and
+    are never in flight two at a time, and consecutive text messages queued
+    for the same chat are merged into one. RetryAfter pauses all sends and
+    network errors pause the chat; either way the message goes back to the
+    head of its lane. The
+    queue is bounded: producers wait for room, which is counted in
+    ``stats()``.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0,
+                 chat_burst: float = 5.0, max_queued: int = 5000, max_attempts: int = 5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+
+        self.bot: Optional[Bot] = None
+        self._lanes: Dict[int, Deque[OutboundMessage]] = {INTERACTIVE: deque(), BACKGROUND: deque()}
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._in_flight: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._room: Optional[asyncio.Condition] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.retried = 0
+        self.backpressure_waits = 0
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Condition()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Give queued messages up to ``timeout`` seconds to go out, then stop"""
+        deadline = time.monotonic() + timeout
+        while (self.queued() or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker:
+            self._worker.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def queued(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None,
+                           lane: int = INTERACTIVE) -> asyncio.Future:
+        """Queue a text message; the returned future resolves once it is sent"""
+        return await self._enqueue(OutboundMessage(chat_id, text=text, reply_markup=reply_markup, lane=lane))
+
+    async def send_photo(self, chat_id: int, photo: str, caption: Optional[str] = None,
+                         reply_markup=None, lane: int = INTERACTIVE) -> asyncio.Future:
+        """Queue a photo; the returned future resolves once it is sent"""
+        return await self._enqueue(
+            OutboundMessage(chat_id, text=caption, photo=photo, reply_markup=reply_markup, lane=lane)
+        )
+
+    async def _enqueue(self, message: OutboundMessage) -> asyncio.Future:
+        async with self._room:
+            if self.queued() >= self.max_queued:
+                self.backpressure_waits += 1
+                await self._room.wait_for(lambda: self.queued() < self.max_queued)
+            self._lanes[message.lane].append(message)
+        future = message.futures[0]
+        future.add_done_callback(_log_failure)
+        self._wakeup.set()
+        return future
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10 * self.max_queued:
+                self._prune_buckets()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_buckets(self):
+        """Forget chats whose bucket has refilled, they behave like new ones"""
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.burst:
+                del self._chat_buckets[chat_id]
+
+    def _take(self, lane: int, index: int) -> OutboundMessage:
+        """Remove a message, merging the chat's following text messages into it"""
+        queue = self._lanes[lane]
+        message = queue[index]
+        del queue[index]
+        if message.photo is not None:
+            return message
+
+        i = index
+        while i < len(queue):
+            other = queue[i]
+            if other.chat_id != message.chat_id:
+                i += 1
+                continue
+            if not message.can_absorb(other):
+                break
+            message.absorb(other)
+            del queue[i]
+            self.coalesced += 1
+        return message
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            global_delay = self.global_bucket.delay(now)
+            if global_delay:
+                await asyncio.sleep(global_delay)
+                continue
+
+            picked = None
+            wait = None
+            for lane in (INTERACTIVE, BACKGROUND):
+                index, lane_wait = self._pick_in(lane, now)
+                if lane_wait is not None:
+                    wait = lane_wait if wait is None else min(wait, lane_wait)
+                if index is not None:
+                    picked = self._take(lane, index)
+                    break
+
+            if picked is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.global_bucket.take()
+            self._chat_bucket(picked.chat_id).take()
+            self._in_flight.add(picked.chat_id)
+            task = asyncio.create_task(self._deliver(picked))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            async with self._room:
+                self._room.notify_all()
+
+    def _pick_in(self, lane: int, now: float):
+        """Index of the first sendable message in a lane, and the shortest wait seen"""
+        wait = None
+        blocked = set()
+        for index, message in enumerate(self._lanes[lane]):
+            chat_id = message.chat_id
+            if chat_id in blocked:
+                continue
+            # Earlier messages to this chat go first, whatever happens
+            blocked.add(chat_id)
+            if chat_id in self._in_flight:
+                continue
+            delay = self._chat_bucket(chat_id).delay(now)
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            return index, wait
+        return None, wait
+
+    async def _deliver(self, message: OutboundMessage):
+        try:
+            if message.photo is not None:
+                result = await self.bot.send_photo(
+                    chat_id=message.chat_id,
+                    photo=message.photo,
+                    caption=message.text,
+                    reply_markup=message.reply_markup,
+                )
+            else:
+                result = await self.bot.send_message(
+                    chat_id=message.chat_id,
+                    text=message.text,
+                    reply_markup=message.reply_markup,
+                )
+        except (Forbidden, BadRequest) as e:
+            self._fail(message, e)
+        except RetryAfter as e:
+            delay = retry_delay(e)
+            # Flood control is often bot-wide, so every chat waits it out
+            bucket = self.global_bucket
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+            self._requeue(message, e, delay)
+        except (TimedOut, NetworkError) as e:
+            self._requeue(message, e, 2 ** message.attempts)
+        except Exception as e:
+            # Anything else (ChatMigrated, InvalidToken, bugs) still has to
+            # resolve the futures, or everyone awaiting them hangs
+            self._fail(message, e)
+        else:
+            self.sent += 1
+            for future in message.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._in_flight.discard(message.chat_id)
+            self._wakeup.set()
+
+    def _requeue(self, message: OutboundMessage, error: Exception, delay: float):
+        message.attempts += 1
+        if message.attempts >= self.max_attempts:
+            self._fail(message, error)
+            return
+        self.retried += 1
+        bucket = self._chat_bucket(message.chat_id)
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+        self._lanes[message.lane].appendleft(message)
+
+    def _fail(self, message: OutboundMessage, error: Exception):
+        self.failed += 1
+        for future in message.futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def stats(self) -> Dict[str, int]:
+        """Queue depth per lane and delivery counters"""
+        return {
+            "queued_interactive": len(self._lanes[INTERACTIVE]),
+            "queued_background": len(self._lanes[BACKGROUND]),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+            "failed": self.failed,
+            "backpressure_waits": self.backpressure_waits,
+        }
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Couldn't deliver message: {future.exception()}")
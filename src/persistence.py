@@ -0,0 +1,115 @@
+import asyncio
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from connection import ConnectionPool
+
+
+class SqlitePersistence(BasePersistence):
+    """ConversationHandler states stored in SQLite
+
+    Only conversation states are persisted; registration drafts have their
+    own store (state.SqliteBackend). The application writes just the
+    conversations that changed, so several worker processes, each owning
+    its own users, can share the table. Statements run on one background
+    thread, in the order they were issued, so waiting for the database write
+    lock never blocks the event loop.
+    """
+
+    def __init__(self, db_name: str, table: str = "conversations", update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=False, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self.pool = ConnectionPool(db_name)
+        self.table = table
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        with self.pool.connection() as conn:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    name TEXT NOT NULL,
+                    conversation_key TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    PRIMARY KEY (name, conversation_key)
+                )
+            ''')
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def get_conversations(self, name: str) -> Dict:
+        return await self._run(self._load_conversations, name)
+
+    async def update_conversation(self, name: str, key, new_state: Optional[object]):
+        await self._run(self._store_conversation, name, json.dumps(key),
+                        None if new_state is None else json.dumps(new_state))
+
+    async def flush(self):
+        await self._run(self.pool.close)
+        self._executor.shutdown(wait=True)
+
+    def _load_conversations(self, name: str) -> Dict:
+        rows = self.pool.connection().execute(
+            f'SELECT conversation_key, state FROM {self.table} WHERE name = ?', (name,)
+        ).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    def _store_conversation(self, name: str, key: str, state: Optional[str]):
+        with self.pool.connection() as conn:
+            if state is None:
+                conn.execute(
+                    f'DELETE FROM {self.table} WHERE name = ? AND conversation_key = ?',
+                    (name, key),
+                )
+            else:
+                conn.execute(
+                    f'INSERT OR REPLACE INTO {self.table} (name, conversation_key, state) VALUES (?, ?, ?)',
+                    (name, key, state),
+                )
+
+    # Nothing else is persisted
+    async def get_user_data(self) -> Dict:
+        return {}
+
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,801 @@
+import random
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg is only needed for STORAGE=postgres
+    asyncpg = None
+
+from cache import TTLCache
+from db import ANY_GENDER, GENDERS, MAX_RAND_KEY, MAX_ROWID
+from geo import EARTH_RADIUS_KM, SearchArea, area_cell, locate, normalize_city, search_area
+from ranking import UserStats
+from storage import Storage
+
+_MISSING = object()
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        name TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        city TEXT NOT NULL,
+        gender TEXT NOT NULL,
+        looking_gender TEXT NOT NULL,
+        looking_age_min INTEGER NOT NULL,
+        looking_age_max INTEGER NOT NULL,
+        description TEXT NOT NULL,
+        photo TEXT,
+        is_active BOOLEAN NOT NULL DEFAULT TRUE,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        city_key TEXT NOT NULL DEFAULT '',
+        rand_key BIGINT NOT NULL DEFAULT 0,
+        epoch INTEGER NOT NULL DEFAULT 0,
+        deactivated_at TIMESTAMPTZ
+    );
+
+    ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS cell TEXT NOT NULL DEFAULT '',
+        ADD COLUMN IF NOT EXISTS username TEXT;
+
+    -- Same layout as the SQLite candidate index: equality columns, then a
+    -- range scan over rand_key, with the other filtered columns read from
+    -- the index entry
+    DROP INDEX IF EXISTS idx_users_candidates;
+    CREATE INDEX IF NOT EXISTS idx_users_nearby
+    ON users (cell, is_active, gender, rand_key)
+    INCLUDE (age, looking_gender, looking_age_min, looking_age_max, latitude, longitude, epoch);
+
+    CREATE INDEX IF NOT EXISTS idx_users_deactivated
+    ON users (deactivated_at) WHERE NOT is_active;
+
+    CREATE TABLE IF NOT EXISTS likes (
+        id BIGSERIAL PRIMARY KEY,
+        from_user_id BIGINT NOT NULL,
+        to_user_id BIGINT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        from_epoch INTEGER NOT NULL DEFAULT 0,
+        to_epoch INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (from_user_id, to_user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS matches (
+        id BIGSERIAL PRIMARY KEY,
+        user1_id BIGINT NOT NULL,
+        user2_id BIGINT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        epoch1 INTEGER NOT NULL DEFAULT 0,
+        epoch2 INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (user1_id, user2_id)
+    );
+
+    -- Each user's matches on either side of the pair, for paging through them by id
+    CREATE INDEX IF NOT EXISTS idx_matches_user1 ON matches (user1_id, epoch1, id);
+    CREATE INDEX IF NOT EXISTS idx_matches_user2 ON matches (user2_id, epoch2, id);
+
+    -- One row per view rather than SQLite's encoded seen sets: rows can be
+    -- written concurrently and excluded in the candidate query itself
+    CREATE TABLE IF NOT EXISTS seen_profiles (
+        viewer_id BIGINT NOT NULL,
+        viewed_id BIGINT NOT NULL,
+        viewed_epoch INTEGER NOT NULL,
+        PRIMARY KEY (viewer_id, viewed_id)
+    );
+
+    -- Swipe counters for candidate ranking and the unread likes counter, as in db.Database
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id BIGINT PRIMARY KEY,
+        last_active_at DOUBLE PRECISION NOT NULL DEFAULT 0,
+        views_given INTEGER NOT NULL DEFAULT 0,
+        likes_given INTEGER NOT NULL DEFAULT 0,
+        views_received INTEGER NOT NULL DEFAULT 0
+    );
+
+    ALTER TABLE user_stats ADD COLUMN IF NOT EXISTS likes_unread INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE likes ADD COLUMN IF NOT EXISTS answered BOOLEAN NOT NULL DEFAULT FALSE;
+
+    -- Each user's inbox: likes they haven't answered yet, oldest first
+    CREATE INDEX IF NOT EXISTS idx_likes_inbox
+    ON likes (to_user_id, to_epoch, id) WHERE NOT answered;
+'''
+
+# Upsert of counter changes into user_stats. {rows} is a query or VALUES
+# list of (user_id, last_active_at, views_given, likes_given,
+# views_received, likes_unread); rows are summed per user and written in
+# user_id order, so concurrent updates lock rows in one order
+COUNT_STATS = '''
+    INSERT INTO user_stats AS stats
+    (user_id, last_active_at, views_given, likes_given, views_received, likes_unread)
+    SELECT user_id, max(last_active_at), sum(views_given), sum(likes_given),
+           sum(views_received), sum(likes_unread)
+    FROM ({rows}) counts (user_id, last_active_at, views_given, likes_given, views_received,
+                          likes_unread)
+    GROUP BY user_id
+    ORDER BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        last_active_at = greatest(stats.last_active_at, excluded.last_active_at),
+        views_given = stats.views_given + excluded.views_given,
+        likes_given = stats.likes_given + excluded.likes_given,
+        views_received = stats.views_received + excluded.views_received,
+        likes_unread = greatest(stats.likes_unread + excluded.likes_unread, 0)
+'''
+
+# Seen profile $1 -> $2, counted in user_stats only if it is a new view.
+# Seeing a profile answers its like, whatever the viewer does next.
+INSERT_VIEW = '''
+    WITH added AS (
+        INSERT INTO seen_profiles (viewer_id, viewed_id, viewed_epoch)
+        VALUES ($1, $2, COALESCE((SELECT epoch FROM users WHERE user_id = $2), 0))
+        ON CONFLICT (viewer_id, viewed_id) DO UPDATE SET
+            viewed_epoch = excluded.viewed_epoch
+        WHERE seen_profiles.viewed_epoch <> excluded.viewed_epoch
+        RETURNING viewer_id, viewed_id
+    ), answered AS (
+        UPDATE likes SET answered = TRUE
+        WHERE from_user_id = $2 AND to_user_id = $1 AND NOT answered
+        AND EXISTS (SELECT 1 FROM added)
+        RETURNING to_user_id
+    )
+''' + COUNT_STATS.format(rows='''
+    SELECT viewer_id, extract(epoch FROM now())::FLOAT8, 1, 0, 0, 0 FROM added
+    UNION ALL
+    SELECT viewed_id, 0::FLOAT8, 0, 0, 1, 0 FROM added
+    UNION ALL
+    SELECT to_user_id, 0::FLOAT8, 0, 0, 0, -1 FROM answered
+''')
+
+# Registration of $1
+COUNT_SIGNUP = COUNT_STATS.format(rows='''
+    VALUES ($1::BIGINT, extract(epoch FROM now())::FLOAT8, 0, 0, 0, 0)
+''')
+
+# A like $1 -> $2, unread for $2 if $3 is 1
+COUNT_LIKE = COUNT_STATS.format(rows='''
+    VALUES ($1::BIGINT, extract(epoch FROM now())::FLOAT8, 0, 1, 0, 0),
+           ($2::BIGINT, 0::FLOAT8, 0, 0, 0, $3::INTEGER)
+''')
+
+# Both likes of the new match of $1 and $2 leave the inboxes
+ANSWER_MATCH = '''
+    WITH answered AS (
+        UPDATE likes SET answered = TRUE
+        WHERE ((from_user_id = $1 AND to_user_id = $2) OR (from_user_id = $2 AND to_user_id = $1))
+        AND NOT answered
+        RETURNING to_user_id
+    )
+''' + COUNT_STATS.format(rows='SELECT to_user_id, 0::FLOAT8, 0, 0, 0, -1 FROM answered')
+
+# Same epoch rules as db.Database: a like counts while both users are still
+# at the epochs it recorded, and renewing an old like updates them. A like
+# from a profile the recipient has already seen is answered from the start.
+INSERT_LIKE = '''
+    INSERT INTO likes (from_user_id, to_user_id, from_epoch, to_epoch, answered)
+    VALUES ($1, $2,
+            COALESCE((SELECT epoch FROM users WHERE user_id = $1), 0),
+            COALESCE((SELECT epoch FROM users WHERE user_id = $2), 0),
+            EXISTS (
+                SELECT 1 FROM seen_profiles
+                WHERE viewer_id = $2 AND viewed_id = $1
+                AND viewed_epoch = COALESCE((SELECT epoch FROM users WHERE user_id = $1), 0)
+            ))
+    ON CONFLICT (from_user_id, to_user_id) DO UPDATE SET
+        from_epoch = excluded.from_epoch,
+        to_epoch = excluded.to_epoch,
+        created_at = now(),
+        answered = excluded.answered
+    WHERE likes.from_epoch <> excluded.from_epoch OR likes.to_epoch <> excluded.to_epoch
+    RETURNING from_epoch, to_epoch, answered
+'''
+
+# Match row for (user1, user2, epoch1, epoch2) if the like $5 -> $6 exists at
+# epochs ($7, $8); RETURNING gives a row only if a match was created or renewed
+INSERT_MATCH_IF_MUTUAL = '''
+    INSERT INTO matches (user1_id, user2_id, epoch1, epoch2)
+    SELECT $1, $2, $3, $4
+    WHERE EXISTS (
+        SELECT 1 FROM likes
+        WHERE from_user_id = $5 AND to_user_id = $6 AND from_epoch = $7 AND to_epoch = $8
+    )
+    ON CONFLICT (user1_id, user2_id) DO UPDATE SET
+        epoch1 = excluded.epoch1,
+        epoch2 = excluded.epoch2,
+        created_at = now()
+    WHERE matches.epoch1 <> excluded.epoch1 OR matches.epoch2 <> excluded.epoch2
+    RETURNING 1
+'''
+
+# Candidate filters shared by the slice walk and get_candidates. $1 viewer id,
+# $2 viewer epoch; neither liked by the viewer nor seen at the current epoch.
+NOT_LIKED_OR_SEEN = '''
+    NOT EXISTS (
+        SELECT 1 FROM likes
+        WHERE from_user_id = $1 AND to_user_id = users.user_id
+        AND from_epoch = $2 AND to_epoch = users.epoch
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM seen_profiles
+        WHERE viewer_id = $1 AND viewed_id = users.user_id AND viewed_epoch = users.epoch
+    )
+'''
+
+
+def area_condition(area: SearchArea, first: int) -> Tuple[str, tuple]:
+    """Condition keeping rows inside a search area, with parameters from ``$first``
+
+    The bounding box is checked on the index entry, and the distance only
+    for rows inside it.
+    """
+    if area.box is None:
+        return '', ()
+    lat_min, lat_max, lon_min, lon_max, lat, lon, radius = (f'${first + i}' for i in range(7))
+    condition = f'''
+        AND latitude BETWEEN {lat_min} AND {lat_max}
+        AND longitude BETWEEN {lon_min} AND {lon_max}
+        AND 2 * {EARTH_RADIUS_KM} * asin(sqrt(least(1.0,
+            power(sin(radians(latitude - {lat}) / 2), 2)
+            + cos(radians({lat})) * cos(radians(latitude))
+            * power(sin(radians(longitude - {lon}) / 2), 2)
+        ))) <= {radius}
+    '''
+    return condition, (*area.box, area.latitude, area.longitude, float(area.radius_km))
+
+
+def pair_lock_key(user_a: int, user_b: int) -> int:
+    """Advisory lock key shared by both likes of a pair"""
+    low, high = min(user_a, user_b), max(user_a, user_b)
+    digest = blake2b(f"{low}:{high}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class PostgresStorage(Storage):
+    """Storage on PostgreSQL through an asyncpg connection pool
+
+    asyncpg prepares every statement on the server and keeps it per
+    connection (``statement_cache_size``), so repeated queries skip parsing
+    and planning. Several bot processes can write at once; the two likes
+    of a pair take the same advisory lock, so one of them always sees the
+    other and the match is reported once. Random candidates are picked with
+    the same rand_key keyset walk as SQLite: TABLESAMPLE samples pages
+    before the city/gender/age filters apply, so it comes back short or
+    empty for small slices. Fresh starts use epochs as in db.Database.
+    """
+
+    tables = ("users", "likes", "matches", "seen_profiles", "user_stats")
+
+    def __init__(self, dsn: str, schema: Optional[str] = None, min_size: int = 2,
+                 max_size: int = 10, statement_cache_size: int = 256,
+                 profile_cache_size: int = 10000, profile_cache_ttl: float = 300.0,
+                 radius_km: float = 50.0, ranker=None):
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is required for PostgreSQL storage")
+        self.dsn = dsn
+        self.schema = schema
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.profiles = TTLCache(profile_cache_size, profile_cache_ttl)
+        self.radius_km = radius_km
+        # Orders the candidates found (ranking.Ranker); None keeps them random
+        self.ranker = ranker
+        self.pool: Optional["asyncpg.Pool"] = None
+        # Where compact_interactions continues in each table (None: done this pass)
+        self._compact_position = {'likes': 0, 'matches': 0, 'seen_profiles': 0}
+
+    async def start(self):
+        server_settings = {"search_path": self.schema} if self.schema else None
+        if self.schema:
+            conn = await asyncpg.connect(self.dsn)
+            try:
+                await conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.schema}"')
+            finally:
+                await conn.close()
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=self.statement_cache_size,
+            server_settings=server_settings,
+        )
+        async with self.pool.acquire() as conn:
+            # Older idx_users_nearby lacks the preference columns; SCHEMA creates the current one
+            definition = await conn.fetchval('''
+                SELECT indexdef FROM pg_indexes
+                WHERE schemaname = current_schema() AND indexname = 'idx_users_nearby'
+            ''')
+            if definition and 'looking_gender' not in definition:
+                await conn.execute('DROP INDEX idx_users_nearby')
+            new_stats = await conn.fetchval("SELECT to_regclass('user_stats') IS NULL")
+            new_inbox = not await conn.fetchval('''
+                SELECT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'likes'
+                    AND column_name = 'answered'
+                )
+            ''')
+            await conn.execute(SCHEMA)
+            if new_stats:
+                # Start existing users from their registration time, views and likes
+                await conn.execute('''
+                    INSERT INTO user_stats (user_id, last_active_at, views_given, likes_given,
+                                            views_received)
+                    SELECT user_id, extract(epoch FROM created_at),
+                           (SELECT COUNT(*) FROM seen_profiles WHERE viewer_id = user_id),
+                           (SELECT COUNT(*) FROM likes WHERE from_user_id = user_id),
+                           (SELECT COUNT(*) FROM seen_profiles WHERE viewed_id = user_id)
+                    FROM users
+                    ON CONFLICT (user_id) DO NOTHING
+                ''')
+            if new_inbox:
+                # Likes that are part of a match, or from a profile the
+                # recipient has seen, are answered
+                await conn.execute('''
+                    UPDATE likes SET answered = TRUE
+                    WHERE EXISTS (
+                        SELECT 1 FROM likes reverse
+                        WHERE reverse.from_user_id = likes.to_user_id
+                        AND reverse.to_user_id = likes.from_user_id
+                    ) OR EXISTS (
+                        SELECT 1 FROM seen_profiles
+                        WHERE viewer_id = likes.to_user_id AND viewed_id = likes.from_user_id
+                    )
+                ''')
+                await conn.execute('''
+                    UPDATE user_stats SET likes_unread = (
+                        SELECT COUNT(*) FROM likes
+                        JOIN users ON users.user_id = likes.to_user_id
+                        WHERE likes.to_user_id = user_stats.user_id
+                        AND likes.to_epoch = users.epoch AND NOT likes.answered
+                    )
+                ''')
+            # Place profiles saved before cells existed by their city
+            rows = await conn.fetch("SELECT user_id, city, city_key FROM users WHERE cell = ''")
+            updates = []
+            for row in rows:
+                latitude, longitude = locate({'city': row['city']})
+                cell = area_cell(row['city_key'], latitude, longitude)
+                updates.append((latitude, longitude, cell, row['user_id']))
+            await conn.executemany(
+                'UPDATE users SET latitude = $1, longitude = $2, cell = $3 WHERE user_id = $4',
+                updates,
+            )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def save_user(self, user_data: Dict) -> bool:
+        city_key = normalize_city(user_data['city'])
+        latitude, longitude = locate(user_data)
+        try:
+            await self.pool.execute('''
+                INSERT INTO users
+                (user_id, name, age, city, gender, looking_gender,
+                 looking_age_min, looking_age_max, description, photo, is_active,
+                 city_key, rand_key, latitude, longitude, cell, username)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, TRUE, $11, $12, $13, $14, $15, $16)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    name = excluded.name,
+                    age = excluded.age,
+                    city = excluded.city,
+                    gender = excluded.gender,
+                    looking_gender = excluded.looking_gender,
+                    looking_age_min = excluded.looking_age_min,
+                    looking_age_max = excluded.looking_age_max,
+                    description = excluded.description,
+                    photo = excluded.photo,
+                    is_active = TRUE,
+                    deactivated_at = NULL,
+                    city_key = excluded.city_key,
+                    rand_key = excluded.rand_key,
+                    latitude = excluded.latitude,
+                    longitude = excluded.longitude,
+                    cell = excluded.cell,
+                    username = COALESCE(excluded.username, users.username)
+            ''',
+                user_data['user_id'],
+                user_data['name'],
+                user_data['age'],
+                user_data['city'],
+                user_data['gender'],
+                user_data['looking_gender'],
+                user_data['looking_age_min'],
+                user_data['looking_age_max'],
+                user_data['description'],
+                user_data.get('photo'),
+                city_key,
+                random.getrandbits(63),
+                latitude,
+                longitude,
+                area_cell(city_key, latitude, longitude),
+                user_data.get('username'),
+            )
+            await self.pool.execute(COUNT_SIGNUP, user_data['user_id'])
+            self.profiles.invalidate(user_data['user_id'])
+            return True
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        cached = self.profiles.get(user_id, _MISSING)
+        if cached is not _MISSING:
+            return dict(cached) if cached else None
+
+        generation = self.profiles.generation
+        try:
+            row = await self.pool.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return None
+        user = dict(row) if row else None
+        # Missing users are cached too, save_user invalidates them
+        self.profiles.set(user_id, user, generation)
+        return dict(user) if user else None
+
+    async def _set_active(self, user_id: int, active: bool) -> bool:
+        try:
+            result = await self.pool.execute('''
+                UPDATE users SET is_active = $2,
+                    deactivated_at = CASE WHEN $2 THEN NULL ELSE now() END
+                WHERE user_id = $1
+            ''', user_id, active)
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
+        self.profiles.invalidate(user_id)
+        return result != "UPDATE 0"
+
+    async def set_username(self, user_id: int, username: str) -> bool:
+        try:
+            result = await self.pool.execute(
+                'UPDATE users SET username = $2 WHERE user_id = $1 AND username IS DISTINCT FROM $2',
+                user_id, username,
+            )
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
+        changed = result != 'UPDATE 0'
+        if changed:
+            self.profiles.invalidate(user_id)
+        return changed
+
+    async def activate_user(self, user_id: int) -> bool:
+        return await self._set_active(user_id, True)
+
+    async def deactivate_user(self, user_id: int) -> bool:
+        return await self._set_active(user_id, False)
+
+    def _wanted_genders(self, user: Dict) -> Tuple[str, ...]:
+        if user['looking_gender'] == ANY_GENDER:
+            return GENDERS
+        return (user['looking_gender'],)
+
+    async def find_potential_matches(self, user_id: int, limit: int = 1,
+                                     exclude_ids: Iterable[int] = ()) -> List[Dict]:
+        user = await self.get_user(user_id)
+        if not user:
+            return []
+        exclude = list(set(exclude_ids))
+        area = search_area(user, self.radius_km)
+        try:
+            async with self.pool.acquire() as conn:
+                inbox = await self._walk_inbox(conn, user, area, limit, exclude)
+                if len(inbox) == limit:
+                    return inbox
+                exclude += [candidate['user_id'] for candidate in inbox]
+                return inbox + await self._find_new(conn, user, area, limit - len(inbox), exclude)
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return []
+
+    async def _find_new(self, conn, user: Dict, area: SearchArea, limit: int,
+                        exclude: List[int]) -> List[Dict]:
+        # Start at a random point of each (cell, gender) slice of the rand_key
+        # index and walk forward, wrapping around to the beginning
+        pivot = random.getrandbits(63)
+        # With ranking, a bigger random pool is fetched and the best of it kept
+        pool = limit if self.ranker is None else limit * self.ranker.pool
+        candidates = []
+        for cell in area.cells:
+            for gender in self._wanted_genders(user):
+                found = await self._walk_slice(conn, user, area, cell, gender, pivot,
+                                               MAX_RAND_KEY, pool, exclude)
+                if len(found) < pool and pivot > 0:
+                    found += await self._walk_slice(conn, user, area, cell, gender, 0,
+                                                    pivot - 1, pool - len(found), exclude)
+                candidates.extend(found)
+
+        candidates.sort(key=lambda c: (c['rand_key'] - pivot) % (1 << 63))
+        candidates = candidates[:pool]
+        if self.ranker is None or not candidates:
+            return candidates[:limit]
+        rows = await conn.fetch('''
+            SELECT user_id, last_active_at, views_given, likes_given, views_received
+            FROM user_stats WHERE user_id = ANY($1::BIGINT[])
+        ''', [candidate['user_id'] for candidate in candidates])
+        stats = {row['user_id']: UserStats(*tuple(row)[1:]) for row in rows}
+        return self.ranker.top(candidates, stats, limit)
+
+    async def _walk_inbox(self, conn, user: Dict, area: SearchArea, limit: int,
+                          exclude: List[int]) -> List[Dict]:
+        """Profiles whose unanswered like to the user is current, oldest first
+
+        Likes from profiles the user had already seen are answered when they
+        are written, so every row the filters let through is waiting. If
+        they all fit in one page, likes_unread is set to their number.
+        """
+        in_area, area_params = area_condition(area, 11)
+        page = limit + len(exclude)
+        rows = await conn.fetch(f'''
+            SELECT users.* FROM likes
+            JOIN users ON users.user_id = likes.from_user_id
+            WHERE likes.to_user_id = $1 AND likes.to_epoch = $2 AND NOT likes.answered
+            AND likes.from_epoch = users.epoch
+            AND cell = ANY($3::TEXT[])
+            AND is_active
+            AND gender = ANY($4::TEXT[])
+            AND age BETWEEN $5 AND $6
+            AND looking_gender IN ($7, $8) AND $9 BETWEEN looking_age_min AND looking_age_max
+            AND {NOT_LIKED_OR_SEEN}
+            {in_area}
+            ORDER BY likes.id
+            LIMIT $10
+        ''', user['user_id'], user['epoch'], list(area.cells), list(self._wanted_genders(user)),
+            user['looking_age_min'], user['looking_age_max'], user['gender'], ANY_GENDER,
+            user['age'], page, *area_params)
+        if len(rows) < page:
+            # Corrects the counter for likes hidden by a fresh start or deactivation
+            await conn.execute(
+                'UPDATE user_stats SET likes_unread = $2 WHERE user_id = $1 AND likes_unread <> $2',
+                user['user_id'], len(rows),
+            )
+        skip = set(exclude)
+        found = [dict(row, likes_you=True) for row in rows if row['user_id'] not in skip]
+        return found[:limit]
+
+    async def _walk_slice(self, conn, user: Dict, area: SearchArea, cell: str, gender: str,
+                          lower: int, upper: int, limit: int, exclude: List[int]) -> List[Dict]:
+        in_area, area_params = area_condition(area, 14)
+        rows = await conn.fetch(f'''
+            SELECT * FROM users
+            WHERE cell = $3
+            AND is_active
+            AND gender = $4
+            AND rand_key BETWEEN $5 AND $6
+            AND age BETWEEN $7 AND $8
+            AND looking_gender IN ($11, $12) AND $13 BETWEEN looking_age_min AND looking_age_max
+            AND user_id <> $1
+            AND user_id <> ALL($9::BIGINT[])
+            AND {NOT_LIKED_OR_SEEN}
+            {in_area}
+            ORDER BY rand_key
+            LIMIT $10
+        ''', user['user_id'], user['epoch'], cell, gender, lower, upper,
+            user['looking_age_min'], user['looking_age_max'], exclude, limit,
+            user['gender'], ANY_GENDER, user['age'], *area_params)
+        return [dict(row) for row in rows]
+
+    async def get_candidates(self, viewer_id: int, candidate_ids: Iterable[int]) -> Dict[int, Dict]:
+        user = await self.get_user(viewer_id)
+        ids = list(candidate_ids)
+        if not user or not ids:
+            return {}
+        area = search_area(user, self.radius_km)
+        in_area, area_params = area_condition(area, 11)
+        try:
+            rows = await self.pool.fetch(f'''
+                SELECT *, EXISTS (
+                    SELECT 1 FROM likes
+                    WHERE from_user_id = users.user_id AND to_user_id = $1
+                    AND from_epoch = users.epoch AND to_epoch = $2
+                ) AS likes_you
+                FROM users
+                WHERE user_id = ANY($3::BIGINT[])
+                AND cell = ANY($4::TEXT[])
+                AND is_active
+                AND gender = ANY($5::TEXT[])
+                AND age BETWEEN $6 AND $7
+                AND looking_gender IN ($8, $9) AND $10 BETWEEN looking_age_min AND looking_age_max
+                AND {NOT_LIKED_OR_SEEN}
+                {in_area}
+            ''', viewer_id, user['epoch'], ids, list(area.cells),
+                list(self._wanted_genders(user)), user['looking_age_min'], user['looking_age_max'],
+                user['gender'], ANY_GENDER, user['age'], *area_params)
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return {}
+        return {row['user_id']: dict(row) for row in rows}
+
+    async def add_like(self, from_user_id: int, to_user_id: int) -> bool:
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    # The reciprocal like has either committed already or waits for this one
+                    await conn.execute(
+                        'SELECT pg_advisory_xact_lock($1)', pair_lock_key(from_user_id, to_user_id)
+                    )
+                    like = await conn.fetchrow(INSERT_LIKE, from_user_id, to_user_id)
+                    if like is None:
+                        # Already liked at these epochs
+                        return False
+                    await conn.execute(COUNT_LIKE, from_user_id, to_user_id,
+                                       0 if like['answered'] else 1)
+                    from_epoch, to_epoch = like['from_epoch'], like['to_epoch']
+                    if from_user_id < to_user_id:
+                        pair = (from_user_id, to_user_id, from_epoch, to_epoch)
+                    else:
+                        pair = (to_user_id, from_user_id, to_epoch, from_epoch)
+                    created = await conn.fetchval(
+                        INSERT_MATCH_IF_MUTUAL, *pair,
+                        to_user_id, from_user_id, to_epoch, from_epoch,
+                    )
+                    if created is None:
+                        return False
+                    await conn.execute(ANSWER_MATCH, from_user_id, to_user_id)
+                    return True
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
+
+    async def add_viewed_profile(self, viewer_id: int, viewed_id: int) -> bool:
+        try:
+            await self.pool.execute(INSERT_VIEW, viewer_id, viewed_id)
+            return True
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
+
+    async def count_unread_likes(self, user_id: int) -> int:
+        try:
+            count = await self.pool.fetchval(
+                'SELECT likes_unread FROM user_stats WHERE user_id = $1', user_id
+            )
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return 0
+        return count or 0
+
+    async def get_matches(self, user_id: int, limit: Optional[int] = None,
+                          before: Optional[int] = None, after: Optional[int] = None) -> List[Dict]:
+        order = 'ASC' if after is not None and before is None else 'DESC'
+        side = f'''
+            (SELECT m.id AS match_id, u.* FROM matches m
+             JOIN users u ON u.user_id = m.{{other}}_id AND u.epoch = m.epoch{{other_n}}
+             WHERE m.{{me}}_id = $1 AND m.epoch{{me_n}} = (SELECT epoch FROM users WHERE user_id = $1)
+             AND m.id > $2 AND m.id < $3 AND u.is_active
+             ORDER BY m.id {order} LIMIT $4)
+        '''
+        try:
+            # Only matches made at both users' current epochs
+            rows = await self.pool.fetch(f'''
+                {side.format(me='user1', me_n=1, other='user2', other_n=2)}
+                UNION ALL
+                {side.format(me='user2', me_n=2, other='user1', other_n=1)}
+                ORDER BY match_id {order} LIMIT $4
+            ''', user_id, 0 if after is None else after,
+                MAX_ROWID if before is None else before, limit)
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return []
+        matches = [dict(row) for row in rows]
+        return matches[::-1] if order == 'ASC' else matches
+
+    async def reset_viewed_profiles(self, user_id: int) -> bool:
+        try:
+            await self.pool.execute('DELETE FROM seen_profiles WHERE viewer_id = $1', user_id)
+            return True
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
+
+    async def _start_epochs(self, conn, user_ids: List[int]):
+        """Move users to a new epoch and drop the profiles they have seen"""
+        await conn.execute(
+            'UPDATE users SET epoch = epoch + 1 WHERE user_id = ANY($1::BIGINT[])', user_ids
+        )
+        await conn.execute(
+            'DELETE FROM seen_profiles WHERE viewer_id = ANY($1::BIGINT[])', user_ids
+        )
+        # Likes to the old epoch are gone from the inbox
+        await conn.execute(
+            'UPDATE user_stats SET likes_unread = 0 WHERE user_id = ANY($1::BIGINT[])', user_ids
+        )
+
+    async def clear_all_user_interactions(self, user_id: int) -> bool:
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await self._start_epochs(conn, [user_id])
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
+        self.profiles.invalidate(user_id)
+        return True
+
+    async def retire_inactive_users(self, days: float, batch_size: int = 1000) -> Tuple[int, bool]:
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    rows = await conn.fetch('''
+                        SELECT user_id FROM users
+                        WHERE NOT is_active AND deactivated_at < now() - $1::FLOAT8 * INTERVAL '1 day'
+                        LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    ''', float(days), batch_size)
+                    user_ids = [row['user_id'] for row in rows]
+                    await self._start_epochs(conn, user_ids)
+                    # Retired once, until the next deactivation
+                    await conn.execute(
+                        'UPDATE users SET deactivated_at = NULL WHERE user_id = ANY($1::BIGINT[])',
+                        user_ids,
+                    )
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return 0, False
+        for user_id in user_ids:
+            self.profiles.invalidate(user_id)
+        return len(user_ids), len(user_ids) == batch_size
+
+    async def compact_interactions(self, batch_size: int = 1000) -> Tuple[int, bool]:
+        """Delete likes, matches and views hidden by new epochs, a batch per table"""
+        stale_like = '''
+            from_epoch <> COALESCE((SELECT epoch FROM users WHERE user_id = from_user_id), 0)
+            OR to_epoch <> COALESCE((SELECT epoch FROM users WHERE user_id = to_user_id), 0)
+        '''
+        stale_match = '''
+            epoch1 <> COALESCE((SELECT epoch FROM users WHERE user_id = user1_id), 0)
+            OR epoch2 <> COALESCE((SELECT epoch FROM users WHERE user_id = user2_id), 0)
+        '''
+        stale_view = '''
+            viewed_epoch <> COALESCE((SELECT epoch FROM users WHERE user_id = viewed_id), 0)
+        '''
+        positions = self._compact_position
+        removed = 0
+        try:
+            async with self.pool.acquire() as conn:
+                for table, key, stale in (('likes', 'id', stale_like),
+                                          ('matches', 'id', stale_match),
+                                          ('seen_profiles', 'viewer_id', stale_view)):
+                    if positions[table] is not None:
+                        removed += await self._compact_range(conn, table, key, stale, batch_size)
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return removed, False
+
+        if all(position is None for position in positions.values()):
+            self._compact_position = dict.fromkeys(positions, 0)
+            return removed, False
+        return removed, True
+
+    async def _compact_range(self, conn, table: str, key: str, stale: str,
+                             batch_size: int) -> int:
+        """Delete stale rows among the next ``batch_size`` keys of a table"""
+        position = self._compact_position[table]
+        last, count = await conn.fetchrow(f'''
+            SELECT MAX({key}), COUNT(*) FROM (
+                SELECT DISTINCT {key} FROM {table} WHERE {key} > $1 ORDER BY {key} LIMIT $2
+            ) batch
+        ''', position, batch_size)
+        if last is None:
+            self._compact_position[table] = None
+            return 0
+        result = await conn.execute(
+            f'DELETE FROM {table} WHERE {key} > $1 AND {key} <= $2 AND ({stale})', position, last
+        )
+        # Done for this pass once the end of the table is reached
+        self._compact_position[table] = last if count == batch_size else None
+        return int(result.split()[-1])
+
+    async def analyze(self, table: str, analysis_limit: int = 1000) -> bool:
+        """Refresh planner statistics (autovacuum does this too, on its own schedule)"""
+        if table not in self.tables:
+            return False
+        try:
+            await self.pool.execute(f'ANALYZE {table}')
+            return True
+        except asyncpg.PostgresError as e:
+            print(f"Database error: {e}")
+            return False
@@ -0,0 +1,82 @@
+import heapq
+import random
+import time
+from typing import Dict, List, Optional
+
+
+class UserStats:
+    """Swipe counters of one user, from the user_stats table
+
+    Storages bump them as part of every view and like, so ranking reads one
+    row per candidate instead of counting likes or views.
+    """
+
+    __slots__ = ("last_active_at", "views_given", "likes_given", "views_received")
+
+    def __init__(self, last_active_at: float = 0.0, views_given: int = 0,
+                 likes_given: int = 0, views_received: int = 0):
+        # Unix time of the user's last registration, view or like
+        self.last_active_at = last_active_at
+        self.views_given = views_given
+        self.likes_given = likes_given
+        self.views_received = views_received
+
+
+NO_STATS = UserStats()
+
+
+class Ranker:
+    """Orders filtered candidates by a weighted score, best first
+
+    Storages fetch ``pool`` candidates per slot they serve and keep the
+    ``limit`` best with a heap. Each signal is in [0, 1]:
+
+    - activity: 1 right after the candidate's last view or like, halving
+      every ``half_life`` seconds, so dormant profiles sink
+    - like_back: share of the profiles they were shown that the candidate
+      liked, smoothed towards 1/2 (no history) by one like and one skip
+    - exposure: 1 for a profile nobody has seen, 1/2 once it has been shown
+      ``exposure_scale`` times, so attention is spread out
+    - random: noise, so profiles with equal scores don't always come in the
+      same order
+
+    This ranks a random sample rather than every profile that passes the
+    filters. Candidate queries start at a random point of the rand_key
+    index, so their cost doesn't grow with the number of matching profiles;
+    a heap over the whole filtered set would read all of them on every
+    query. The price is that in a large slice the best profile is only
+    served first when it falls into the sample, so ranking nudges a random
+    order rather than replacing it. A bigger ``pool`` orders more strongly
+    and reads proportionally more rows. Slices no bigger than the pool are
+    ranked in full.
+    """
+
+    def __init__(self, pool: int = 3, activity: float = 1.0, like_back: float = 1.0,
+                 exposure: float = 0.5, jitter: float = 0.1,
+                 half_life: float = 72 * 3600.0, exposure_scale: float = 100.0,
+                 seed: Optional[int] = None):
+        self.pool = max(1, pool)
+        self.activity = activity
+        self.like_back = like_back
+        self.exposure = exposure
+        self.jitter = jitter
+        self.half_life = half_life
+        self.exposure_scale = exposure_scale
+        self._rng = random.Random(seed)
+
+    def score(self, stats: UserStats, now: float) -> float:
+        idle = max(0.0, now - stats.last_active_at)
+        return (
+            self.activity * 0.5 ** (idle / self.half_life)
+            + self.like_back * (stats.likes_given + 1) / (stats.views_given + 2)
+            + self.exposure * self.exposure_scale / (self.exposure_scale + stats.views_received)
+            + self.jitter * self._rng.random()
+        )
+
+    def top(self, candidates: List[Dict], stats: Dict[int, UserStats], limit: int,
+            now: Optional[float] = None) -> List[Dict]:
+        """The ``limit`` best candidates, in order"""
+        now = time.time() if now is None else now
+        scored = ((self.score(stats.get(candidate['user_id'], NO_STATS), now), i, candidate)
+                  for i, candidate in enumerate(candidates))
+        return [candidate for _, _, candidate in heapq.nlargest(limit, scored)]
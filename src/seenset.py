@@ -0,0 +1,99 @@
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import accumulate
+from operator import sub
+from typing import Iterable, Iterator
+
+_RAW = 0
+_ZLIB = 1
+
+# Seen sets hold seen_key(user_id, epoch), so a profile seen before its
+# owner's fresh start doesn't count as seen any more. Telegram user ids have
+# at most 52 significant bits, which leaves 11 bits of the int64 for the
+# epoch. Epochs wrap after 2048 fresh starts, long after compaction has
+# dropped keys from old epochs.
+USER_ID_BITS = 52
+EPOCH_BITS = 63 - USER_ID_BITS
+EPOCH_MASK = (1 << EPOCH_BITS) - 1
+
+
+def seen_key(user_id: int, epoch: int) -> int:
+    """Seen set entry for a profile at the given epoch"""
+    if not 0 <= user_id < 1 << USER_ID_BITS:
+        raise ValueError(f"user id {user_id} doesn't fit in {USER_ID_BITS} bits")
+    return (user_id << EPOCH_BITS) | (epoch & EPOCH_MASK)
+
+
+class SeenSet:
+    """Sorted, duplicate-free array of int64 keys with a compact BLOB encoding
+
+    On disk the ids are delta-encoded (first id, then gaps) as little-endian
+    int64 and, for sets bigger than ``COMPRESS_MIN`` ids, zlib-compressed.
+    That takes a few bytes per id instead of a table row plus index entry per
+    pair. The first byte of the encoding says whether it is compressed.
+    """
+
+    COMPRESS_MIN = 64
+
+    __slots__ = ("ids",)
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.ids = array("q", sorted(set(ids)))
+
+    @classmethod
+    def _from_sorted(cls, ids: array) -> "SeenSet":
+        seen = cls.__new__(cls)
+        seen.ids = ids
+        return seen
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SeenSet":
+        deltas = array("q")
+        if data:
+            payload = data[1:]
+            deltas.frombytes(zlib.decompress(payload) if data[0] == _ZLIB else payload)
+            if sys.byteorder == "big":
+                deltas.byteswap()
+        return cls._from_sorted(array("q", accumulate(deltas)))
+
+    def to_bytes(self) -> bytes:
+        ids = self.ids
+        if not ids:
+            return b""
+        deltas = array("q", ids[:1])
+        deltas.extend(map(sub, ids[1:], ids[:-1]))
+        if sys.byteorder == "big":
+            deltas.byteswap()
+        # Compressing tiny sets costs more time than it saves space
+        if len(ids) < self.COMPRESS_MIN:
+            return bytes((_RAW,)) + deltas.tobytes()
+        return bytes((_ZLIB,)) + zlib.compress(deltas.tobytes())
+
+    def __contains__(self, user_id: int) -> bool:
+        i = bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def union(self, other: Iterable[int]) -> "SeenSet":
+        """New set with the ids of both (other need not be sorted)"""
+        other = sorted(set(other))
+        merged = array("q")
+        last = None
+        for user_id in merge(self.ids, other):
+            if user_id != last:
+                merged.append(user_id)
+                last = user_id
+        return SeenSet._from_sorted(merged)
+
+    def difference(self, other: Iterable[int]) -> "SeenSet":
+        """New set without the given ids"""
+        other = set(other)
+        return SeenSet._from_sorted(array("q", (i for i in self.ids if i not in other)))
@@ -0,0 +1,115 @@
+import os
+
+# Tunables, overridable from the environment
+DB_NAME = os.getenv("SOULMATE_DB_NAME", "soulmate.db")
+DB_WORKERS = int(os.getenv("SOULMATE_DB_WORKERS", "4"))
+
+# Located profiles (shared location, or a city the bundled gazetteer knows) see each other
+# within this distance; other profiles only see their own city
+GEO_RADIUS_KM = float(os.getenv("SOULMATE_GEO_RADIUS_KM", "50"))
+
+# Candidates fetched per matching query, and the queue length that triggers a refill
+CANDIDATE_BATCH = int(os.getenv("SOULMATE_CANDIDATE_BATCH", "20"))
+CANDIDATE_LOW_WATER = int(os.getenv("SOULMATE_CANDIDATE_LOW_WATER", "5"))
+# Seconds after which queued candidates are re-read (in one query) before the next is served
+CANDIDATE_RECHECK = float(os.getenv("SOULMATE_CANDIDATE_RECHECK", "30"))
+
+# Candidate ranking: RANK_POOL random filtered candidates are fetched per one served (1 keeps
+# the random order) and the best are kept by recent activity, how often they like back and
+# how little they have been shown. Only that sample is ranked, see ranking.Ranker; signal
+# weights, activity half-life and views that halve the exposure score
+RANK_POOL = int(os.getenv("SOULMATE_RANK_POOL", "3"))
+RANK_WEIGHT_ACTIVITY = float(os.getenv("SOULMATE_RANK_WEIGHT_ACTIVITY", "1"))
+RANK_WEIGHT_LIKE_BACK = float(os.getenv("SOULMATE_RANK_WEIGHT_LIKE_BACK", "1"))
+RANK_WEIGHT_EXPOSURE = float(os.getenv("SOULMATE_RANK_WEIGHT_EXPOSURE", "0.5"))
+RANK_WEIGHT_RANDOM = float(os.getenv("SOULMATE_RANK_WEIGHT_RANDOM", "0.1"))
+RANK_ACTIVITY_HALF_LIFE_HOURS = float(os.getenv("SOULMATE_RANK_ACTIVITY_HALF_LIFE_HOURS", "72"))
+RANK_EXPOSURE_SCALE = float(os.getenv("SOULMATE_RANK_EXPOSURE_SCALE", "100"))
+
+# Matches listed per page of /matches
+MATCHES_PAGE_SIZE = int(os.getenv("SOULMATE_MATCHES_PAGE_SIZE", "10"))
+
+# Buffer swipes and write them in batches (flush every FLUSH_INTERVAL_MS or FLUSH_BATCH events)
+WRITE_BEHIND = os.getenv("SOULMATE_WRITE_BEHIND", "1") == "1"
+FLUSH_INTERVAL_MS = int(os.getenv("SOULMATE_FLUSH_INTERVAL_MS", "50"))
+FLUSH_BATCH = int(os.getenv("SOULMATE_FLUSH_BATCH", "500"))
+
+# Where profiles, likes and matches live: "sqlite" (DB_NAME), or "postgres" (needs asyncpg).
+# POSTGRES_SCHEMA is created if missing and used as the search_path
+STORAGE = os.getenv("SOULMATE_STORAGE", "sqlite")
+POSTGRES_DSN = os.getenv("SOULMATE_POSTGRES_DSN", "postgresql://localhost/soulmate")
+POSTGRES_SCHEMA = os.getenv("SOULMATE_POSTGRES_SCHEMA", "")
+POSTGRES_POOL_MIN = int(os.getenv("SOULMATE_POSTGRES_POOL_MIN", "2"))
+POSTGRES_POOL_MAX = int(os.getenv("SOULMATE_POSTGRES_POOL_MAX", "10"))
+
+# In-process profile cache
+PROFILE_CACHE_SIZE = int(os.getenv("SOULMATE_PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("SOULMATE_PROFILE_CACHE_TTL", "300"))
+
+# Telegram @usernames kept in memory in front of the users table
+USERNAME_CACHE_SIZE = int(os.getenv("SOULMATE_USERNAME_CACHE_SIZE", "10000"))
+USERNAME_CACHE_TTL = float(os.getenv("SOULMATE_USERNAME_CACHE_TTL", "3600"))
+
+# Conversation state: "memory" or "sqlite" (states and drafts survive restarts), idle eviction and cap
+STATE_BACKEND = os.getenv("SOULMATE_STATE_BACKEND", "memory")
+STATE_IDLE_TIMEOUT = float(os.getenv("SOULMATE_STATE_IDLE_TIMEOUT", str(24 * 3600)))
+STATE_MAX_ENTRIES = int(os.getenv("SOULMATE_STATE_MAX_ENTRIES", "100000"))
+
+# Candidate selection: "sql", or "numpy" for the experimental in-memory matching engine
+# (slower than SQL in scripts/bench_swipes.py, see the README)
+MATCH_ENGINE = os.getenv("SOULMATE_MATCH_ENGINE", "sql")
+
+# Outbound messages: sends per second overall and per chat (with burst), and queue bound
+OUTBOX_GLOBAL_RATE = float(os.getenv("SOULMATE_OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("SOULMATE_OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = float(os.getenv("SOULMATE_OUTBOX_CHAT_BURST", "5"))
+OUTBOX_MAX_QUEUED = int(os.getenv("SOULMATE_OUTBOX_MAX_QUEUED", "5000"))
+
+# Check the prefetched candidate's photo file_id with get_file (one extra API call per profile)
+PREFETCH_CHECK_PHOTOS = os.getenv("SOULMATE_PREFETCH_CHECK_PHOTOS", "0") == "1"
+
+# Updates handled in parallel (a user's own updates are always handled in order)
+CONCURRENT_UPDATES = int(os.getenv("SOULMATE_CONCURRENT_UPDATES", "16"))
+
+# "polling", or "webhook" to receive updates on an embedded HTTP server
+MODE = os.getenv("SOULMATE_MODE", "polling")
+WEBHOOK_HOST = os.getenv("SOULMATE_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("SOULMATE_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("SOULMATE_WEBHOOK_PATH", "/telegram")
+# Secret Telegram sends in X-Telegram-Bot-Api-Secret-Token (1-256 of A-Z, a-z, 0-9, _ and -)
+WEBHOOK_SECRET = os.getenv("SOULMATE_WEBHOOK_SECRET", "")
+# Public URL to register with setWebhook on startup; leave empty to manage it yourself
+WEBHOOK_URL = os.getenv("SOULMATE_WEBHOOK_URL", "")
+
+# Worker processes started by launcher.py, and the first local port they listen on
+WORKERS = int(os.getenv("SOULMATE_WORKERS", "1"))
+WORKER_BASE_PORT = int(os.getenv("SOULMATE_WORKER_BASE_PORT", "9001"))
+# Likes can only be buffered when a single process checks for matches
+BUFFER_LIKES = os.getenv("SOULMATE_BUFFER_LIKES", "1" if WORKERS == 1 else "0") == "1"
+# How often the numpy engine picks up profile changes made by other workers
+ENGINE_SYNC_INTERVAL = float(os.getenv("SOULMATE_ENGINE_SYNC_INTERVAL", "2"))
+
+# Background maintenance, on in one worker only under launcher.py. Per job: seconds between
+# runs (0 turns it off) and the time budget of a run; rows handled per step
+MAINTENANCE = os.getenv("SOULMATE_MAINTENANCE", "1") == "1"
+MAINTENANCE_BATCH = int(os.getenv("SOULMATE_MAINTENANCE_BATCH", "1000"))
+# GC: likes, matches and seen entries hidden by fresh starts, interactions of profiles
+# deactivated over GC_INACTIVE_DAYS ago (0 keeps them), and old profile change log entries
+GC_INTERVAL = float(os.getenv("SOULMATE_GC_INTERVAL", "30"))
+GC_BUDGET = float(os.getenv("SOULMATE_GC_BUDGET", "0.25"))
+GC_INACTIVE_DAYS = float(os.getenv("SOULMATE_GC_INACTIVE_DAYS", "90"))
+PROFILE_LOG_KEEP = int(os.getenv("SOULMATE_PROFILE_LOG_KEEP", "10000"))
+# Incremental vacuum, VACUUM_PAGES free pages per step
+VACUUM_INTERVAL = float(os.getenv("SOULMATE_VACUUM_INTERVAL", "300"))
+VACUUM_BUDGET = float(os.getenv("SOULMATE_VACUUM_BUDGET", "0.1"))
+VACUUM_PAGES = int(os.getenv("SOULMATE_VACUUM_PAGES", "256"))
+# Query planner statistics, one table per step
+ANALYZE_INTERVAL = float(os.getenv("SOULMATE_ANALYZE_INTERVAL", "3600"))
+ANALYZE_BUDGET = float(os.getenv("SOULMATE_ANALYZE_BUDGET", "2"))
+# Passive WAL checkpoints
+CHECKPOINT_INTERVAL = float(os.getenv("SOULMATE_CHECKPOINT_INTERVAL", "60"))
+CHECKPOINT_BUDGET = float(os.getenv("SOULMATE_CHECKPOINT_BUDGET", "1"))
+# Seconds between printing this worker's counters: per-user state, prefetches, outbox,
+# maintenance
+# (0 turns it off)
+STATS_INTERVAL = float(os.getenv("SOULMATE_STATS_INTERVAL", "300"))
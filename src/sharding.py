@@ -0,0 +1,28 @@
+import hashlib
+from bisect import bisect
+from typing import Dict, Hashable, List, Sequence
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of keys (user ids) onto nodes (workers)
+
+    Each node gets ``replicas`` points on the ring so keys spread evenly, and
+    adding or removing a node only moves the keys of that node's points.
+    """
+
+    def __init__(self, nodes: Sequence[Hashable], replicas: int = 128):
+        self.nodes = list(nodes)
+        points: Dict[int, Hashable] = {}
+        for node in self.nodes:
+            for replica in range(replicas):
+                points[_hash(f"{node}:{replica}")] = node
+        self._keys: List[int] = sorted(points)
+        self._nodes = [points[key] for key in self._keys]
+
+    def node_for(self, key: Hashable) -> Hashable:
+        index = bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._nodes[index]
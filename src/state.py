@@ -0,0 +1,270 @@
+import asyncio
+import functools
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from connection import ConnectionPool
+
+
+class RegistrationDraft:
+    """Answers collected so far during registration"""
+
+    __slots__ = (
+        "name",
+        "age",
+        "city",
+        "gender",
+        "looking_gender",
+        "looking_age_min",
+        "looking_age_max",
+        "description",
+        "photo",
+        "latitude",
+        "longitude",
+    )
+
+    # Only set when the user shared a location or named a known city
+    OPTIONAL = ("latitude", "longitude")
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    def is_complete(self) -> bool:
+        return all(
+            getattr(self, field) is not None
+            for field in self.__slots__ if field not in self.OPTIONAL
+        )
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "RegistrationDraft":
+        return cls(**data)
+
+
+def _record_size(record) -> int:
+    """Approximate bytes held by a __slots__ record and its values"""
+    size = sys.getsizeof(record)
+    for field in getattr(record, "__slots__", ()):
+        size += sys.getsizeof(getattr(record, field, None))
+    return size
+
+
+class MemoryBackend:
+    """Records kept in process memory, least recently used first"""
+
+    in_memory = True
+
+    def __init__(self):
+        self._records: "OrderedDict[int, tuple]" = OrderedDict()
+
+    def get(self, user_id: int, now: float):
+        entry = self._records.get(user_id)
+        if entry is None:
+            return None
+        self._records[user_id] = (now, entry[1])
+        self._records.move_to_end(user_id)
+        return entry[1]
+
+    def put(self, user_id: int, record, now: float):
+        self._records[user_id] = (now, record)
+        self._records.move_to_end(user_id)
+
+    def delete(self, user_id: int):
+        self._records.pop(user_id, None)
+
+    def expire(self, cutoff: float, max_entries: int) -> int:
+        """Drop records idle since before ``cutoff`` and the oldest above the cap"""
+        evicted = 0
+        while self._records:
+            user_id, (last_used, _) = next(iter(self._records.items()))
+            if last_used >= cutoff and len(self._records) <= max_entries:
+                break
+            del self._records[user_id]
+            evicted += 1
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def bytes_used(self) -> int:
+        return sum(_record_size(record) for _, record in self._records.values())
+
+
+class SqliteBackend:
+    """Records stored as JSON in SQLite, so they survive restarts"""
+
+    in_memory = False
+
+    def __init__(self, db_name: str, table: str = "conversation_state",
+                 record_type=RegistrationDraft):
+        self.pool = ConnectionPool(db_name)
+        self.table = table
+        self.record_type = record_type
+        with self.pool.connection() as conn:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_{table}_updated_at
+                ON {table} (updated_at)
+            ''')
+
+    def get(self, user_id: int, now: float):
+        # Reads don't touch updated_at: records idle out from their last write
+        row = self.pool.connection().execute(
+            f'SELECT data FROM {self.table} WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return self.record_type.from_dict(json.loads(row[0]))
+
+    def put(self, user_id: int, record, now: float):
+        with self.pool.connection() as conn:
+            conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (user_id, data, updated_at) VALUES (?, ?, ?)',
+                (user_id, json.dumps(record.to_dict()), now)
+            )
+
+    def delete(self, user_id: int):
+        with self.pool.connection() as conn:
+            conn.execute(f'DELETE FROM {self.table} WHERE user_id = ?', (user_id,))
+
+    def expire(self, cutoff: float, max_entries: int) -> int:
+        with self.pool.connection() as conn:
+            evicted = conn.execute(
+                f'DELETE FROM {self.table} WHERE updated_at < ?', (cutoff,)
+            ).rowcount
+            evicted += conn.execute(f'''
+                DELETE FROM {self.table} WHERE user_id IN (
+                    SELECT user_id FROM {self.table}
+                    ORDER BY updated_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,)).rowcount
+        return evicted
+
+    def __len__(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def bytes_used(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute(
+                f'SELECT COALESCE(SUM(LENGTH(data)), 0) FROM {self.table}'
+            ).fetchone()[0]
+
+    def close(self):
+        self.pool.close()
+
+
+class StateStore:
+    """Per-user conversation state with idle-timeout eviction and a size cap"""
+
+    def __init__(self, backend=None, idle_timeout: float = 24 * 3600,
+                 max_entries: int = 100000, prune_interval: float = 60.0):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+        # Wall-clock time so SQLite timestamps stay valid across restarts
+        self._clock = time.time
+
+    def get(self, user_id: int):
+        with self._lock:
+            self._maybe_prune()
+            return self.backend.get(user_id, self._clock())
+
+    def put(self, user_id: int, record):
+        with self._lock:
+            self.backend.put(user_id, record, self._clock())
+            self._maybe_prune()
+
+    def pop(self, user_id: int):
+        with self._lock:
+            self.backend.delete(user_id)
+
+    def prune(self) -> int:
+        """Evict idle entries and anything above the cap"""
+        with self._lock:
+            return self._prune()
+
+    def _maybe_prune(self):
+        if time.monotonic() - self._last_prune >= self.prune_interval:
+            self._prune()
+        # Counting is free in memory; disk backends are only capped periodically
+        elif self.backend.in_memory and len(self.backend) > self.max_entries:
+            self._prune()
+
+    def _prune(self) -> int:
+        self._last_prune = time.monotonic()
+        evicted = self.backend.expire(self._clock() - self.idle_timeout, self.max_entries)
+        self.evicted += evicted
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        """Live entries, approximate bytes held and evictions so far"""
+        with self._lock:
+            return {
+                "entries": len(self.backend),
+                "bytes": self.backend.bytes_used(),
+                "evicted": self.evicted,
+            }
+
+    def close(self):
+        close = getattr(self.backend, "close", None)
+        if close:
+            close()
+
+
+class AsyncStateStore:
+    """Async facade over a StateStore
+
+    Calls to disk backends run on a thread pool, so their SQLite statements
+    stay off the event loop; in-memory backends are called directly.
+    """
+
+    def __init__(self, store: StateStore, max_workers: int = 2):
+        self.store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="state"
+        )
+
+    async def _run(self, func, *args):
+        if self.store.backend.in_memory:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def get(self, user_id: int):
+        return await self._run(self.store.get, user_id)
+
+    async def put(self, user_id: int, record):
+        await self._run(self.store.put, user_id, record)
+
+    async def pop(self, user_id: int):
+        await self._run(self.store.pop, user_id)
+
+    async def prune(self) -> int:
+        return await self._run(self.store.prune)
+
+    async def stats(self) -> Dict[str, int]:
+        return await self._run(self.store.stats)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.store.close()
@@ -0,0 +1,131 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class Storage(ABC):
+    """Async interface the bot uses to store profiles, swipes and matches
+
+    AsyncDatabase (SQLite) and PostgresStorage implement it, and
+    scripts/storage_conformance.py checks that they behave the same.
+    Maintenance steps a backend has no use for keep the defaults here,
+    which do nothing.
+    """
+
+    # Tables whose planner statistics the analyze job refreshes
+    tables: Tuple[str, ...] = ()
+
+    # In-memory matching engine, if the backend has one
+    engine = None
+
+    async def start(self):
+        """Connect and create the schema; called once the event loop runs"""
+
+    @abstractmethod
+    async def close(self):
+        """Finish pending writes and release connections"""
+
+    @abstractmethod
+    async def save_user(self, user_data: Dict) -> bool:
+        """Create or replace a profile (activating it)"""
+
+    @abstractmethod
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        """Profile as a dict of users columns, or None"""
+
+    async def user_exists(self, user_id: int) -> bool:
+        return await self.get_user(user_id) is not None
+
+    @abstractmethod
+    async def set_username(self, user_id: int, username: str) -> bool:
+        """Store the user's Telegram @username ('' for none); True if it changed"""
+
+    @abstractmethod
+    async def activate_user(self, user_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    async def deactivate_user(self, user_id: int) -> bool:
+        pass
+
+    async def is_user_active(self, user_id: int) -> bool:
+        user = await self.get_user(user_id)
+        return bool(user and user['is_active'])
+
+    @abstractmethod
+    async def find_potential_matches(self, user_id: int, limit: int = 1,
+                                     exclude_ids: Iterable[int] = ()) -> List[Dict]:
+        """Active profiles the user wants to see and hasn't seen or liked
+
+        Profiles whose like the user hasn't answered come first, with
+        ``likes_you`` set.
+        """
+
+    @abstractmethod
+    async def get_candidates(self, viewer_id: int, candidate_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Fresh profiles of queued candidates by id, in one query; those that no
+        longer qualify are left out
+
+        ``likes_you`` says whether the candidate's like to the viewer is current.
+        """
+
+    async def get_candidate(self, viewer_id: int, candidate_id: int) -> Optional[Dict]:
+        """Fresh profile of a queued candidate, or None if they no longer qualify"""
+        return (await self.get_candidates(viewer_id, [candidate_id])).get(candidate_id)
+
+    @abstractmethod
+    async def add_like(self, from_user_id: int, to_user_id: int) -> bool:
+        """Record a like; True exactly once per match, for the like that completes it"""
+
+    @abstractmethod
+    async def add_viewed_profile(self, viewer_id: int, viewed_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    async def count_unread_likes(self, user_id: int) -> int:
+        """Likes the user hasn't answered yet, from a counter kept on write"""
+
+    @abstractmethod
+    async def get_matches(self, user_id: int, limit: Optional[int] = None,
+                          before: Optional[int] = None, after: Optional[int] = None) -> List[Dict]:
+        """Active profiles the user has a current match with, newest first
+
+        Each carries its ``match_id``; pass the last one as ``before`` for
+        the next page, or the first one as ``after`` for the previous page.
+        """
+
+    @abstractmethod
+    async def reset_viewed_profiles(self, user_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    async def clear_all_user_interactions(self, user_id: int) -> bool:
+        """Hide the user's likes, matches and views, in both directions"""
+
+    async def give_user_fresh_start(self, user_id: int) -> bool:
+        if not await self.clear_all_user_interactions(user_id):
+            return False
+        return await self.activate_user(user_id)
+
+    # Maintenance steps, see maintenance.database_jobs. Batched ones return
+    # what they reclaimed and whether more is waiting.
+
+    async def retire_inactive_users(self, days: float, batch_size: int = 1000) -> Tuple[int, bool]:
+        return 0, False
+
+    async def compact_interactions(self, batch_size: int = 1000) -> Tuple[int, bool]:
+        return 0, False
+
+    async def prune_profile_changes(self, keep: int, batch_size: int = 1000) -> Tuple[int, bool]:
+        return 0, False
+
+    async def incremental_vacuum(self, pages: int = 256) -> Tuple[int, bool]:
+        return 0, False
+
+    async def analyze(self, table: str, analysis_limit: int = 1000) -> bool:
+        return False
+
+    async def checkpoint_wal(self) -> int:
+        return 0
+
+    async def sync_engine(self) -> int:
+        return 0
@@ -0,0 +1,152 @@
+import threading
+from typing import Dict, List, Set, Tuple
+
+
+class SwipeBuffer:
+    """Write-behind buffer for viewed profiles and likes
+
+    Swipes from all users are collected in memory and written by a background
+    thread in one transaction every ``flush_interval`` seconds, or sooner once
+    ``flush_batch`` events are waiting. Rows stay visible to ``pending_views``
+    and to the reciprocal-like check until their transaction commits, so
+    readers never see a gap between the buffer and the tables.
+
+    Likes that complete a match are not buffered: the like and the match row
+    are written synchronously so the match is reported exactly once.
+    """
+
+    def __init__(self, database, flush_interval: float = 0.05, flush_batch: int = 500):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._views: List[Tuple[int, int]] = []
+        self._likes: List[Tuple[int, int]] = []
+        # Everything queued or being flushed, for reads that race the writer
+        self._pending_views: Dict[int, Set[int]] = {}
+        self._pending_likes: Set[Tuple[int, int]] = set()
+        self._closed = False
+
+        self._thread = threading.Thread(
+            target=self._run, name="swipe-writer", daemon=True
+        )
+        self._thread.start()
+
+    def add_view(self, viewer_id: int, viewed_id: int):
+        """Queue a viewed profile"""
+        with self._cond:
+            viewed = self._pending_views.setdefault(viewer_id, set())
+            if viewed_id in viewed:
+                return
+            viewed.add(viewed_id)
+            self._views.append((viewer_id, viewed_id))
+            self._notify_if_full()
+
+    def add_like(self, from_user_id: int, to_user_id: int) -> bool:
+        """Queue a like, or write it through if it completes a match"""
+        with self._cond:
+            if ((to_user_id, from_user_id) in self._pending_likes
+                    or self.database._has_like(to_user_id, from_user_id)):
+                # Still under the lock, so the reciprocal like cannot be
+                # reporting this match at the same time.
+                return self.database._write_match(from_user_id, to_user_id)
+
+            if (from_user_id, to_user_id) not in self._pending_likes:
+                self._pending_likes.add((from_user_id, to_user_id))
+                self._likes.append((from_user_id, to_user_id))
+                self._notify_if_full()
+            return False
+
+    def pending_views(self, viewer_id: int) -> Set[int]:
+        """Profiles the viewer has seen that may not be in the table yet"""
+        with self._cond:
+            return set(self._pending_views.get(viewer_id, ()))
+
+    def pending_likes_to(self, to_user_id: int) -> int:
+        """Likes the user received that may not be in the table yet"""
+        with self._cond:
+            return sum(1 for _, liked_id in self._pending_likes if liked_id == to_user_id)
+
+    def discard_views(self, viewer_id: int):
+        """Drop the viewer's queued views, except of profiles they liked
+
+        Waits for a batch that is already being written, so none of them
+        can reach the table after the caller has reset the viewer's set.
+        Liked profiles stay hidden until their like is written.
+        """
+        with self._flush_lock, self._cond:
+            self._views = [
+                view for view in self._views
+                if view[0] != viewer_id or view in self._pending_likes
+            ]
+            viewed = self._pending_views.get(viewer_id)
+            if viewed is not None:
+                viewed.intersection_update(
+                    liked_id for liker_id, liked_id in self._pending_likes if liker_id == viewer_id
+                )
+                if not viewed:
+                    del self._pending_views[viewer_id]
+
+    def discard(self, user_id: int):
+        """Drop every queued view and like by or of the user (see discard_views)"""
+        with self._flush_lock, self._cond:
+            self._views = [view for view in self._views if user_id not in view]
+            self._likes = [like for like in self._likes if user_id not in like]
+            self._pending_likes = {like for like in self._pending_likes if user_id not in like}
+            self._pending_views.pop(user_id, None)
+            for viewer_id, viewed in list(self._pending_views.items()):
+                viewed.discard(user_id)
+                if not viewed:
+                    del self._pending_views[viewer_id]
+
+    def flush(self):
+        """Write everything queued so far in a single transaction"""
+        with self._flush_lock:
+            with self._cond:
+                views, self._views = self._views, []
+                likes, self._likes = self._likes, []
+            if not views and not likes:
+                return
+
+            if not self.database._insert_swipes(views, likes):
+                # Keep the rows for the next attempt
+                with self._cond:
+                    self._views[:0] = views
+                    self._likes[:0] = likes
+                return
+
+            with self._cond:
+                for viewer_id, viewed_id in views:
+                    viewed = self._pending_views.get(viewer_id)
+                    if viewed is not None:
+                        viewed.discard(viewed_id)
+                        if not viewed:
+                            del self._pending_views[viewer_id]
+                self._pending_likes.difference_update(likes)
+
+    def close(self):
+        """Stop the writer thread after a final flush"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+    def _notify_if_full(self):
+        if len(self._views) + len(self._likes) >= self.flush_batch:
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed
+                    or len(self._views) + len(self._likes) >= self.flush_batch,
+                    timeout=self.flush_interval,
+                )
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
@@ -0,0 +1,79 @@
+import asyncio
+import sys
+from typing import Awaitable, Dict, Hashable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Size of the base class semaphore; UserOrderedProcessor.limit is the real limit
+UNLIMITED = sys.maxsize
+
+
+class UserOrderedProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, but one at a time per user
+
+    Conversation state and the candidate queue assume a user's messages are
+    handled in the order they were sent, so updates from one user wait for
+    each other while different users are served in parallel. An update only
+    takes one of the ``max_concurrent_updates`` slots once the user's
+    earlier updates are done, so one user flooding the bot can't hold slots
+    that other users' updates need.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # The base class takes its slot before do_process_update, which
+        # would count updates still waiting for their turn; the limit is
+        # applied here instead
+        super().__init__(UNLIMITED)
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._running = 0
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks: Dict[Hashable, list] = {}
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        """Updates running now, not counting those waiting for their turn"""
+        return self._running
+
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        key = _user_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _run(self, coroutine: Awaitable):
+        async with self._slots:
+            self._running += 1
+            try:
+                await coroutine
+            finally:
+                self._running -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def _user_key(update: object):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
@@ -0,0 +1,156 @@
+import asyncio
+import hmac
+import json
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from telegram import Update
+from telegram.ext import Application
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    502: "Bad Gateway",
+}
+
+# Takes the decoded update JSON, returns an HTTP status (None for 200)
+Handler = Callable[[dict], Awaitable[Optional[int]]]
+
+
+def application_handler(app: Application) -> Handler:
+    """Handler that puts updates on the application's update queue"""
+    async def handle(data: dict):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    return handle
+
+
+class WebhookServer:
+    """Small HTTP/1.1 server for Telegram webhook POSTs
+
+    Each POST to ``path`` with a JSON update body is passed to ``handle``
+    and answered as soon as it returns, so it should only queue the update
+    (an Application is wrapped with ``application_handler``). When
+    ``secret_token`` is set, requests without a matching
+    X-Telegram-Bot-Api-Secret-Token header get 403. Connections are kept
+    alive, as Telegram reuses them.
+    """
+
+    def __init__(self, handle, host: str = "127.0.0.1", port: int = 8443,
+                 path: str = "/telegram", secret_token: Optional[str] = None,
+                 max_body: int = 1024 * 1024):
+        if isinstance(handle, Application):
+            handle = application_handler(handle)
+        self.handle = handle
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.max_body = max_body
+        self.received = 0
+        self.rejected = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+        # Connections in the middle of a request
+        self._busy: Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self, timeout: float = 5.0):
+        """Stop accepting connections and let requests in progress finish"""
+        if self._server:
+            self._server.close()
+        # Idle keep-alive connections are closed right away, which ends their tasks
+        for task, writer in list(self._connections.items()):
+            if task not in self._busy:
+                writer.close()
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=timeout)
+        for task in list(self._connections):
+            task.cancel()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            keep_alive = True
+            while keep_alive and not reader.at_eof():
+                keep_alive = await self._handle_request(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            self._busy.discard(task)
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader,
+                              writer: asyncio.StreamWriter) -> bool:
+        """Read and answer one request; returns whether to keep the connection"""
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        task = asyncio.current_task()
+        self._busy.add(task)
+        try:
+            return await self._answer(request_line, reader, writer)
+        finally:
+            self._busy.discard(task)
+
+    async def _answer(self, request_line: bytes, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> bool:
+        method, target, version = request_line.decode("latin-1").split()
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        if length > self.max_body:
+            await self._respond(writer, 413, False)
+            return False
+        body = await reader.readexactly(length) if length else b""
+
+        status = self._check(method, target, headers)
+        if status == 200:
+            try:
+                status = await self.handle(json.loads(body)) or 200
+            except (ValueError, TypeError, KeyError):
+                status = 400
+            if status == 200:
+                self.received += 1
+        if status != 200:
+            self.rejected += 1
+
+        await self._respond(writer, status, keep_alive)
+        return keep_alive
+
+    def _check(self, method: str, target: str, headers) -> int:
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()
+        ):
+            return 403
+        return 200
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, keep_alive: bool):
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()